@@ -66,4 +66,5 @@ if not app.debug:
         app.logger.info('Microblog startup')
 
 
-from app import routes, models
+from app import routes, models, indexer, cli, fragments, api, stream, \
+    accounts
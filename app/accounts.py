@@ -0,0 +1,203 @@
+"""
+Deletion of the accounts, in the background for the big ones
+"""
+from datetime import datetime, timedelta
+import os
+from threading import Event, Lock, Thread
+from app import app, db
+from app.explore import recent_posts
+from app.fragments import post_fragments
+from app.models import User, Post, AccountDeletion, Counters, followers, \
+    timeline
+from app.search import search_cache, hydration_cache
+
+
+class AccountDeleter:
+    """
+    Deletes the accounts in batches of posts, newest first so that they
+    leave the first pages at once, each batch in its own transaction with
+    set-based statements
+    The account is hidden as soon as its deletion is requested, the
+    accounts with more than ACCOUNT_DELETION_SYNC_LIMIT posts are deleted
+    by a thread of each process (or `flask account worker`), which resumes
+    the jobs interrupted for ACCOUNT_DELETION_STALE seconds
+    """
+
+    def __init__(self):
+        self.wakeup = Event()
+        self.lock = Lock()
+        self.thread = None
+        self.pid = None
+
+    def request(self, user):
+        """
+        Hides an account and deletes it, at once if it has few posts
+        Returns the deletion job
+        """
+        user.deleted_at = datetime.utcnow()
+        inline = user.posts_count <= app.config['ACCOUNT_DELETION_SYNC_LIMIT']
+        # claimed by this request when it is deleted at once
+        job = AccountDeletion(user_id=user.id, username=user.username,
+                              posts_total=user.posts_count,
+                              status='running' if inline else 'pending')
+        db.session.add(job)
+        db.session.commit()
+        if inline:
+            self.run(job)
+        else:
+            self.notify()
+        return job
+
+    def delete_batch(self, job):
+        """
+        Deletes the newest posts of an account
+        Returns the number of posts deleted
+        """
+        post_ids = [post_id for post_id, in db.session.query(Post.id)
+                    .filter(Post.user_id == job.user_id)
+                    .order_by(Post.timestamp.desc(), Post.id.desc())
+                    .limit(app.config['ACCOUNT_DELETION_BATCH_SIZE'])]
+        now = datetime.utcnow()
+        if post_ids:
+            Post.unindex(post_ids)
+            # a single bound list, much cheaper to compile than one per id
+            ids = db.bindparam('ids', expanding=True)
+            # by reader first, the key of the timelines
+            readers = db.select([followers.c.follower_id]) \
+                .where(followers.c.followed_id == job.user_id) \
+                .union(db.select([db.literal(job.user_id)]))
+            db.session.execute(timeline.delete()
+                               .where(timeline.c.user_id.in_(readers))
+                               .where(timeline.c.post_id.in_(ids)),
+                               {'ids': post_ids})
+            db.session.execute(Post.__table__.delete()
+                               .where(Post.id.in_(ids)), {'ids': post_ids})
+            # the timelines of the followers change
+            db.session.execute(User.__table__.update()
+                               .where(User.id == job.user_id)
+                               .values(updated_at=now))
+        job.posts_deleted += len(post_ids)
+        job.updated_at = now
+        db.session.commit()
+        self.forget_posts(post_ids)
+        return len(post_ids)
+
+    @staticmethod
+    def forget_posts(post_ids):
+        """
+        Drops the deleted posts from the caches of this process
+        """
+        if not post_ids:
+            return
+        if recent_posts.enabled():
+            recent_posts.prune(post_ids)
+        post_fragments.discard(post_ids)
+        hydration_cache.discard(Post.__tablename__, post_ids)
+        search_cache.invalidate()
+
+    @staticmethod
+    def delete_user(job):
+        """
+        Deletes the user of a job once it has no posts
+        """
+        Counters.forget_follows(db.session, job.user_id)
+        db.session.execute(followers.delete().where(db.or_(
+            followers.c.follower_id == job.user_id,
+            followers.c.followed_id == job.user_id)))
+        db.session.execute(timeline.delete()
+                           .where(timeline.c.user_id == job.user_id))
+        db.session.execute(User.__table__.delete()
+                           .where(User.id == job.user_id))
+        job.status = 'done'
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    def run(self, job):
+        """
+        Deletes the account of a claimed job
+        """
+        while self.delete_batch(job):
+            pass
+        self.delete_user(job)
+
+    @staticmethod
+    def claim():
+        """
+        Returns the next pending or interrupted job, marked as running by
+        this process, or None
+        """
+        stale = datetime.utcnow() - \
+            timedelta(seconds=app.config['ACCOUNT_DELETION_STALE'])
+        candidates = AccountDeletion.query.filter(db.or_(
+            AccountDeletion.status == 'pending',
+            db.and_(AccountDeletion.status == 'running',
+                    AccountDeletion.updated_at < stale))) \
+            .order_by(AccountDeletion.id).limit(10).all()
+        for job in candidates:
+            # the other processes may claim it meanwhile
+            claimed = AccountDeletion.query.filter_by(
+                id=job.id, status=job.status, updated_at=job.updated_at) \
+                .update({'status': 'running',
+                         'updated_at': datetime.utcnow()},
+                        synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return job
+        return None
+
+    def work(self):
+        """
+        Runs the waiting jobs
+        Returns the number of accounts deleted
+        """
+        deleted = 0
+        while True:
+            job = self.claim()
+            if job is None:
+                return deleted
+            self.run(job)
+            deleted += 1
+
+    def loop(self):
+        """
+        Runs the jobs when notified, or periodically for the jobs of the
+        other processes and the interrupted ones
+        """
+        while True:
+            self.wakeup.clear()
+            with app.app_context():
+                try:
+                    self.work()
+                except Exception:
+                    app.logger.exception('Account deletion error')
+                finally:
+                    db.session.remove()
+            self.wakeup.wait(app.config['ACCOUNT_DELETION_INTERVAL'])
+
+    def notify(self):
+        """
+        Wakes up the deletion thread, starting it in this process if needed
+        """
+        if not app.config['ACCOUNT_DELETION_THREAD']:
+            return
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.wakeup = Event()
+                self.thread = Thread(target=self.loop, daemon=True,
+                                     name='account-deleter')
+                self.thread.start()
+        self.wakeup.set()
+
+
+account_deleter = AccountDeleter()
+
+
+@app.before_first_request
+def start_account_deleter():
+    """
+    Resumes the deletions left by a previous run of the process
+    """
+    if AccountDeletion.query.filter(AccountDeletion.status != 'done') \
+            .first() is not None:
+        account_deleter.notify()
@@ -0,0 +1,132 @@
+"""
+Write-behind buffer of the last visits of the users
+"""
+import atexit
+from datetime import datetime, timedelta
+import os
+from threading import Event, Lock, Thread
+from app import app, db
+from app.models import User
+
+
+class LastSeenBuffer:
+    """
+    Records the last visits of the users in memory, at most once per user
+    and granularity, and writes them in a single batched UPDATE periodically
+    and when the process exits
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.recorded = {}
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.thread = None
+        self.pid = None
+
+    def granularity(self):
+        """
+        Returns the minimum delay between two recorded visits of a user
+        """
+        return timedelta(seconds=app.config['LAST_SEEN_GRANULARITY'])
+
+    def touch(self, user_id, now=None):
+        """
+        Records a visit of a user
+        Returns whether the visit will be written
+        """
+        now = now or datetime.utcnow()
+        with self.lock:
+            recorded = self.recorded.get(user_id)
+            if recorded is not None and now - recorded < self.granularity():
+                return False
+            self.recorded[user_id] = self.pending[user_id] = now
+        self.start()
+        return True
+
+    def seen(self, user):
+        """
+        Returns the last visit of a user, including a visit not written yet
+        """
+        with self.lock:
+            pending = self.pending.get(user.id)
+        if pending is None or (user.last_seen and user.last_seen > pending):
+            return user.last_seen
+        return pending
+
+    def flush(self):
+        """
+        Writes the recorded visits
+        Returns the number of users written
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            horizon = datetime.utcnow() - self.granularity()
+            self.recorded = {user_id: seen for user_id, seen
+                             in self.recorded.items() if seen > horizon}
+        if not pending:
+            return 0
+        user = User.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    user.update()
+                    .where(user.c.id == db.bindparam('user_id'))
+                    .where(db.or_(user.c.last_seen.is_(None),
+                                  user.c.last_seen < db.bindparam('seen')))
+                    .values(last_seen=db.bindparam('seen')),
+                    [{'user_id': user_id, 'seen': seen}
+                     for user_id, seen in pending.items()])
+        except Exception:
+            # written with the next flush, unless there are newer visits
+            with self.lock:
+                for user_id, seen in pending.items():
+                    self.pending.setdefault(user_id, seen)
+            raise
+        return len(pending)
+
+    def clear(self):
+        """
+        Forgets the recorded visits without writing them
+        """
+        with self.lock:
+            self.pending.clear()
+            self.recorded.clear()
+
+    def run(self):
+        """
+        Writes the recorded visits periodically
+        """
+        while True:
+            self.wakeup.wait(app.config['LAST_SEEN_FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Last seen flush error')
+
+    def start(self):
+        """
+        Starts the flushing thread in this process if needed
+        """
+        if not app.config['LAST_SEEN_FLUSH_INTERVAL']:
+            return
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = Thread(target=self.run, daemon=True,
+                                     name='last-seen')
+                self.thread.start()
+
+
+last_seen_buffer = LastSeenBuffer()
+
+
+@atexit.register
+def flush_last_seen():
+    """
+    Writes the visits recorded by the worker before it exits
+    """
+    try:
+        last_seen_buffer.flush()
+    except Exception:
+        app.logger.exception('Last seen flush error')
@@ -0,0 +1,250 @@
+"""
+JSON API of the timelines, version 1
+Lists of posts are paged with cursors and every response can be reduced to
+some fields, e.g. /api/v1/explore?fields=id,body,author.username
+"""
+from functools import wraps
+import json
+from flask import request, Response
+from flask_login import current_user
+from app import app
+from app.activity import last_seen_buffer
+from app.explore import recent_page
+from app.models import User, Post, preload_authors
+from app.pagination import keyset_paginate, decode_cursor, \
+    encode_search_cursor, decode_search_cursor
+
+MAX_LIMIT = 100
+
+
+def isoformat(value):
+    """
+    Returns a UTC datetime in ISO 8601 format, or None
+    """
+    return value.isoformat() + 'Z' if value is not None else None
+
+
+USER_FIELDS = {
+    'id': lambda user: user.id,
+    'username': lambda user: user.username,
+    'about_me': lambda user: user.about_me,
+    'avatar': lambda user: user.avatar(128),
+    'last_seen': lambda user: isoformat(last_seen_buffer.seen(user)),
+    'followers_count': lambda user: user.followers_count,
+    'followed_count': lambda user: user.followed_count,
+    'posts_count': lambda user: user.posts_count,
+    'following': lambda user: current_user.is_following(user),
+}
+POST_FIELDS = {
+    'id': lambda post: post.id,
+    'body': lambda post: post.body,
+    'timestamp': lambda post: isoformat(post.timestamp),
+}
+# fields of the authors embedded in the posts when none are requested
+AUTHOR_FIELDS = ('username', 'avatar')
+
+
+class APIError(Exception):
+    """
+    Error answered as a JSON object with its status code
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@app.errorhandler(APIError)
+def api_error(error):
+    """
+    Answers the errors of the API in JSON
+    """
+    return json_response({'error': error.message}, error.status)
+
+
+def json_response(payload, status=200):
+    """
+    Returns a compact JSON response
+    """
+    return Response(json.dumps(payload, separators=(',', ':'),
+                               ensure_ascii=False),
+                    status=status, mimetype='application/json')
+
+
+def api_login_required(view):
+    """
+    Answers 401 instead of redirecting to the login page
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated:
+            raise APIError(401, 'Authentication required')
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def requested_fields(allowed, nested=None):
+    """
+    Returns the requested top-level fields and the requested fields of the
+    nested objects, by name, from the `fields` argument
+    """
+    nested = nested or {}
+    fields, subfields = [], {}
+    names = [name.strip() for name in request.args.get('fields', '').split(',')
+             if name.strip()]
+    for name in names or list(allowed) + list(nested):
+        parent, _, child = name.partition('.')
+        if parent in nested:
+            if child and child not in nested[parent]:
+                raise APIError(400, f'Unknown field {name}')
+            subfields.setdefault(parent, [])
+            if child:
+                subfields[parent].append(child)
+            if parent not in fields:
+                fields.append(parent)
+        elif parent in allowed and not child:
+            fields.append(name)
+        else:
+            raise APIError(400, f'Unknown field {name}')
+    return fields, subfields
+
+
+def serializer(getters, fields):
+    """
+    Returns a function turning an object into a dict of the fields
+    """
+    selected = [(field, getters[field]) for field in fields
+                if field in getters]
+    return lambda obj: {field: getter(obj) for field, getter in selected}
+
+
+def serialize_posts(posts):
+    """
+    Returns the requested fields of posts, their authors loaded at once
+    """
+    fields, subfields = requested_fields(POST_FIELDS, {'author': USER_FIELDS})
+    serialize = serializer(POST_FIELDS, fields)
+    author = None
+    if 'author' in fields:
+        posts = preload_authors(posts)
+        author = serializer(USER_FIELDS,
+                            subfields['author'] or AUTHOR_FIELDS)
+    items = []
+    for post in posts:
+        item = serialize(post)
+        if author is not None:
+            item['author'] = author(post.author) \
+                if post.author is not None else None
+        items.append(item)
+    return items
+
+
+def limit():
+    """
+    Returns the requested number of items per page
+    """
+    value = request.args.get('limit', app.config['POSTS_PER_PAGE'], type=int)
+    if not 0 < value <= MAX_LIMIT:
+        raise APIError(400, f'limit must be between 1 and {MAX_LIMIT}')
+    return value
+
+
+def cursor():
+    """
+    Returns the cursor argument, checked
+    """
+    value = request.args.get('cursor')
+    if value is not None and decode_cursor(value) is None:
+        raise APIError(400, 'Invalid cursor')
+    return value
+
+
+def posts_page(query, key=(Post.timestamp, Post.id), page=None):
+    """
+    Returns the response of a keyset page of posts, paginated on their
+    (timestamp, id) key columns
+    """
+    if page is None:
+        page = keyset_paginate(query, key, limit(), cursor())
+    return json_response({'posts': serialize_posts(page.items),
+                          'next_cursor': page.next_cursor,
+                          'prev_cursor': page.prev_cursor})
+
+
+@app.route('/api/v1/timeline')
+@api_login_required
+def api_timeline():
+    """
+    Home timeline of the current user
+    """
+    return posts_page(*current_user.timeline())
+
+
+@app.route('/api/v1/explore')
+@api_login_required
+def api_explore():
+    """
+    All the posts, newest first
+    """
+    return posts_page(Post.query, page=recent_page(limit(), cursor()))
+
+
+@app.route('/api/v1/users/<username>/posts')
+@api_login_required
+def api_user_posts(username):
+    """
+    Posts of a user
+    """
+    target_user = User.query.filter_by(username=username,
+                                       deleted_at=None).first()
+    if target_user is None:
+        raise APIError(404, f'User {username} not found')
+    return posts_page(target_user.posts)
+
+
+@app.route('/api/v1/search')
+@api_login_required
+def api_search():
+    """
+    Posts matching the `q` argument, by relevance
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        raise APIError(400, 'q is required')
+    per_page = limit()
+    position = None
+    if 'cursor' in request.args:
+        position = decode_search_cursor(request.args['cursor'])
+        if position is None:
+            raise APIError(400, 'Invalid cursor')
+    page, after = position or (1, None)
+    posts, total, position = Post.search(query, page, per_page, after)
+    next_cursor = encode_search_cursor(page + 1, position) \
+        if position and (total > page * per_page or
+                         total >= app.config['SEARCH_MAX_OFFSET']) else None
+    return json_response({'posts': serialize_posts(posts), 'total': total,
+                          'next_cursor': next_cursor})
+
+
+@app.route('/api/v1/users')
+@api_login_required
+def api_users():
+    """
+    Users of a comma-separated list of usernames, in a single query
+    """
+    usernames = [username.strip() for username
+                 in request.args.get('usernames', '').split(',')
+                 if username.strip()]
+    if not 0 < len(usernames) <= MAX_LIMIT:
+        raise APIError(400, f'usernames must list 1 to {MAX_LIMIT} users')
+    fields, _ = requested_fields(USER_FIELDS)
+    serialize = serializer(USER_FIELDS, fields)
+    found = {user.username: user for user in
+             User.query.filter(User.username.in_(usernames),
+                               User.deleted_at.is_(None))}
+    return json_response({
+        'users': [serialize(found[username]) for username in usernames
+                  if username in found],
+        'missing': [username for username in usernames
+                    if username not in found]})
@@ -0,0 +1,130 @@
+"""
+In-memory caches
+"""
+from collections import OrderedDict
+import fcntl
+import mmap
+import os
+import struct
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+    """
+    Thread-safe cache bounded in number of entries, evicting the least
+    recently used ones, with an optional time to live in seconds
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the value of a key, or the default if it is missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[1] is not None and
+                                 entry[1] < monotonic()):
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """
+        Stores the value of a key, evicting the oldest entries if needed
+        """
+        if self.maxsize <= 0:
+            return
+        expires = monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Removes a key from the cache
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all the entries
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns the size and hit/miss counters of the cache
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / requests if requests else 0.0}
+
+
+class Generation:
+    """
+    Counter bumped to invalidate the entries of a cache at once
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def get(self):
+        """
+        Returns the current generation
+        """
+        return self.value
+
+    def bump(self):
+        """
+        Starts a new generation
+        """
+        with self.lock:
+            self.value += 1
+
+
+class SharedGeneration(Generation):
+    """
+    Generation counter stored in a memory-mapped file, shared by all the
+    processes using the same path (gunicorn workers, indexer worker)
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < 8:
+                os.ftruncate(fd, 8)
+            self.map = mmap.mmap(fd, 8)
+        finally:
+            os.close(fd)
+        self.path = path
+
+    def get(self):
+        return struct.unpack_from('Q', self.map)[0]
+
+    def bump(self):
+        with self.lock, open(self.path, 'rb') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                struct.pack_into('Q', self.map, 0, self.get() + 1)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,248 @@
+"""
+Command line interface of the app
+"""
+import click
+from sqlalchemy.exc import SQLAlchemyError
+from app import app, db
+from app.models import User, Counters, Timeline, AccountDeletion
+from app.accounts import account_deleter
+from app.data import KINDS, FORMATS, Importer, export_rows, read_records
+from app.indexer import indexer, Reindexer, SEARCHABLE_MODELS
+from app.search import search_backend
+from app.profiling import profile_token
+
+
+@app.cli.group()
+def timeline():
+    """
+    Home timeline commands
+    """
+
+
+@timeline.command()
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of users rebuilt per transaction.')
+def rebuild(batch_size):
+    """
+    Rebuilds the materialized home timelines of all the users
+    """
+    last_id, rebuilt = 0, 0
+    while True:
+        user_ids = [user_id for user_id, in db.session.query(User.id)
+                    .filter(User.id > last_id).order_by(User.id)
+                    .limit(batch_size)]
+        if not user_ids:
+            break
+        Timeline.rebuild(user_ids)
+        db.session.commit()
+        last_id = user_ids[-1]
+        rebuilt += len(user_ids)
+        click.echo(f'{rebuilt} timelines rebuilt')
+
+
+@app.cli.group()
+def counters():
+    """
+    User counters commands
+    """
+
+
+@counters.command()
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of users checked per transaction.')
+@click.option('--repair', is_flag=True, help='Fix the drifted counters.')
+def check(batch_size, repair):
+    """
+    Checks the follower, following and post counters of all the users
+    """
+    last_id, checked, drifted = 0, 0, 0
+    while True:
+        user_ids = [user_id for user_id, in db.session.query(User.id)
+                    .filter(User.id > last_id).order_by(User.id)
+                    .limit(batch_size)]
+        if not user_ids:
+            break
+        for user_id, column, stored, actual in \
+                Counters.check(user_ids, repair=repair):
+            click.echo(f'user {user_id}: {column} is {stored}, '
+                       f'expected {actual}')
+            drifted += 1
+        db.session.commit()
+        last_id = user_ids[-1]
+        checked += len(user_ids)
+    status = 'repaired' if repair else 'found'
+    click.echo(f'{checked} users checked, {drifted} drifted counters {status}')
+
+
+@app.cli.group()
+def search():
+    """
+    Search index commands
+    """
+
+
+@search.command()
+def status():
+    """
+    Shows the number of mutations waiting in the search outbox
+    """
+    click.echo(f'{indexer.queue_depth()} mutations in the outbox')
+
+
+@search.command()
+def drain():
+    """
+    Sends the due mutations of the search outbox to Elasticsearch
+    """
+    click.echo(f'{indexer.drain()} mutations processed, '
+               f'{indexer.queue_depth()} left in the outbox')
+
+
+@search.command()
+def worker():
+    """
+    Runs the search indexer in the foreground
+    """
+    indexer.run()
+
+
+@search.command()
+@click.option('--index', default='post', show_default=True,
+              type=click.Choice(sorted(SEARCHABLE_MODELS)))
+@click.option('--workers',
+              default=lambda: app.config['SEARCH_REINDEX_WORKERS'],
+              type=int, help='Number of worker processes.')
+@click.option('--chunk-size', default=10000, show_default=True,
+              help='Number of ids per checkpointed chunk.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of documents per bulk request.')
+@click.option('--checkpoint', help='Path of the checkpoint file.')
+@click.option('--restart', is_flag=True,
+              help='Ignore the checkpoint of a previous run.')
+def reindex(index, workers, chunk_size, batch_size, checkpoint, restart):
+    """
+    Rebuilds a search index from the database, resuming interrupted runs
+    """
+    def progress(sent, failed, elapsed):
+        rate = sent / elapsed if elapsed else 0
+        click.echo(f'{sent} documents sent, {failed} failed, '
+                   f'{rate:.0f} docs/sec')
+
+    if not search_backend().enabled:
+        click.echo('No search backend is configured')
+        return
+    reindexer = Reindexer(index, chunk_size=chunk_size,
+                          batch_size=batch_size, workers=workers,
+                          checkpoint=checkpoint)
+    sent, failed, rate = reindexer.run(restart=restart, progress=progress)
+    click.echo(f'Reindexed {sent} documents at {rate:.0f} docs/sec')
+    if failed:
+        click.echo(f'{failed} documents failed, run the command again to '
+                   f'resume')
+
+
+@app.cli.group()
+def account():
+    """
+    Account commands
+    """
+
+
+@account.command()
+@click.option('--all', 'show_all', is_flag=True,
+              help='Include the finished deletions.')
+def deletions(show_all):
+    """
+    Shows the progress of the account deletions
+    """
+    query = AccountDeletion.query.order_by(AccountDeletion.id)
+    if not show_all:
+        query = query.filter(AccountDeletion.status != 'done')
+    for job in query:
+        click.echo(f'{job.username} ({job.user_id}): {job.status}, '
+                   f'{job.posts_deleted}/{job.posts_total} posts deleted, '
+                   f'requested {job.created_at:%Y-%m-%d %H:%M:%S}, '
+                   f'updated {job.updated_at:%Y-%m-%d %H:%M:%S}')
+
+
+@account.command('worker')
+def account_worker():
+    """
+    Runs the account deletions in the foreground
+    """
+    account_deleter.loop()
+
+
+@app.cli.group()
+def data():
+    """
+    Bulk import and export commands
+    """
+
+
+def file_format(fmt, file):
+    """
+    Returns the format of a file, CSV for the .csv ones and JSON lines
+    otherwise
+    """
+    if fmt is not None:
+        return fmt
+    return 'csv' if getattr(file, 'name', '').endswith('.csv') else 'jsonl'
+
+
+@data.command('export')
+@click.argument('kind', type=click.Choice(sorted(KINDS)))
+@click.argument('file', type=click.File('w', encoding='utf-8'),
+                default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help='Format of the file, from its extension by default.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of rows fetched at once.')
+def export_data(kind, file, fmt, batch_size):
+    """
+    Writes the users, posts or follows to a file (stdout by default)
+    """
+    exported = export_rows(kind, file, file_format(fmt, file), batch_size)
+    click.echo(f'{exported} {kind} exported', err=True)
+
+
+@data.command('import')
+@click.argument('kind', type=click.Choice(sorted(KINDS)))
+@click.argument('file', type=click.File('r', encoding='utf-8'),
+                default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help='Format of the file, from its extension by default.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of rows inserted per transaction.')
+def import_data(kind, file, fmt, batch_size):
+    """
+    Reads users, posts or follows from a file (stdin by default), the
+    users first, then the follows and the posts in any order
+    """
+    importer = Importer(kind, batch_size)
+    try:
+        importer.run(read_records(file, file_format(fmt, file)))
+    except (ValueError, SQLAlchemyError) as error:
+        raise click.ClickException(
+            f'{importer.imported} {kind} imported before the error: {error}')
+    click.echo(f'{importer.imported} {kind} imported')
+    if kind == 'posts' and app.config['EXPLORE_BUFFER_SIZE'] and \
+            not app.config['EXPLORE_BUFFER_PATH']:
+        click.echo('Restart the app to show the imported posts on explore')
+
+
+@app.cli.group()
+def profile():
+    """
+    Request profiling commands
+    """
+
+
+@profile.command()
+@click.option('--expires-in', default=3600, show_default=True,
+              help='Validity of the token in seconds.')
+def token(expires_in):
+    """
+    Prints a token profiling the requests sent with it in X-Profile
+    """
+    click.echo(profile_token(expires_in))
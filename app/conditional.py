@@ -0,0 +1,71 @@
+"""
+Conditional GET of the pages
+The weak ETag of a page is derived from its URL, cheap watermarks of its
+content and from what it carries for the session (user, CSRF tokens), so
+that a 304 is answered before the queries and the rendering of the page
+"""
+from hashlib import md5
+import os
+from time import time
+from flask import g, make_response, request, session
+from flask_login import current_user
+from app import app
+
+
+def templates_version():
+    """
+    Returns a digest of the templates, so that a new release changes the
+    ETags of all the pages
+    """
+    digest = md5()
+    for directory, _, filenames in sorted(
+            os.walk(app.jinja_loader.searchpath[0])):
+        for filename in sorted(filenames):
+            with open(os.path.join(directory, filename), 'rb') as template:
+                digest.update(template.read())
+    return digest.hexdigest()
+
+
+TEMPLATES_VERSION = templates_version()
+
+
+def page_etag(*watermarks):
+    """
+    Returns the ETag of the current page for these watermarks
+    """
+    # the CSRF tokens of a page expire, it is rendered again at half of
+    # their lifetime
+    limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    parts = [TEMPLATES_VERSION, request.full_path, current_user.get_id(),
+             current_user.updated_at, session.get('csrf_token'),
+             int(time() // (limit / 2)) if limit else None, *watermarks]
+    return md5(repr(parts).encode('utf-8')).hexdigest()
+
+
+def not_modified(*watermarks):
+    """
+    Returns a 304 response if the client already has the page of these
+    watermarks, otherwise None and the ETag is added to the page
+    """
+    if not app.config['CONDITIONAL_GET'] or request.method != 'GET' or \
+            '_flashes' in session:
+        # the flashed messages are only shown once
+        return None
+    g.etag = page_etag(*watermarks)
+    if request.if_none_match.contains_weak(g.etag):
+        return make_response('', 304)
+    return None
+
+
+@app.after_request
+def add_etag(response):
+    """
+    Adds the ETag of a conditional page, only kept by the browser of the
+    user and always revalidated
+    """
+    etag = g.pop('etag', None)
+    if etag is not None and response.status_code in (200, 304):
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+    return response
@@ -0,0 +1,298 @@
+"""
+Streaming import and export of the users, posts and follows
+"""
+from collections import Counter
+import csv
+from datetime import datetime
+from hashlib import md5
+import io
+import json
+from app import app, db
+from app.explore import recent_posts
+from app.models import User, Post, Timeline, followers
+from app.search import search_backend, search_cache
+
+# exported fields of each kind, with their parser
+KINDS = {
+    'users': (User.__table__, {'id': int, 'username': str, 'email': str,
+                               'password_hash': str, 'about_me': str,
+                               'last_seen': datetime.fromisoformat}),
+    'posts': (Post.__table__, {'id': int, 'user_id': int, 'body': str,
+                               'timestamp': datetime.fromisoformat}),
+    'follows': (followers, {'follower_id': int, 'followed_id': int}),
+}
+REQUIRED = {'users': ['username'], 'posts': ['user_id', 'body'],
+            'follows': ['follower_id', 'followed_id']}
+FORMATS = ['jsonl', 'csv']
+
+
+def export_query(kind):
+    """
+    Returns the select of the rows of a kind, in primary key order, without
+    the accounts being deleted
+    """
+    table, fields = KINDS[kind]
+    query = db.select([table.c[field] for field in fields])
+    live = db.select([User.id]).where(User.deleted_at.is_(None))
+    if kind == 'users':
+        query = query.where(User.deleted_at.is_(None))
+    elif kind == 'posts':
+        query = query.where(Post.user_id.in_(live))
+    else:
+        query = query.where(followers.c.follower_id.in_(live)) \
+            .where(followers.c.followed_id.in_(live))
+    return query.order_by(*table.primary_key.columns)
+
+
+def export_rows(kind, file, fmt, batch_size=1000):
+    """
+    Writes the rows of a kind to a file, streamed from a server-side cursor
+    Returns the number of rows written
+    """
+    fields = list(KINDS[kind][1])
+    query = export_query(kind).execution_options(stream_results=True)
+    result = db.session.execute(query)
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(fields)
+    exported = 0
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            values = [value.isoformat() if isinstance(value, datetime)
+                      else value for value in row]
+            if writer is not None:
+                writer.writerow(values)
+            else:
+                file.write(json.dumps(dict(zip(fields, values)),
+                                      ensure_ascii=False) + '\n')
+        exported += len(rows)
+    result.close()
+    return exported
+
+
+def read_records(file, fmt):
+    """
+    Yields the (line number, record) of a file, empty values left out
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, {key: value for key, value in
+                                    record.items() if value != ''}
+        return
+    for line_number, line in enumerate(file, 1):
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as error:
+                raise ValueError(f'line {line_number}: {error}')
+            if not isinstance(record, dict):
+                raise ValueError(f'line {line_number}: not a JSON object')
+            yield line_number, {key: value for key, value in record.items()
+                                if value is not None}
+
+
+def copy_value(value):
+    """
+    Formats a value for the text format of COPY
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+class Importer:
+    """
+    Inserts rows of a kind in batches of set-based statements, `COPY` on
+    PostgreSQL, each batch in its own transaction with the counters and
+    timelines it changes
+    The imported posts are indexed by a single pass once all the batches
+    are committed; the import is meant for a quiet database, the posts
+    created meanwhile without an id could be fanned out twice
+    """
+
+    def __init__(self, kind, batch_size=1000):
+        self.kind = kind
+        self.table, self.fields = KINDS[kind]
+        self.batch_size = batch_size
+        self.imported = 0
+        # range of the imported ids
+        self.first_id = None
+        self.last_id = None
+
+    def row(self, line_number, record):
+        """
+        Returns the row of a record
+        """
+        for field in REQUIRED[self.kind]:
+            if field not in record:
+                raise ValueError(f'line {line_number}: missing {field}')
+        try:
+            row = {field: parse(record[field]) if field in record else None
+                   for field, parse in self.fields.items()}
+        except (TypeError, ValueError) as error:
+            raise ValueError(f'line {line_number}: {error}')
+        if row.get('id') is None:
+            row.pop('id', None)
+        now = datetime.utcnow()
+        if self.kind == 'users':
+            email = row['email']
+            row['email_hash'] = md5(email.lower().encode('utf-8')) \
+                .hexdigest() if email else None
+            row['last_seen'] = row['last_seen'] or now
+            row['updated_at'] = now
+        elif self.kind == 'posts':
+            row['timestamp'] = row['timestamp'] or now
+        return row
+
+    def run(self, records):
+        """
+        Imports (line number, record) pairs
+        Returns the number of rows imported
+        """
+        batch = []
+        try:
+            for line_number, record in records:
+                batch.append(self.row(line_number, record))
+                if len(batch) == self.batch_size:
+                    self.insert(batch)
+                    batch = []
+            if batch:
+                self.insert(batch)
+        finally:
+            db.session.rollback()
+            self.finish()
+        return self.imported
+
+    def insert(self, rows):
+        """
+        Inserts a batch of rows with their side effects, in a transaction
+        """
+        if self.kind == 'follows':
+            self.copy(rows)
+            self.add_follows(rows)
+            groups = []
+        else:
+            # the rows with an id and the others are inserted separately
+            groups = [[row for row in rows if 'id' in row],
+                      [row for row in rows if 'id' not in row]]
+        for group in groups:
+            if not group:
+                continue
+            if 'id' in group[0]:
+                self.copy(group)
+                self.advance_sequence()
+                ids = [row['id'] for row in group]
+                first, last = min(ids), max(ids)
+            else:
+                # the new ids follow the largest one
+                first = self.max_id() + 1
+                self.copy(group)
+                last = self.max_id()
+                ids = db.select([self.table.c.id]) \
+                    .where(self.table.c.id.between(first, last))
+            if self.kind == 'posts':
+                self.add_posts(group, ids)
+            self.first_id = min(first, self.first_id or first)
+            self.last_id = max(last, self.last_id or last)
+        db.session.commit()
+        self.imported += len(rows)
+
+    def advance_sequence(self):
+        """
+        Moves the PostgreSQL sequence past the ids given by the file, for
+        the rows without one
+        """
+        connection = db.session.connection()
+        if connection.dialect.name != 'postgresql':
+            return
+        table = connection.dialect.identifier_preparer \
+            .format_table(self.table)
+        db.session.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"(SELECT max(id) FROM {table}))")
+
+    def max_id(self):
+        """
+        Returns the largest id of the table, 0 when it is empty
+        """
+        return db.session.query(db.func.coalesce(
+            db.func.max(self.table.c.id), 0)).scalar()
+
+    def copy(self, rows):
+        """
+        Inserts rows with the same keys, through COPY on PostgreSQL and
+        executemany otherwise
+        """
+        connection = db.session.connection()
+        if connection.dialect.name != 'postgresql':
+            connection.execute(self.table.insert(), rows)
+            return
+        columns = list(rows[0])
+        quote = connection.dialect.identifier_preparer
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join(copy_value(row[column])
+                                 for column in columns) + '\n')
+        data.seek(0)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f'COPY {quote.format_table(self.table)} '
+                f'({", ".join(quote.quote(column) for column in columns)}) '
+                f'FROM STDIN', data)
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def bump(column, counts):
+        """
+        Adds counts by user id to a counter column
+        """
+        db.session.execute(
+            User.__table__.update()
+            .where(User.id == db.bindparam('user_id'))
+            .values({column: getattr(User, column) + db.bindparam('delta'),
+                     'updated_at': datetime.utcnow()}),
+            [{'user_id': user_id, 'delta': delta}
+             for user_id, delta in counts.items()])
+
+    def add_posts(self, rows, post_ids):
+        """
+        Counts and fans out imported posts
+        """
+        counts = Counter(row['user_id'] for row in rows)
+        Timeline.fan_out(post_ids, list(counts))
+        self.bump('posts_count', counts)
+
+    def add_follows(self, rows):
+        """
+        Counts imported follows and rebuilds the timelines of the followers
+        """
+        self.bump('followers_count',
+                  Counter(row['followed_id'] for row in rows))
+        following = Counter(row['follower_id'] for row in rows)
+        self.bump('followed_count', following)
+        Timeline.rebuild(list(following))
+
+    def finish(self):
+        """
+        Indexes the imported rows and refreshes what they outdated
+        """
+        if self.kind != 'posts' or self.first_id is None:
+            return
+        if search_backend().enabled:
+            Post.reindex(self.first_id, self.last_id + 1,
+                         batch_size=self.batch_size)
+            # the database indexes are written in the session
+            db.session.commit()
+            search_cache.invalidate()
+        if recent_posts.enabled() and app.config['EXPLORE_BUFFER_PATH']:
+            recent_posts.load()
@@ -1,28 +1,177 @@
 """
 Simple email framework
 """
-from threading import Thread
+import os
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+from time import perf_counter
 from flask import render_template
 from flask_mail import Message
 from app import mail, app
+from app.metrics import metrics
 
 
-def send_async_email(application, msg):
+class MailQueue:
     """
-    Sends an email asynchroneously
+    Bounded queue of emails sent by a fixed pool of worker threads
+    Each worker keeps its SMTP connection open while there are emails to
+    send, when the queue is full the emails wait for a place or are dropped
     """
-    with application.app_context():
-        mail.send(msg)
+
+    def __init__(self):
+        self.queue = None
+        self.workers = []
+        self.lock = Lock()
+        self.pid = None
+        self.connections = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        """
+        Starts the worker threads in this process if needed
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = Queue(app.config['MAIL_QUEUE_SIZE'])
+                self.workers = []
+            self.workers = [worker for worker in self.workers
+                            if worker.is_alive()]
+            while len(self.workers) < app.config['MAIL_WORKERS']:
+                worker = Thread(target=self.run, daemon=True,
+                                name=f'mail-{len(self.workers)}')
+                worker.start()
+                self.workers.append(worker)
+
+    def put(self, msg):
+        """
+        Queues an email
+        Returns False if it was dropped because the queue is full
+        """
+        self.start()
+        try:
+            if app.config['MAIL_QUEUE_FULL'] == 'drop':
+                self.queue.put_nowait((msg, perf_counter()))
+            else:
+                self.queue.put((msg, perf_counter()),
+                               timeout=app.config['MAIL_QUEUE_TIMEOUT'])
+        except Full:
+            with self.lock:
+                self.dropped += 1
+            app.logger.warning(f'Email to {", ".join(msg.recipients)} '
+                               f'dropped, the queue is full')
+            return False
+        return True
+
+    def run(self):
+        """
+        Sends the queued emails
+        """
+        with app.app_context():
+            while True:
+                item = self.queue.get()
+                try:
+                    self.send_batch(item)
+                except Exception:
+                    app.logger.exception('Email worker error')
+
+    def send_batch(self, item):
+        """
+        Sends an email, then the following ones on the same connection until
+        the queue stays empty for the idle timeout
+        """
+        with self.lock:
+            self.connections += 1
+        try:
+            with mail.connect() as connection:
+                while item is not None:
+                    msg, queued = item
+                    connection.send(msg)
+                    latency = perf_counter() - queued
+                    with self.lock:
+                        self.sent += 1
+                        self.latency += latency
+                        self.max_latency = max(self.max_latency, latency)
+                    self.queue.task_done()
+                    item = None
+                    try:
+                        item = self.queue.get(
+                            timeout=app.config['MAIL_IDLE_TIMEOUT'])
+                    except Empty:
+                        pass
+        except Exception:
+            # the connection is likely broken, the next email opens another
+            if item is not None:
+                with self.lock:
+                    self.failed += 1
+                self.queue.task_done()
+            raise
+
+    def join(self):
+        """
+        Waits until the queued emails are processed
+        """
+        if self.queue is not None:
+            self.queue.join()
+
+    def stats(self):
+        """
+        Returns the depth of the queue, the send counters and the latencies
+        between queueing and sending in seconds
+        """
+        with self.lock:
+            return {'depth': self.queue.qsize() if self.queue else 0,
+                    'workers': len(self.workers),
+                    'connections': self.connections,
+                    'sent': self.sent, 'failed': self.failed,
+                    'dropped': self.dropped,
+                    'latency_avg': self.latency / self.sent
+                    if self.sent else 0.0,
+                    'latency_max': self.max_latency}
+
+
+mail_queue = MailQueue()
+
+MAIL_QUEUE_DEPTH = metrics.gauge('microblog_mail_queue_depth',
+                                 'Emails waiting to be sent')
+MAIL_WORKERS = metrics.gauge('microblog_mail_workers',
+                             'Threads sending the emails')
+MAIL_EMAILS = metrics.counter('microblog_mail_emails_total',
+                              'Emails by outcome')
+MAIL_CONNECTIONS = metrics.counter('microblog_mail_connections_total',
+                                   'SMTP connections opened')
+MAIL_LATENCY_MAX = metrics.gauge(
+    'microblog_mail_latency_max_seconds',
+    'Longest time between queueing and sending an email')
+
+
+@metrics.collector
+def mail_metrics():
+    """
+    Returns the state and counters of the mail queue
+    """
+    stats = mail_queue.stats()
+    yield MAIL_QUEUE_DEPTH, stats['depth'], {}
+    yield MAIL_WORKERS, stats['workers'], {}
+    for outcome in ('sent', 'failed', 'dropped'):
+        yield MAIL_EMAILS, stats[outcome], {'outcome': outcome}
+    yield MAIL_CONNECTIONS, stats['connections'], {}
+    yield MAIL_LATENCY_MAX, stats['latency_max'], {}
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     """
     Sends an email using flask-mail
+    Returns False if it was dropped because the queue is full
     """
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+    return mail_queue.put(msg)
 
 
 def send_password_reset_email(user):
@@ -0,0 +1,330 @@
+"""
+Ring buffer of the newest posts serving the first pages of /explore
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import fcntl
+import mmap
+import os
+import struct
+from threading import Lock
+from flask import request, url_for
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from app import app, db
+from app.metrics import metrics
+from app.models import Post
+from app.pagination import KeysetPage, paginate_posts, encode_cursor, \
+    decode_cursor
+
+EPOCH = datetime(1970, 1, 1)
+# 140 characters of UTF-8, the longer bodies are loaded from the database
+BODY_SIZE = 560
+MISSING_BODY = 0xFFFF
+
+
+class RecentPosts:
+    """
+    Newest EXPLORE_BUFFER_SIZE posts as (id, author id, timestamp, body)
+    slots of a ring, in a memory-mapped file shared by the processes when
+    EXPLORE_BUFFER_PATH is set, in the memory of the process otherwise
+    Each process rebuilds it from the database on its first read, new posts
+    are appended and deleted ones pruned when their transaction commits
+    """
+    # version, next slot, used slots, all the posts are in the ring
+    header = struct.Struct('<QQQQ')
+    # id (0 once deleted), author id, timestamp in microseconds, body
+    slot = struct.Struct(f'<qqqH{BODY_SIZE}s')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.map = None
+        self.path = None
+        self.pid = None
+        self.loaded = None
+        self.entries = (None, [])
+
+    @staticmethod
+    def enabled():
+        return app.config['EXPLORE_BUFFER_SIZE'] > 0
+
+    def setup(self):
+        """
+        Maps the ring again with the current configuration
+        """
+        with self.lock:
+            self.pid = None
+
+    def open(self):
+        """
+        Maps the ring of this process, creating it if needed
+        """
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            length = self.header.size + \
+                self.slot.size * app.config['EXPLORE_BUFFER_SIZE']
+            self.path = app.config['EXPLORE_BUFFER_PATH']
+            if self.path:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    if os.fstat(fd).st_size != length:
+                        os.ftruncate(fd, 0)
+                        os.ftruncate(fd, length)
+                    self.map = mmap.mmap(fd, length)
+                finally:
+                    os.close(fd)
+            else:
+                self.map = bytearray(length)
+            self.loaded = None
+            self.entries = (None, [])
+            self.pid = os.getpid()
+
+    @contextmanager
+    def locked(self, exclusive=True):
+        """
+        Locks the ring between the threads, and between the processes when
+        it is shared
+        """
+        with self.lock:
+            if self.path is None:
+                yield
+                return
+            with open(self.path, 'rb') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX if exclusive else
+                            fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def write(self, position, post_id, user_id, timestamp, body):
+        # called with the lock
+        encoded = body.encode('utf-8') if body is not None else b''
+        length = len(encoded) if body is not None and \
+            len(encoded) <= BODY_SIZE else MISSING_BODY
+        self.slot.pack_into(
+            self.map, self.header.size + position * self.slot.size, post_id,
+            user_id or 0, (timestamp - EPOCH) // timedelta(microseconds=1),
+            length, encoded if length != MISSING_BODY else b'')
+
+    def append(self, rows):
+        # called with the lock
+        version, head, used, complete = self.header.unpack_from(self.map)
+        size = app.config['EXPLORE_BUFFER_SIZE']
+        for row in rows:
+            self.write(head, *row)
+            head = (head + 1) % size
+            if used == size:
+                # the oldest post is overwritten
+                complete = 0
+            used = min(size, used + 1)
+        self.header.pack_into(self.map, 0, version + 1, head, used, complete)
+
+    def load(self):
+        """
+        Fills the ring with the newest posts of the database
+        """
+        self.open()
+        size = app.config['EXPLORE_BUFFER_SIZE']
+        with self.locked():
+            # the posts committed meanwhile are appended after this
+            rows = db.session.query(Post.id, Post.user_id, Post.timestamp,
+                                    Post.body) \
+                .order_by(Post.timestamp.desc(), Post.id.desc()) \
+                .limit(size).all()
+            version = self.header.unpack_from(self.map)[0]
+            self.header.pack_into(self.map, 0, version, 0, 0,
+                                  int(len(rows) < size))
+            self.append(reversed(rows))
+        self.loaded = os.getpid()
+
+    def add(self, rows):
+        """
+        Appends new (id, author id, timestamp, body) posts
+        """
+        self.open()
+        with self.locked():
+            self.append(rows)
+
+    def prune(self, post_ids):
+        """
+        Marks deleted posts
+        """
+        self.open()
+        post_ids = set(post_ids)
+        with self.locked():
+            version, head, used, complete = self.header.unpack_from(self.map)
+            for position in range(used):
+                offset = self.header.size + position * self.slot.size
+                if struct.unpack_from('<q', self.map, offset)[0] in post_ids:
+                    struct.pack_into('<q', self.map, offset, 0)
+            self.header.pack_into(self.map, 0, version + 1, head, used,
+                                  complete)
+
+    def read(self):
+        """
+        Returns whether the ring has all the posts, and its posts as
+        (timestamp, id, author id, body) newest first
+        """
+        if self.loaded != os.getpid():
+            self.load()
+        with self.locked(exclusive=False):
+            version, head, used, complete = self.header.unpack_from(self.map)
+            if self.entries[0] == version:
+                return complete, self.entries[1]
+            entries = {}
+            for position in range(used):
+                post_id, user_id, timestamp, length, body = \
+                    self.slot.unpack_from(self.map, self.header.size +
+                                          position * self.slot.size)
+                if post_id:
+                    entries[post_id] = (
+                        EPOCH + timedelta(microseconds=timestamp), post_id,
+                        user_id or None, body[:length].decode('utf-8')
+                        if length != MISSING_BODY else None)
+        entries = sorted(entries.values(), reverse=True)
+        self.entries = (version, entries)
+        return complete, entries
+
+    def newest(self, limit, offset=0, before=None):
+        """
+        Returns up to `limit` posts from an offset, or before a
+        (timestamp, id) position, as (timestamp, id, author id, body)
+        Returns None if the ring does not have all of them
+        """
+        complete, entries = self.read()
+        if before is not None:
+            entries = [entry for entry in entries if entry[:2] < before]
+        entries = entries[offset:offset + limit]
+        if len(entries) < limit and not complete:
+            return None
+        return entries
+
+    @staticmethod
+    def posts(entries):
+        """
+        Returns the Post objects of (timestamp, id, author id, body) entries,
+        without querying the database
+        """
+        session = db.session()
+        mapper = inspect(Post)
+        posts = []
+        for timestamp, post_id, user_id, body in entries:
+            obj = session.identity_map.get(
+                mapper.identity_key_from_primary_key([post_id]))
+            if obj is None and body is not None:
+                obj = mapper.class_manager.new_instance()
+                for attribute, value in (('id', post_id), ('user_id', user_id),
+                                         ('timestamp', timestamp),
+                                         ('body', body)):
+                    set_committed_value(obj, attribute, value)
+                make_transient_to_detached(obj)
+                session.add(obj)
+            posts.append(obj if obj is not None else post_id)
+        missing = [post for post in posts if isinstance(post, int)]
+        if missing:
+            loaded = {post.id: post
+                      for post in Post.query.filter(Post.id.in_(missing))}
+            posts = [loaded.get(post) if isinstance(post, int) else post
+                     for post in posts]
+        return [post for post in posts if post is not None]
+
+    def after_flush(self, session, flush_context):
+        """
+        Saves the posts created and deleted by the flush
+        """
+        if not self.enabled():
+            return
+        changes = session.info.setdefault('recent_posts', ([], []))
+        changes[0].extend((obj.id, obj.user_id, obj.timestamp, obj.body)
+                          for obj in session.new if isinstance(obj, Post))
+        changes[1].extend(obj.id for obj in session.deleted
+                          if isinstance(obj, Post))
+
+    def after_commit(self, session):
+        """
+        Applies the committed posts to the ring
+        """
+        added, deleted = session.info.pop('recent_posts', ([], []))
+        if added:
+            self.add(added)
+        if deleted:
+            self.prune(deleted)
+
+    @staticmethod
+    def after_rollback(session):
+        """
+        Forgets the posts of a rolled back transaction
+        """
+        session.info.pop('recent_posts', None)
+
+
+recent_posts = RecentPosts()
+db.event.listen(db.session, 'after_flush', recent_posts.after_flush)
+db.event.listen(db.session, 'after_commit', recent_posts.after_commit)
+db.event.listen(db.session, 'after_rollback', recent_posts.after_rollback)
+
+EXPLORE_PAGES = metrics.counter('microblog_explore_pages_total',
+                                'Explore pages by source')
+
+
+def recent_page(per_page, cursor=None):
+    """
+    Returns the keyset page of the newest posts after a cursor from the
+    recent posts, or None if they do not have it
+    """
+    if not recent_posts.enabled():
+        return None
+    key = decode_cursor(cursor) if cursor else None
+    # only the older pages, the newer ones are followed back in SQL
+    if key is not None and key[0] != 'n':
+        return None
+    entries = recent_posts.newest(per_page + 1,
+                                  before=key[1:] if key else None)
+    if entries is None:
+        return None
+    metrics.inc(EXPLORE_PAGES, source='buffer')
+    posts = recent_posts.posts(entries[:per_page])
+    return KeysetPage(
+        posts,
+        encode_cursor('n', posts[-1])
+        if len(entries) > per_page and posts else None,
+        encode_cursor('p', posts[0]) if key and posts else None)
+
+
+def paginate_explore():
+    """
+    Paginates /explore from the recent posts when they have the page, from
+    the database otherwise
+    Returns the posts of the page and the urls of the next and previous pages
+    """
+    per_page = app.config['POSTS_PER_PAGE']
+    if app.config['CURSOR_PAGINATION'] and 'page' not in request.args:
+        page = recent_page(per_page, request.args.get('cursor'))
+        if page is not None:
+            next_url = url_for('explore', cursor=page.next_cursor) \
+                if page.next_cursor else None
+            prev_url = url_for('explore', cursor=page.prev_cursor) \
+                if page.prev_cursor else None
+            return page.items, next_url, prev_url
+    elif recent_posts.enabled():
+        page = request.args.get('page', 1, type=int)
+        entries = recent_posts.newest(
+            per_page + 1, offset=(page - 1) * per_page) \
+            if page >= 1 else None
+        if entries is not None:
+            metrics.inc(EXPLORE_PAGES, source='buffer')
+            next_url = url_for('explore', page=page + 1) \
+                if len(entries) > per_page else None
+            prev_url = url_for('explore', page=page - 1
+                               if page > 2 else None) \
+                if page > 1 else None
+            return recent_posts.posts(entries[:per_page]), next_url, \
+                prev_url
+    metrics.inc(EXPLORE_PAGES, source='database')
+    return paginate_posts(Post.query.order_by(Post.timestamp.desc()),
+                          (Post.timestamp, Post.id), 'explore')
@@ -0,0 +1,110 @@
+"""
+Cache of the rendered posts
+"""
+from flask import render_template
+from flask_login import current_user
+from markupsafe import Markup
+from app import app, db
+from app.cache import LRUCache
+from app.metrics import metrics
+from app.models import Post
+
+# stands for the CSRF field of the delete form, which changes with the
+# session and the time
+CSRF_PLACEHOLDER = '\x00csrf\x00'
+
+
+class PostFragmentCache:
+    """
+    HTML of the posts rendered by _post.html, by post and by viewer class
+    (author of the post or not), bounded by POST_FRAGMENT_CACHE_SIZE
+    An entry is only used while the post and its author still render the
+    same (body, author name and avatar), so that profile edits and reused
+    ids are never served from another process' stale entries
+    """
+
+    def __init__(self):
+        self.cache = None
+
+    def setup(self):
+        """
+        Creates an empty cache with the current configuration
+        """
+        self.cache = LRUCache(app.config['POST_FRAGMENT_CACHE_SIZE'])
+
+    @staticmethod
+    def fingerprint(post):
+        author = post.author
+        return post.body, post.timestamp, author.username, author.email_hash
+
+    def render(self, post, delete_form, no_popover=False):
+        """
+        Returns the HTML of a post
+        """
+        if self.cache is None:
+            self.setup()
+        owner = current_user == post.author
+        # only the authors get the delete form
+        csrf = str(delete_form.hidden_tag()) if owner else ''
+        key = (post.id, owner, no_popover)
+        fingerprint = self.fingerprint(post)
+        entry = self.cache.get(key)
+        if entry is None or entry[0] != fingerprint:
+            html = render_template('_post.html', post=post,
+                                   delete_form=delete_form,
+                                   no_popover=no_popover)
+            if csrf:
+                html = html.replace(csrf, CSRF_PLACEHOLDER)
+            entry = (fingerprint, html)
+            self.cache.set(key, entry)
+        html = entry[1]
+        if csrf:
+            html = html.replace(CSRF_PLACEHOLDER, csrf)
+        return Markup(html)
+
+    def discard(self, post_ids):
+        """
+        Removes the fragments of posts
+        """
+        if self.cache is None:
+            return
+        for post_id in post_ids:
+            for owner in (False, True):
+                for no_popover in (False, True):
+                    self.cache.delete((post_id, owner, no_popover))
+
+    def stats(self):
+        """
+        Returns the size and hit/miss counters of the cache
+        """
+        if self.cache is None:
+            self.setup()
+        return self.cache.stats()
+
+    def after_flush(self, session, flush_context):
+        """
+        Drops the fragments of the deleted posts
+        """
+        self.discard([obj.id for obj in session.deleted
+                      if isinstance(obj, Post)])
+
+
+post_fragments = PostFragmentCache()
+app.add_template_global(post_fragments.render, 'render_post')
+db.event.listen(db.session, 'after_flush', post_fragments.after_flush)
+
+FRAGMENT_REQUESTS = metrics.counter('microblog_post_fragment_requests_total',
+                                    'Lookups of the rendered posts by result')
+FRAGMENT_ENTRIES = metrics.gauge('microblog_post_fragment_entries',
+                                 'Rendered posts in the cache')
+
+
+@metrics.collector
+def post_fragment_metrics():
+    """
+    Returns the counters of the rendered posts cache
+    """
+    stats = post_fragments.stats()
+    yield FRAGMENT_REQUESTS, stats['hits'], {'result': 'hit'}
+    yield FRAGMENT_REQUESTS, stats['misses'], {'result': 'miss'}
+    yield FRAGMENT_ENTRIES, stats['size'], {}
@@ -0,0 +1,346 @@
+"""
+Background indexing of the search outbox and bulk reindexing
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import json
+import multiprocessing
+import os
+import socket
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+from elasticsearch import Elasticsearch, ElasticsearchException
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from app import app, db
+from app.models import Post, search_outbox, lease
+from app.search import bulk_index, search_backend, search_cache
+
+SEARCHABLE_MODELS = {model.__tablename__: model for model in [Post]}
+
+
+class SearchIndexer:
+    """
+    Drains the search outbox through the Elasticsearch bulk API
+    Mutations of the same object are coalesced, failed ones are retried
+    with an exponential backoff
+    A single process drains the outbox at a time, holding a lease in the
+    database, so that the mutations reach the index in order
+    """
+
+    def __init__(self):
+        self.wakeup = Event()
+        self.lock = Lock()
+        self.thread = None
+        self.pid = None
+
+    @staticmethod
+    def queue_depth():
+        """
+        Returns the number of mutations waiting in the outbox
+        """
+        return db.session.query(db.func.count(search_outbox.c.id)).scalar()
+
+    @staticmethod
+    def backoff(attempts):
+        """
+        Returns the delay before the next attempt of a failed mutation
+        """
+        return timedelta(seconds=min(
+            app.config['SEARCH_INDEXER_BACKOFF'] * 2 ** attempts,
+            app.config['SEARCH_INDEXER_MAX_BACKOFF']))
+
+    def drain_once(self):
+        """
+        Sends one batch of due mutations
+        Returns the number of outbox rows processed
+        """
+        now = datetime.utcnow()
+        rows = db.session.execute(
+            search_outbox.select()
+            .where(search_outbox.c.next_attempt <= now)
+            .order_by(search_outbox.c.id)
+            .limit(app.config['SEARCH_INDEXER_BATCH_SIZE'])).fetchall()
+        if not rows:
+            return 0
+        # the last mutation of each object wins
+        mutations = OrderedDict()
+        for row in rows:
+            key = (row.index, row.object_id)
+            previous = mutations.pop(key, (None, []))[1]
+            mutations[key] = (row, previous + [row])
+        # so it does over its older mutations waiting for a retry
+        for row in db.session.execute(
+                search_outbox.select()
+                .where(search_outbox.c.next_attempt > now)
+                .where(search_outbox.c.id < rows[-1].id)
+                .where(search_outbox.c.object_id.in_(
+                    db.bindparam('ids', expanding=True))),
+                {'ids': list({row.object_id for row in rows})}):
+            latest, key_rows = mutations.get((row.index, row.object_id),
+                                             (None, None))
+            if latest is not None and row.id < latest.id:
+                key_rows.append(row)
+        operations = [(row.operation, row.index, row.object_id,
+                       json.loads(row.payload) if row.payload else None)
+                      for row, _ in mutations.values()]
+        try:
+            errors = bulk_index(operations)
+        except ElasticsearchException as error:
+            app.logger.warning(f'Search indexing failed: {error}')
+            errors = dict.fromkeys(range(len(operations)), str(error))
+        done, failed = [], []
+        for position, (row, key_rows) in enumerate(mutations.values()):
+            # only the last mutation of a failed object is retried
+            done.extend(key_row for key_row in key_rows
+                        if position not in errors or key_row is not row)
+            if position in errors:
+                failed.append(row)
+        if done:
+            db.session.execute(search_outbox.delete().where(
+                search_outbox.c.id.in_([row.id for row in done])))
+            # the results cached before the mutations reached the index
+            search_cache.invalidate()
+        for row in failed:
+            db.session.execute(
+                search_outbox.update()
+                .where(search_outbox.c.id == row.id)
+                .values(attempts=row.attempts + 1,
+                        next_attempt=now + self.backoff(row.attempts)))
+        db.session.commit()
+        return len(rows)
+
+    @staticmethod
+    def owner():
+        """
+        Returns the name of this thread in the lease
+        """
+        return f'{socket.gethostname()}:{os.getpid()}:{get_ident()}'
+
+    def acquire(self):
+        """
+        Takes or renews the lease of the indexer
+        Returns whether this thread holds it
+        """
+        now = datetime.utcnow()
+        values = {'owner': self.owner(), 'expires_at': now + timedelta(
+            seconds=app.config['SEARCH_INDEXER_LEASE'])}
+        acquired = db.session.execute(
+            lease.update()
+            .where(lease.c.name == 'search-indexer')
+            .where(db.or_(lease.c.owner == values['owner'],
+                          lease.c.expires_at < now))
+            .values(values)).rowcount
+        if not acquired:
+            try:
+                db.session.execute(lease.insert().values(
+                    name='search-indexer', **values))
+                acquired = 1
+            except IntegrityError:
+                # held by another process
+                db.session.rollback()
+        db.session.commit()
+        return bool(acquired)
+
+    def release(self):
+        """
+        Lets the other processes take the lease
+        """
+        db.session.rollback()
+        db.session.execute(lease.update()
+                           .where(lease.c.name == 'search-indexer')
+                           .where(lease.c.owner == self.owner())
+                           .values(expires_at=datetime.utcnow()))
+        db.session.commit()
+
+    def drain(self):
+        """
+        Sends all the due mutations, unless another process is draining
+        them, in the order they were made
+        Returns the number of outbox rows processed
+        """
+        processed = 0
+        try:
+            while self.acquire():
+                batch = self.drain_once()
+                if not batch:
+                    break
+                processed += batch
+        finally:
+            self.release()
+        return processed
+
+    def run(self):
+        """
+        Drains the outbox when notified, or periodically for the retries
+        """
+        while True:
+            self.wakeup.wait(app.config['SEARCH_INDEXER_INTERVAL'])
+            self.wakeup.clear()
+            with app.app_context():
+                try:
+                    self.drain()
+                except Exception:
+                    app.logger.exception('Search indexer error')
+                finally:
+                    db.session.remove()
+
+    def notify(self):
+        """
+        Wakes up the indexing thread, starting it in this process if needed
+        """
+        if not app.config['SEARCH_INDEXER_THREAD'] or \
+                search_backend().transactional or \
+                not search_backend().enabled:
+            return
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.wakeup = Event()
+                self.thread = Thread(target=self.run, daemon=True,
+                                     name='search-indexer')
+                self.thread.start()
+        self.wakeup.set()
+
+    def after_commit(self, session):
+        """
+        Notifies the indexer of the mutations of a commit
+        """
+        if session.info.pop('search_outbox', False):
+            self.notify()
+
+
+class Reindexer:
+    """
+    Rebuilds a search index from the database in primary key chunks
+    Chunks are spread over worker processes and checkpointed so that an
+    interrupted run resumes where it stopped
+    """
+
+    def __init__(self, index, chunk_size=10000, batch_size=500, workers=1,
+                 checkpoint=None):
+        self.model = SEARCHABLE_MODELS[index]
+        self.index = index
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint or os.path.join(
+            app.instance_path, f'reindex-{index}.json')
+
+    def chunks(self):
+        """
+        Returns the [start, end) id ranges of the table
+        """
+        low, high = db.session.query(db.func.min(self.model.id),
+                                     db.func.max(self.model.id)).one()
+        if low is None:
+            return []
+        # aligned on the chunk size so that resumed runs find the same chunks
+        first = low - low % self.chunk_size
+        return [(start, start + self.chunk_size)
+                for start in range(first, high + 1, self.chunk_size)]
+
+    def load_checkpoint(self):
+        """
+        Returns the chunks already indexed by a previous run
+        """
+        try:
+            with open(self.checkpoint) as checkpoint:
+                state = json.load(checkpoint)
+        except (OSError, ValueError):
+            return set()
+        if state.get('chunk_size') != self.chunk_size:
+            return set()
+        return {tuple(chunk) for chunk in state['done']}
+
+    def save_checkpoint(self, done):
+        """
+        Atomically records the indexed chunks
+        """
+        os.makedirs(os.path.dirname(self.checkpoint) or '.', exist_ok=True)
+        temporary = self.checkpoint + '.tmp'
+        with open(temporary, 'w') as checkpoint:
+            json.dump({'index': self.index, 'chunk_size': self.chunk_size,
+                       'done': sorted(done)}, checkpoint)
+        os.replace(temporary, self.checkpoint)
+
+    def run(self, restart=False, progress=None):
+        """
+        Indexes the chunks not done yet
+        Returns the number of documents sent, failed and the throughput
+        """
+        done = set() if restart else self.load_checkpoint()
+        todo = [chunk for chunk in self.chunks() if chunk not in done]
+        tasks = [(self.index, start, end, self.batch_size)
+                 for start, end in todo]
+        sent, failed, started = 0, 0, perf_counter()
+        workers = self.workers
+        if search_backend().transactional and \
+                db.engine.dialect.name == 'sqlite':
+            # SQLite has a single writer, the workers would lock each other
+            workers = 1
+        if workers > 1 and len(tasks) > 1:
+            # the forked workers must not share the parent connections
+            db.engine.dispose()
+            pool = multiprocessing.get_context('fork').Pool(
+                workers, initializer=init_reindex_worker)
+            results = pool.imap_unordered(reindex_chunk, tasks)
+        else:
+            pool = None
+            results = map(reindex_chunk, tasks)
+        try:
+            for start, end, chunk_sent, chunk_failed in results:
+                sent += chunk_sent
+                failed += chunk_failed
+                if not chunk_failed:
+                    done.add((start, end))
+                    self.save_checkpoint(done)
+                if progress:
+                    progress(sent, failed, perf_counter() - started)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        elapsed = perf_counter() - started
+        return sent, failed, sent / elapsed if elapsed else 0.0
+
+
+def init_reindex_worker():
+    """
+    Gives a reindexing worker process its own connections
+    """
+    db.engine.dispose()
+    if app.config['ELASTICSEARCH_URL']:
+        app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']])
+    app.app_context().push()
+
+
+def reindex_chunk(task):
+    """
+    Indexes the rows of one chunk
+    Returns the chunk with the number of documents sent and failed
+    """
+    index, start, end, batch_size = task
+    try:
+        sent, failed = SEARCHABLE_MODELS[index].reindex(start, end,
+                                                        batch_size)
+        db.session.commit()
+    except (ElasticsearchException, SQLAlchemyError) as error:
+        app.logger.warning(f'Reindexing of {index} [{start}, {end}) '
+                           f'failed: {error}')
+        sent, failed = 0, 1
+    finally:
+        db.session.remove()
+    return start, end, sent, failed
+
+
+indexer = SearchIndexer()
+
+db.event.listen(db.session, 'after_commit', indexer.after_commit)
+
+
+@app.before_first_request
+def start_indexer():
+    """
+    Drains the mutations left in the outbox by a previous process
+    """
+    indexer.notify()
@@ -0,0 +1,355 @@
+"""
+Metrics of the app in the Prometheus text format
+Each process records its own metrics and, when METRICS_DIR is set, writes
+them to a file of that directory so that /metrics adds up all the workers
+"""
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import os
+import re
+import tempfile
+from threading import Lock
+from time import monotonic, perf_counter
+from flask import g, has_request_context, request
+from sqlalchemy.engine import Engine
+from app import app, db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of a process by name and labels
+    Counters and histograms are added up over every process that wrote a
+    file, gauges only over the running ones
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.descriptions = {}
+        self.collectors = []
+        self.values = {}
+        self.pid = os.getpid()
+        self.written = 0.0
+
+    def describe(self, name, kind, description, buckets=None):
+        """
+        Declares a metric, returns its name
+        """
+        self.descriptions[name] = (kind, description,
+                                   tuple(buckets) if buckets else None)
+        return name
+
+    def counter(self, name, description):
+        """
+        Declares a counter, returns its name
+        """
+        return self.describe(name, 'counter', description)
+
+    def gauge(self, name, description):
+        """
+        Declares a gauge, returns its name
+        """
+        return self.describe(name, 'gauge', description)
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        """
+        Declares a histogram with its bucket bounds, returns its name
+        """
+        return self.describe(name, 'histogram', description, buckets)
+
+    def collector(self, function):
+        """
+        Registers a function returning (name, value, labels) tuples, read
+        each time the metrics are collected
+        """
+        self.collectors.append(function)
+        return function
+
+    def current(self):
+        """
+        Returns the values of this process, called with the lock
+        """
+        if self.pid != os.getpid():
+            # a forked worker starts from zero
+            self.pid = os.getpid()
+            self.values = {}
+            self.written = 0.0
+        return self.values
+
+    def samples(self, name):
+        """
+        Returns the samples of a metric by labels, called with the lock
+        """
+        return self.current().setdefault(name, {})
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Adds to a counter
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.samples(name)
+            samples[key] = samples.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value in a histogram
+        """
+        buckets = self.descriptions[name][2]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.samples(name)
+            sample = samples.get(key)
+            if sample is None:
+                # the count of each bucket, +Inf included, then the sum
+                sample = samples[key] = [0] * (len(buckets) + 1) + [0.0]
+            sample[bisect_left(buckets, value)] += 1
+            sample[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Records the duration of a block in a histogram
+        """
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started, **labels)
+
+    def clear(self):
+        """
+        Resets the values of this process
+        """
+        with self.lock:
+            self.values = {}
+
+    def snapshot(self):
+        """
+        Returns the values of this process, the collected ones included
+        """
+        with self.lock:
+            values = {name: {key: list(value) if isinstance(value, list)
+                             else value for key, value in samples.items()}
+                      for name, samples in self.current().items()}
+        for function in self.collectors:
+            try:
+                for name, value, labels in function():
+                    values.setdefault(name, {})[
+                        tuple(sorted(labels.items()))] = value
+            except Exception:
+                app.logger.exception('Metrics collector error')
+        return values
+
+    @staticmethod
+    def path(pid):
+        """
+        Returns the file of the values of a process
+        """
+        return os.path.join(app.config['METRICS_DIR'], f'metrics-{pid}.json')
+
+    def write(self):
+        """
+        Writes the values of this process to its file of METRICS_DIR
+        """
+        if not app.config['METRICS_DIR']:
+            return
+        values = {name: [[list(key), value] for key, value in samples.items()]
+                  for name, samples in self.snapshot().items()}
+        fd, temporary = tempfile.mkstemp(dir=app.config['METRICS_DIR'],
+                                         prefix='.metrics-')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(values, file)
+        # readers never see a partial file
+        os.replace(temporary, self.path(os.getpid()))
+        self.written = monotonic()
+
+    def write_due(self):
+        """
+        Writes the values if the last write is older than the interval
+        """
+        if app.config['METRICS_DIR'] and monotonic() - self.written >= \
+                app.config['METRICS_WRITE_INTERVAL']:
+            self.write()
+
+    @staticmethod
+    def running(pid):
+        """
+        Returns whether a process is still running
+        """
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def processes(self):
+        """
+        Returns the values and liveness of every process, this one from
+        memory and the others from their files
+        """
+        yield self.snapshot(), True
+        directory = app.config['METRICS_DIR']
+        if not directory:
+            return
+        for filename in os.listdir(directory):
+            match = re.fullmatch(r'metrics-(\d+)\.json', filename)
+            if not match or int(match.group(1)) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as file:
+                    values = json.load(file)
+            except (OSError, ValueError):
+                continue
+            yield ({name: {tuple(map(tuple, key)): value
+                           for key, value in samples}
+                    for name, samples in values.items()},
+                   self.running(int(match.group(1))))
+
+    def aggregate(self):
+        """
+        Returns the values of all the processes added up
+        """
+        totals = {}
+        for values, running in self.processes():
+            for name, samples in values.items():
+                if name not in self.descriptions or \
+                        (self.descriptions[name][0] == 'gauge' and
+                         not running):
+                    continue
+                total = totals.setdefault(name, {})
+                for key, value in samples.items():
+                    if isinstance(value, list):
+                        previous = total.get(key, [0] * len(value))
+                        total[key] = [a + b for a, b in zip(previous, value)]
+                    else:
+                        total[key] = total.get(key, 0) + value
+        return totals
+
+    @staticmethod
+    def labels(key):
+        """
+        Returns the labels of a sample in the text format
+        """
+        if not key:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in key) + '}'
+
+    def render(self):
+        """
+        Returns the metrics of all the processes in the text format
+        """
+        lines = []
+        for name, samples in sorted(self.aggregate().items()):
+            kind, description, buckets = self.descriptions[name]
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, value in sorted(samples.items()):
+                if kind != 'histogram':
+                    lines.append(f'{name}{self.labels(key)} {value}')
+                    continue
+                count = 0
+                for bound, bucket in zip(buckets + ('+Inf',), value):
+                    count += bucket
+                    le = bound if bound == '+Inf' else repr(float(bound))
+                    lines.append(f'{name}_bucket'
+                                 f'{self.labels(key + (("le", le),))} {count}')
+                lines.append(f'{name}_sum{self.labels(key)} {value[-1]}')
+                lines.append(f'{name}_count{self.labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+REQUESTS = metrics.counter('microblog_http_requests_total',
+                           'Requests by endpoint, method and status')
+REQUEST_DURATION = metrics.histogram('microblog_http_request_duration_seconds',
+                                     'Request latency by endpoint')
+REQUEST_SQL_STATEMENTS = metrics.histogram(
+    'microblog_http_request_sql_statements',
+    'SQL statements executed per request by endpoint', STATEMENT_BUCKETS)
+REQUEST_SQL_DURATION = metrics.histogram(
+    'microblog_http_request_sql_duration_seconds',
+    'Time spent in SQL statements per request by endpoint')
+
+
+@app.before_request
+def start_request_metrics():
+    """
+    Starts measuring the request
+    """
+    g.metrics_started = perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Records the latency and the SQL work of the request
+    """
+    if 'metrics_started' in g:
+        endpoint = request.endpoint or 'unmatched'
+        metrics.inc(REQUESTS, endpoint=endpoint, method=request.method,
+                    status=str(response.status_code))
+        metrics.observe(REQUEST_DURATION,
+                        perf_counter() - g.pop('metrics_started'),
+                        endpoint=endpoint)
+        metrics.observe(REQUEST_SQL_STATEMENTS, g.sql_statements,
+                        endpoint=endpoint)
+        metrics.observe(REQUEST_SQL_DURATION, g.sql_seconds,
+                        endpoint=endpoint)
+        metrics.write_due()
+    return response
+
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    """
+    Starts timing a statement of the request
+    """
+    if has_request_context():
+        conn.info.setdefault('metrics_started', []).append(perf_counter())
+
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    """
+    Counts a statement of the request and its duration
+    """
+    if has_request_context() and conn.info.get('metrics_started'):
+        g.sql_statements = g.get('sql_statements', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + \
+            perf_counter() - conn.info['metrics_started'].pop()
+
+
+@db.event.listens_for(Engine, 'handle_error')
+def forget_statement(context):
+    """
+    Drops the start of a failed statement, which is not recorded
+    """
+    if has_request_context() and context.connection is not None and \
+            context.connection.info.get('metrics_started'):
+        context.connection.info['metrics_started'].pop()
+
+
+@atexit.register
+def write_metrics():
+    """
+    Writes the last values of the process
+    """
+    try:
+        metrics.write()
+    except Exception:
+        app.logger.exception('Metrics write failed')
@@ -1,14 +1,24 @@
 """
 Database models
 """
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
 from datetime import datetime
+import json
 from time import time
-from werkzeug.security import generate_password_hash, check_password_hash
 from hashlib import md5
 import jwt
+from sqlalchemy import inspect
+from sqlalchemy.orm import validates, make_transient_to_detached, \
+    object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import ClauseElement
 from flask_login import UserMixin
 from app import app, db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.passwords import password_hasher
+from app.search import query_index, document, bulk_index, search_backend, \
+    register_index, search_cache, hydration_cache
 
 """
 Association table between followers and followed
@@ -16,10 +26,51 @@ Association table between followers and followed
 followers = db.Table('followers',
                      db.Column('follower_id',
                                db.Integer,
-                               db.ForeignKey('user.id')),
+                               db.ForeignKey('user.id'),
+                               primary_key=True),
                      db.Column('followed_id',
                                db.Integer,
-                               db.ForeignKey('user.id')))
+                               db.ForeignKey('user.id'),
+                               primary_key=True),
+                     db.PrimaryKeyConstraint('follower_id', 'followed_id',
+                                             name='pk_followers'),
+                     db.Index('ix_followers_followed_id_follower_id',
+                              'followed_id', 'follower_id'))
+
+"""
+Materialized home timelines: one row per post visible on a user's home page
+"""
+timeline = db.Table('timeline',
+                    db.Column('user_id',
+                              db.Integer,
+                              db.ForeignKey('user.id'),
+                              primary_key=True),
+                    db.Column('post_id',
+                              db.Integer,
+                              db.ForeignKey('post.id'),
+                              primary_key=True),
+                    db.Column('timestamp', db.DateTime),
+                    db.Index('ix_timeline_user_id_timestamp',
+                             'user_id', 'timestamp', 'post_id'))
+
+"""
+Search index mutations waiting to be sent to Elasticsearch
+"""
+search_outbox = db.Table('search_outbox',
+                         db.Column('id', db.Integer, primary_key=True),
+                         db.Column('index', db.String(64)),
+                         db.Column('object_id', db.Integer),
+                         db.Column('operation', db.String(8)),
+                         db.Column('payload', db.Text),
+                         db.Column('attempts', db.Integer, default=0),
+                         db.Column('next_attempt', db.DateTime, index=True,
+                                   default=datetime.utcnow))
+
+# jobs run by a single process at a time, held until they expire
+lease = db.Table('lease',
+                 db.Column('name', db.String(64), primary_key=True),
+                 db.Column('owner', db.String(128)),
+                 db.Column('expires_at', db.DateTime))
 
 
 class SearchableMixin:
@@ -27,57 +78,506 @@ class SearchableMixin:
     Mixin for searchable objects
     """
     @classmethod
-    def search(cls, expression, page, per_page):
+    def search(cls, expression, page, per_page, after=None):
         """
         Replaces the list of ids found by objects
+        Also returns the total and the position to continue the search after
+        this page
         """
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total, position = query_index(cls.__tablename__, expression,
+                                           page, per_page, after)
         if len(ids) == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
+            return [], 0, None
+        return cls.hydrate(ids), total, position
+
+    @classmethod
+    def hydrate(cls, ids):
+        """
+        Returns the objects of a list of ids in the same order, skipping the
+        missing ones
+        Recently loaded objects are rebuilt from the hydration cache, the
+        others are fetched in a single query
+        """
+        session = db.session()
+        mapper = inspect(cls)
+        objects, missing = {}, []
+        for object_id in ids:
+            key = mapper.identity_key_from_primary_key([object_id])
+            obj = session.identity_map.get(key)
+            if obj is not None and not inspect(obj).expired:
+                objects[object_id] = obj
+                continue
+            values = hydration_cache.get(cls.__tablename__, object_id)
+            if values is None:
+                missing.append(object_id)
+                continue
+            if obj is None:
+                obj = mapper.class_manager.new_instance()
+                for attribute, value in values.items():
+                    set_committed_value(obj, attribute, value)
+                make_transient_to_detached(obj)
+                session.add(obj)
+            else:
+                for attribute, value in values.items():
+                    set_committed_value(obj, attribute, value)
+            objects[object_id] = obj
+        if missing:
+            columns = [attribute.key for attribute in mapper.column_attrs]
+            for obj in cls.query.filter(cls.id.in_(missing)):
+                objects[obj.id] = obj
+                hydration_cache.set(
+                    cls.__tablename__, obj.id,
+                    {column: getattr(obj, column) for column in columns})
+        return [objects[object_id] for object_id in ids
+                if object_id in objects]
 
     @classmethod
-    def before_commit(cls, session):
+    def after_flush(cls, session, flush_context):
         """
-        Save changes before we commit to the database
+        Saves the changes of the flush and applies their search index
+        mutations to a database index, or queues them in the outbox for
+        Elasticsearch, in the same transaction
         """
-        session._changes = {
+        if getattr(session, '_changes', None) is None:
+            session._changes = {'add': [], 'update': [], 'delete': []}
+        changes = {
             'add': list(session.new),
-            'update': list(session.dirty),
+            'update': [obj for obj in session.dirty
+                       if session.is_modified(obj)],
             'delete': list(session.deleted)
         }
+        operations = []
+        for kind, objects in changes.items():
+            session._changes[kind].extend(objects)
+            for obj in objects:
+                if isinstance(obj, SearchableMixin):
+                    operations.append(
+                        ('delete', obj.__tablename__, obj.id, None)
+                        if kind == 'delete' else
+                        ('index', obj.__tablename__, obj.id, document(obj)))
+        cls.apply(session, operations)
+
+    @classmethod
+    def unindex(cls, ids):
+        """
+        Removes objects deleted without the ORM from the search index, in
+        the current transaction
+        """
+        cls.apply(db.session(), [('delete', cls.__tablename__, object_id, None)
+                                 for object_id in ids])
+
+    @staticmethod
+    def apply(session, operations):
+        """
+        Applies search index mutations to a database index, or queues them
+        in the outbox for Elasticsearch
+        """
+        backend = search_backend()
+        if not operations or not backend.enabled:
+            return
+        if backend.transactional:
+            bulk_index(operations)
+            return
+        now = datetime.utcnow()
+        session.execute(search_outbox.insert(), [
+            {'operation': operation, 'index': index, 'object_id': object_id,
+             'payload': json.dumps(payload) if payload else None,
+             'attempts': 0, 'next_attempt': now}
+            for operation, index, object_id, payload in operations])
+        session.info['search_outbox'] = True
 
     @classmethod
     def after_commit(cls, session):
         """
-        Pass the changes made by the commit to the search index
+        Invalidates the cached search results and objects once the changes
+        are committed, then forgets them
         """
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+        changes = getattr(session, '_changes', None) or {}
+        if any(isinstance(obj, SearchableMixin)
+               for objects in changes.values() for obj in objects):
+            search_cache.invalidate()
+        for obj in changes.get('update', []) + changes.get('delete', []):
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                hydration_cache.discard(obj.__tablename__, [obj.id])
+        session._changes = None
+
+    @classmethod
+    def after_rollback(cls, session):
+        """
+        Forgets the changes of a rolled back transaction
+        """
         session._changes = None
+        session.info.pop('search_outbox', None)
+
+    @classmethod
+    def documents(cls, start=None, end=None, batch_size=500):
+        """
+        Streams the (id, document) of the rows with start <= id < end
+        in batches, without loading ORM objects
+        """
+        query = db.session.query(
+            cls.id, *[getattr(cls, field) for field in cls.__searchable__])
+        if start is not None:
+            query = query.filter(cls.id >= start)
+        if end is not None:
+            query = query.filter(cls.id < end)
+        batch = []
+        for row in query.order_by(cls.id).yield_per(batch_size):
+            batch.append((row.id, {field: getattr(row, field)
+                                   for field in cls.__searchable__}))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
     @classmethod
-    def reindex(cls):
+    def reindex(cls, start=None, end=None, batch_size=500):
         """
         Refresh an index with all the data from the relational side
+        Returns the number of documents sent and the number of failures
+        """
+        sent, failed = 0, 0
+        for batch in cls.documents(start, end, batch_size):
+            errors = bulk_index([('index', cls.__tablename__, object_id,
+                                  payload) for object_id, payload in batch])
+            sent += len(batch)
+            failed += len(errors)
+        return sent, failed
+
+
+def increment(obj, attribute, delta):
+    """
+    Increments a counter column of an object
+    Persistent objects are incremented in SQL to avoid lost updates
+    """
+    value = obj.__dict__.get(attribute)
+    if isinstance(value, ClauseElement):
+        value = value + delta
+    elif inspect(obj).persistent:
+        value = getattr(type(obj), attribute) + delta
+    else:
+        value = (value or 0) + delta
+    setattr(obj, attribute, value)
+
+
+class FollowedIds:
+    """
+    Ids of the users followed by a user, kept in a set or, above a number of
+    ids, in a more compact sorted array of 64-bit integers
+    """
+
+    def __init__(self, ids, threshold):
+        ids = sorted(ids)
+        self.ids = array('q', ids) if len(ids) > threshold else set(ids)
+
+    def __contains__(self, user_id):
+        if isinstance(self.ids, set):
+            return user_id in self.ids
+        position = bisect_left(self.ids, user_id)
+        return position < len(self.ids) and self.ids[position] == user_id
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def add(self, user_id):
+        """
+        Adds an id if it is missing
+        """
+        if isinstance(self.ids, set):
+            self.ids.add(user_id)
+        elif user_id not in self:
+            insort(self.ids, user_id)
+
+    def discard(self, user_id):
+        """
+        Removes an id if it is present
+        """
+        if isinstance(self.ids, set):
+            self.ids.discard(user_id)
+        elif user_id in self:
+            del self.ids[bisect_left(self.ids, user_id)]
+
+
+class Counters:
+    """
+    Maintenance of the denormalized counters of the users
+    """
+    @staticmethod
+    def before_flush(session, flush_context, instances):
+        """
+        Updates the post and follow counters of the flushed changes
+        """
+        deleted_users = {obj for obj in session.deleted
+                         if isinstance(obj, User)}
+        for obj in session.new:
+            if isinstance(obj, Post):
+                author = obj.author or (obj.user_id and
+                                        User.query.get(obj.user_id))
+                if author:
+                    increment(author, 'posts_count', 1)
+        for obj in session.deleted:
+            if isinstance(obj, Post) and obj.author is not None \
+                    and obj.author not in deleted_users:
+                increment(obj.author, 'posts_count', -1)
+        # the follow rows of the deleted users are removed by the flush
+        for obj in deleted_users:
+            Counters.forget_follows(session, obj.id)
+
+    @staticmethod
+    def forget_follows(session, user_id):
+        """
+        Decrements the counters of the users following and followed by a
+        user about to be deleted
+        """
+        followed_ids = [followed_id for followed_id, in session.execute(
+            db.select([followers.c.followed_id])
+            .where(followers.c.follower_id == user_id))]
+        session.execute(User.__table__.update()
+                        .where(User.id.in_(
+                            db.select([followers.c.followed_id])
+                            .where(followers.c.follower_id == user_id)))
+                        .values(followers_count=User.followers_count - 1,
+                                updated_at=datetime.utcnow()))
+        if followed_ids:
+            Timeline.backfill(Timeline.no_longer_popular(
+                dict.fromkeys(followed_ids, 1)))
+        session.execute(User.__table__.update()
+                        .where(User.id.in_(
+                            db.select([followers.c.follower_id])
+                            .where(followers.c.followed_id == user_id)))
+                        .values(followed_count=User.followed_count - 1,
+                                updated_at=datetime.utcnow()))
+
+    @staticmethod
+    def check(user_ids, repair=False):
+        """
+        Compares the counters of the given users with the actual counts
+        Returns the drifted counters as (user id, column, stored, actual)
+        """
+        actual = {user_id: {'followers_count': 0, 'followed_count': 0,
+                            'posts_count': 0} for user_id in user_ids}
+        counts = [
+            ('followers_count', followers.c.followed_id,
+             db.func.count(followers.c.follower_id)),
+            ('followed_count', followers.c.follower_id,
+             db.func.count(followers.c.followed_id)),
+            ('posts_count', Post.user_id, db.func.count(Post.id)),
+        ]
+        for column, key, count in counts:
+            for user_id, value in db.session.query(key, count) \
+                    .filter(key.in_(user_ids)).group_by(key):
+                actual[user_id][column] = value
+        drifts = []
+        for user_id, followers_count, followed_count, posts_count in \
+                db.session.query(User.id, User.followers_count,
+                                 User.followed_count, User.posts_count) \
+                .filter(User.id.in_(user_ids)):
+            stored = {'followers_count': followers_count,
+                      'followed_count': followed_count,
+                      'posts_count': posts_count}
+            for column, value in stored.items():
+                if value != actual[user_id][column]:
+                    drifts.append((user_id, column, value,
+                                   actual[user_id][column]))
+        if repair and drifts:
+            for user_id, column, _, value in drifts:
+                db.session.execute(User.__table__.update()
+                                   .where(User.id == user_id)
+                                   .values({column: value}))
+        return drifts
+
+
+class Timeline:
+    """
+    Fan-out on write of the posts to the home timelines of the followers
+    Authors with more followers than TIMELINE_FANOUT_THRESHOLD are only
+    fanned out to themselves, their posts are merged when reading and
+    backfilled into the timelines once they fall back to the threshold
+    """
+    @staticmethod
+    def popular_authors(author_ids=None):
+        """
+        Returns the ids of the authors whose posts are fanned out on read
+        """
+        query = db.session.query(User.id).filter(
+            User.followers_count > app.config['TIMELINE_FANOUT_THRESHOLD'])
+        if author_ids is not None:
+            query = query.filter(User.id.in_(author_ids))
+        return {author_id for author_id, in query}
+
+    @staticmethod
+    def follow(follower, followed):
+        """
+        Schedules the fan-out of the posts of a newly followed user
+        """
+        db.session.info.setdefault('timeline', []).append(
+            ('follow', follower, followed))
+
+    @staticmethod
+    def unfollow(follower, followed):
+        """
+        Schedules the removal of the posts of an unfollowed user
         """
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        db.session.info.setdefault('timeline', []).append(
+            ('unfollow', follower, followed))
 
+    @staticmethod
+    def before_flush(session, flush_context, instances):
+        """
+        Removes the timeline rows referencing deleted posts and users
+        """
+        deleted_posts = [obj.id for obj in session.deleted
+                         if isinstance(obj, Post)]
+        deleted_users = [obj.id for obj in session.deleted
+                         if isinstance(obj, User)]
+        if deleted_posts:
+            session.execute(timeline.delete().where(
+                timeline.c.post_id.in_(deleted_posts)))
+        if deleted_users:
+            session.execute(timeline.delete().where(
+                timeline.c.user_id.in_(deleted_users)))
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """
+        Fans out the new posts in the same transaction as their creation
+        """
+        new_posts = [obj for obj in session.new if isinstance(obj, Post)]
+        if new_posts:
+            cls.fan_out([obj.id for obj in new_posts],
+                        list({obj.user_id for obj in new_posts}))
+        unfollowed = Counter()
+        for operation, follower, followed in \
+                session.info.pop('timeline', []):
+            if operation == 'follow':
+                cls.add_author(follower.id, followed.id)
+            else:
+                cls.remove_author(follower.id, followed.id)
+                unfollowed[followed.id] += 1
+        if unfollowed:
+            cls.backfill(cls.no_longer_popular(unfollowed))
+
+    @classmethod
+    def fan_out(cls, post_ids, author_ids):
+        """
+        Adds new posts to the timelines of their authors and followers
+        """
+        popular = cls.popular_authors(author_ids)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([Post.user_id, Post.id, Post.timestamp])
+            .where(Post.id.in_(post_ids))))
+        fanned_out = db.select([followers.c.follower_id, Post.id,
+                                Post.timestamp]).distinct() \
+            .select_from(Post.__table__.join(
+                followers, followers.c.followed_id == Post.user_id)) \
+            .where(Post.id.in_(post_ids)) \
+            .where(followers.c.follower_id != Post.user_id)
+        if popular:
+            fanned_out = fanned_out.where(
+                Post.user_id.notin_(list(popular)))
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], fanned_out))
+
+    @staticmethod
+    def no_longer_popular(removed):
+        """
+        Returns the authors whose followers, fewer by the given counts, are
+        no longer above the threshold
+        """
+        threshold = app.config['TIMELINE_FANOUT_THRESHOLD']
+        return [user_id for user_id, count in db.session.query(
+                    User.id, User.followers_count)
+                .filter(User.id.in_(list(removed)))
+                if count <= threshold < count + removed[user_id]]
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+    @staticmethod
+    def backfill(author_ids):
+        """
+        Adds the missing posts of authors fanned out on read until now to
+        the timelines of their followers
+        """
+        if not author_ids:
+            return
+        missing = db.select([followers.c.follower_id, Post.id,
+                             Post.timestamp]) \
+            .select_from(Post.__table__.join(
+                followers, followers.c.followed_id == Post.user_id)) \
+            .where(Post.user_id.in_(author_ids)) \
+            .where(followers.c.follower_id != Post.user_id) \
+            .where(~db.exists().where(db.and_(
+                timeline.c.user_id == followers.c.follower_id,
+                timeline.c.post_id == Post.id)))
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], missing))
+
+    @staticmethod
+    def add_author(user_id, author_id):
+        """
+        Adds all the posts of an author to the timeline of a user
+        """
+        existing = db.select([timeline.c.post_id]) \
+            .where(timeline.c.user_id == user_id)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([db.literal(user_id), Post.id, Post.timestamp])
+            .where(Post.user_id == author_id)
+            .where(Post.id.notin_(existing))))
+
+    @staticmethod
+    def remove_author(user_id, author_id):
+        """
+        Removes all the posts of an author from the timeline of a user
+        """
+        db.session.execute(timeline.delete()
+                           .where(timeline.c.user_id == user_id)
+                           .where(timeline.c.post_id.in_(
+                               db.select([Post.id])
+                               .where(Post.user_id == author_id))))
+
+    @classmethod
+    def rebuild(cls, user_ids):
+        """
+        Rebuilds the timelines of the given users from the followers table
+        """
+        db.session.execute(timeline.delete()
+                           .where(timeline.c.user_id.in_(user_ids)))
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([Post.user_id, Post.id, Post.timestamp])
+            .where(Post.user_id.in_(user_ids))))
+        fanned_out = db.select([followers.c.follower_id, Post.id,
+                                Post.timestamp]).distinct() \
+            .select_from(Post.__table__.join(
+                followers, followers.c.followed_id == Post.user_id)) \
+            .where(followers.c.follower_id.in_(user_ids)) \
+            .where(followers.c.follower_id != Post.user_id)
+        popular = cls.popular_authors()
+        if popular:
+            fanned_out = fanned_out.where(
+                Post.user_id.notin_(list(popular)))
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], fanned_out))
+
+    @staticmethod
+    def after_rollback(session):
+        """
+        Forgets the timeline changes of a rolled back transaction
+        """
+        session.info.pop('timeline', None)
+
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
+db.event.listen(db.session, 'before_flush', Counters.before_flush)
+db.event.listen(db.session, 'before_flush', Timeline.before_flush)
+db.event.listen(db.session, 'after_flush', Timeline.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+db.event.listen(db.session, 'after_rollback', Timeline.after_rollback)
 
 
 class User(UserMixin, db.Model):
@@ -87,10 +587,21 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    email_hash = db.Column(db.String(32))
     password_hash = db.Column(db.String(128))
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # bumped by every change of the user, its counters included
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # hidden from the request of the deletion of the account
+    deleted_at = db.Column(db.DateTime)
+    followers_count = db.Column(db.Integer, default=0, server_default='0',
+                                nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0',
+                               nullable=False)
+    posts_count = db.Column(db.Integer, default=0, server_default='0',
+                            nullable=False)
 
     followed = db.relationship(
         # 'what is followed' ('what follows' is defined by the parent class)
@@ -113,21 +624,40 @@ class User(UserMixin, db.Model):
         """
         Hashes the given password and adds it to the user
         """
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
         """
         Checks if the given password matches the database entry
+        Upgrades a matching hash to the current method and cost
+        """
+        if not password_hasher.verify(self.password_hash, password):
+            return False
+        if password_hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
+
+    @validates('email')
+    def validate_email(self, key, email):
+        """
+        Keeps the Gravatar hash of the email up to date
         """
-        return check_password_hash(self.password_hash, password)
+        self.email_hash = md5(email.lower().encode('utf-8')).hexdigest() \
+            if email else None
+        self.__dict__.pop('_avatars', None)
+        return email
 
     def avatar(self, size):
         """
         Returns the avatar of the user using Gravatar with a specific size
         """
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f"//www.gravatar.com/avatar/{digest}?s={size}"\
-            f"&d={app.config['AVATAR_STYLE']}"
+        avatars = self.__dict__.setdefault('_avatars', {})
+        if size not in avatars:
+            digest = self.email_hash or \
+                md5(self.email.lower().encode('utf-8')).hexdigest()
+            avatars[size] = f"//www.gravatar.com/avatar/{digest}?s={size}"\
+                f"&d={app.config['AVATAR_STYLE']}"
+        return avatars[size]
 
     def follow(self, user):
         """
@@ -135,6 +665,10 @@ class User(UserMixin, db.Model):
         """
         if not self.is_following(user):
             self.followed.append(user)
+            self.followed_ids().add(user.id)
+            increment(self, 'followed_count', 1)
+            increment(user, 'followers_count', 1)
+            Timeline.follow(self, user)
 
     def unfollow(self, user):
         """
@@ -142,13 +676,77 @@ class User(UserMixin, db.Model):
         """
         if self.is_following(user):
             self.followed.remove(user)
+            self.followed_ids().discard(user.id)
+            increment(self, 'followed_count', -1)
+            increment(user, 'followers_count', -1)
+            Timeline.unfollow(self, user)
+
+    def followed_ids(self):
+        """
+        Returns the ids of the followed users, loaded once until the user is
+        expired (at the end of the transaction)
+        """
+        ids = self.__dict__.get('_followed_ids')
+        if ids is None:
+            if self.id is None and object_session(self):
+                object_session(self).flush()
+            ids = FollowedIds(
+                [user_id for user_id, in db.session.query(
+                    followers.c.followed_id).filter(
+                        followers.c.follower_id == self.id)]
+                if self.id is not None else [],
+                app.config['FOLLOWED_IDS_ARRAY_THRESHOLD'])
+            self.__dict__['_followed_ids'] = ids
+        return ids
 
     def is_following(self, user):
         """
         Checks if the user is followed
         """
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        if user.id is None and object_session(user):
+            object_session(user).flush()
+        return user.id is not None and user.id in self.followed_ids()
+
+    @staticmethod
+    def touch(session, flush_context, instances):
+        """
+        Bumps the version of the changed users, which their new and deleted
+        posts change through the counters
+        """
+        now = datetime.utcnow()
+        for obj in session.dirty:
+            if isinstance(obj, User) and session.is_modified(obj):
+                obj.updated_at = now
+
+    def timeline_version(self):
+        """
+        Returns the last change of the user and of the followed users,
+        which covers every post of the home timeline
+        """
+        followed = db.select([followers.c.followed_id]).where(
+            followers.c.follower_id == self.id)
+        return db.session.query(db.func.max(User.updated_at)).filter(
+            db.or_(User.id == self.id, User.id.in_(followed))).scalar()
+
+    @staticmethod
+    def last_change():
+        """
+        Returns the last change of any user, which covers every post, or of
+        the deletion of an account
+        """
+        return db.session.query(
+            db.func.max(User.updated_at),
+            db.select([db.func.max(AccountDeletion.updated_at)])
+            .as_scalar()).one()
+
+    @staticmethod
+    def forget_followed_ids(user, attributes):
+        """
+        Drops the followed ids of an expired user
+        """
+        # None when the user was already garbage collected
+        if user is not None:
+            user.__dict__.pop('_followed_ids', None)
 
     def followed_posts(self):
         """
@@ -160,6 +758,31 @@ class User(UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def timeline(self):
+        """
+        Returns the posts of the materialized home timeline of the user,
+        merged with the posts of the followed authors fanned out on read,
+        and the (timestamp, id) columns to order them on: those of the
+        timeline index when there are no such authors
+        """
+        materialized = Post.query.join(
+            timeline, (timeline.c.post_id == Post.id)).filter(
+                timeline.c.user_id == self.id)
+        popular = Timeline.popular_authors(db.select(
+            [followers.c.followed_id]).where(
+                followers.c.follower_id == self.id))
+        if not popular:
+            return materialized, (timeline.c.timestamp, timeline.c.post_id)
+        on_read = Post.query.filter(Post.user_id.in_(list(popular)))
+        return materialized.union(on_read), (Post.timestamp, Post.id)
+
+    def timeline_posts(self):
+        """
+        Returns the posts of the home timeline of the user, newest first
+        """
+        query, key = self.timeline()
+        return query.order_by(*[column.desc() for column in key])
+
     def get_reset_password_token(self, expires_in=900):
         """
         Returns the password reset token for the user
@@ -187,6 +810,8 @@ class Post(SearchableMixin, db.Model):
     Post database model
     """
     __searchable__ = ['body']
+    __table_args__ = (db.Index('ix_post_user_id_timestamp',
+                               'user_id', 'timestamp', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -196,9 +821,54 @@ class Post(SearchableMixin, db.Model):
         return f'<Post {self.body}>'
 
 
+register_index(Post)
+
+
+class AccountDeletion(db.Model):
+    """
+    Deletion of an account, with its progress
+    The user row is kept, hidden, until all its posts are deleted
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, index=True)
+    username = db.Column(db.String(64))
+    # pending, running or done
+    status = db.Column(db.String(16), index=True, default='pending')
+    posts_total = db.Column(db.Integer, default=0)
+    posts_deleted = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # bumped by every batch, the pages without the deleted posts change
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<AccountDeletion {self.username} {self.status}>'
+
+
+def preload_authors(posts, avatar_size=128):
+    """
+    Loads the authors of a list of posts in a single query
+    and precomputes their avatars for rendering
+    """
+    posts = list(posts)
+    author_ids = {post.user_id for post in posts}
+    authors = {author.id: author for author in
+               User.query.filter(User.id.in_(author_ids))} \
+        if author_ids else {}
+    for post in posts:
+        set_committed_value(post, 'author', authors.get(post.user_id))
+    for author in authors.values():
+        author.avatar(avatar_size)
+    return posts
+
+
+db.event.listen(User, 'expire', User.forget_followed_ids)
+db.event.listen(db.session, 'before_flush', User.touch)
+
+
 @login.user_loader
 def load_user(user_id):
     """
     Loads the user corresponding to the given id
     """
-    return User.query.get(int(user_id))
+    user = User.query.get(int(user_id))
+    return user if user is not None and user.deleted_at is None else None
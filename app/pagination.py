@@ -0,0 +1,133 @@
+"""
+Pagination helpers
+"""
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+import json
+from flask import request, url_for
+from app import app, db
+
+
+class KeysetPage:
+    """
+    Page of a keyset (cursor) pagination, newest items first
+    """
+
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def encode_cursor(direction, item):
+    """
+    Returns an opaque cursor pointing before ('n') or after ('p') an item
+    """
+    raw = f'{direction}|{item.timestamp.isoformat()}|{item.id}'
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (direction, timestamp, id) contained in a cursor
+    Returns None if the cursor is invalid
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        raw = urlsafe_b64decode(cursor + padding).decode('utf-8')
+        direction, timestamp, item_id = raw.split('|')
+        if direction not in ('n', 'p'):
+            return None
+        return direction, datetime.fromisoformat(timestamp), int(item_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def encode_search_cursor(page, position):
+    """
+    Returns an opaque cursor continuing a search at a page, after the position
+    of the last result of the previous page
+    """
+    raw = json.dumps([page, position], separators=(',', ':'))
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_search_cursor(cursor):
+    """
+    Returns the (page, position) contained in a search cursor
+    Returns None if the cursor is invalid
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        page, position = json.loads(urlsafe_b64decode(cursor + padding))
+        if not isinstance(page, int) or page < 1 or \
+                not isinstance(position.get('sort'), list):
+            return None
+        return page, position
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def keyset_paginate(query, key, per_page, cursor=None):
+    """
+    Paginates a query on its (timestamp, id) key columns without OFFSET or
+    COUNT
+    The query can already be ordered, its ordering is replaced
+    """
+    query = query.order_by(None)
+    timestamp_column, id_column = key
+    key = decode_cursor(cursor) if cursor else None
+    newest_first = (timestamp_column.desc(), id_column.desc())
+    if key is None:
+        items = query.order_by(*newest_first).limit(per_page + 1).all()
+        has_next, has_prev = len(items) > per_page, False
+        items = items[:per_page]
+    elif key[0] == 'n':
+        _, timestamp, item_id = key
+        items = query.filter(db.or_(
+            timestamp_column < timestamp,
+            db.and_(timestamp_column == timestamp, id_column < item_id))) \
+            .order_by(*newest_first).limit(per_page + 1).all()
+        has_next, has_prev = len(items) > per_page, True
+        items = items[:per_page]
+    else:
+        _, timestamp, item_id = key
+        items = query.filter(db.or_(
+            timestamp_column > timestamp,
+            db.and_(timestamp_column == timestamp, id_column > item_id))) \
+            .order_by(timestamp_column.asc(), id_column.asc()) \
+            .limit(per_page + 1).all()
+        has_next, has_prev = True, len(items) > per_page
+        items = items[:per_page][::-1]
+    next_cursor = encode_cursor('n', items[-1]) \
+        if has_next and items else None
+    prev_cursor = encode_cursor('p', items[0]) \
+        if has_prev and items else None
+    return KeysetPage(items, next_cursor, prev_cursor)
+
+
+def paginate_posts(query, key, endpoint, **values):
+    """
+    Paginates a post query on its (timestamp, id) key columns for the given
+    endpoint
+    Uses cursors if enabled, unless an old `?page=N` link is followed
+    Returns the items of the page and the urls of the next and previous pages
+    """
+    per_page = app.config['POSTS_PER_PAGE']
+    if app.config['CURSOR_PAGINATION'] and 'page' not in request.args:
+        page = keyset_paginate(query, key, per_page,
+                               request.args.get('cursor'))
+        next_url = url_for(endpoint, cursor=page.next_cursor, **values) \
+            if page.next_cursor else None
+        prev_url = url_for(endpoint, cursor=page.prev_cursor, **values) \
+            if page.prev_cursor else None
+        return page.items, next_url, prev_url
+    page = request.args.get('page', 1, type=int)
+    posts = query.paginate(page, per_page, False)
+    next_url = url_for(endpoint, page=posts.next_num, **values) \
+        if posts.has_next else None
+    prev_url = url_for(endpoint,
+                       page=posts.prev_num if posts.prev_num > 1 else None,
+                       **values) \
+        if posts.has_prev else None
+    return posts.items, next_url, prev_url
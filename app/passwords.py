@@ -0,0 +1,99 @@
+"""
+Password hashing in a pool of worker processes
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+from threading import BoundedSemaphore, Lock
+from werkzeug.security import generate_password_hash, check_password_hash, \
+    DEFAULT_PBKDF2_ITERATIONS
+from app import app
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when too many passwords are already waiting to be hashed
+    """
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords in worker processes, so that the key
+    derivations of a burst of logins do not starve the web workers
+    At most PASSWORD_HASH_QUEUE operations wait or run at once per process
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.slots = None
+        self.pid = None
+        self.lock = Lock()
+
+    def executor(self):
+        """
+        Returns the pool of this process, starting it if needed
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                # spawned workers do not inherit the threads of the app
+                self.pool = ProcessPoolExecutor(
+                    app.config['PASSWORD_HASH_WORKERS'],
+                    mp_context=multiprocessing.get_context('spawn'))
+                self.slots = BoundedSemaphore(
+                    app.config['PASSWORD_HASH_QUEUE'])
+                self.pid = os.getpid()
+            return self.pool
+
+    def run(self, function, *args):
+        """
+        Runs a hashing function in the pool, or inline without workers
+        """
+        if not app.config['PASSWORD_HASH_WORKERS']:
+            return function(*args)
+        pool = self.executor()
+        if not self.slots.acquire(timeout=app.config['PASSWORD_HASH_TIMEOUT']):
+            raise PasswordHasherBusy()
+        try:
+            return pool.submit(function, *args).result()
+        except BrokenProcessPool:
+            # a worker died, the next operation starts a new pool
+            with self.lock:
+                if self.pool is pool:
+                    self.pid = None
+                    pool.shutdown(wait=False)
+            raise
+        finally:
+            self.slots.release()
+
+    @staticmethod
+    def method():
+        """
+        Returns the configured hash method with its cost,
+        e.g. pbkdf2:sha256:150000
+        """
+        method = app.config['PASSWORD_HASH_METHOD']
+        if method.startswith('pbkdf2:') and method.count(':') == 1:
+            method += f':{DEFAULT_PBKDF2_ITERATIONS}'
+        return method
+
+    def hash(self, password):
+        """
+        Returns the hash of a password with the configured method
+        """
+        return self.run(generate_password_hash, password, self.method())
+
+    def verify(self, password_hash, password):
+        """
+        Checks a password against a hash
+        """
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """
+        Checks if a hash was made with another method or cost
+        """
+        return password_hash.split('$', 1)[0] != self.method()
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,160 @@
+"""
+On-demand profiling of requests
+A request is profiled when it carries a token of `flask profile token` in
+its X-Profile header, when an admin adds ?profile to its url, or when it is
+part of the sampled fraction. Its pstats and its collapsed stacks (for
+flamegraph.pl or speedscope) are written to PROFILE_DIR
+"""
+from collections import Counter
+import cProfile
+from datetime import datetime
+import os
+import random
+import re
+import sys
+from threading import Event, Thread, get_ident
+from time import perf_counter, time
+from flask import g, request
+from flask_login import current_user
+import jwt
+from app import app
+
+
+def profile_token(expires_in=3600):
+    """
+    Returns a token enabling the profiling of the requests carrying it
+    By default expires after an hour
+    """
+    return jwt.encode({'profile': True, 'exp': time() + expires_in},
+                      app.config['SECRET_KEY'], algorithm='HS256').decode(
+                          'utf-8')
+
+
+def verify_profile_token(token):
+    """
+    Checks a profiling token
+    """
+    try:
+        return jwt.decode(token, app.config['SECRET_KEY'],
+                          algorithms=['HS256']).get('profile') is True
+    except jwt.InvalidTokenError:
+        return False
+
+
+class StackSampler(Thread):
+    """
+    Samples the stack of a thread at a fixed interval and counts the
+    collapsed stacks, root first
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True, name='profile-sampler')
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f'{code.co_name} '
+                              f'({os.path.basename(code.co_filename)}:'
+                              f'{code.co_firstlineno})')
+                frame = frame.f_back
+            if frames:
+                self.stacks[';'.join(reversed(frames))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def profiling_wanted():
+    """
+    Checks if the current request is to be profiled
+    """
+    token = request.headers.get('X-Profile')
+    if token:
+        return verify_profile_token(token)
+    if 'profile' in request.args:
+        return current_user.is_authenticated and \
+            current_user.email in app.config['ADMINS']
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+def start_profiling():
+    """
+    Starts the profiler and the stack sampler of a wanted request
+    """
+    if not app.config['PROFILE_DIR'] or not profiling_wanted():
+        return
+    g.profile_sampler = StackSampler(get_ident(),
+                                     app.config['PROFILE_SAMPLE_INTERVAL'])
+    g.profile_sampler.start()
+    g.profile_started = perf_counter()
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+def stop_profiling():
+    """
+    Stops the profiling of the request and writes its files
+    Returns their path without extension, or None if it was not profiled
+    """
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return None
+    profiler.disable()
+    duration = perf_counter() - g.pop('profile_started')
+    sampler = g.pop('profile_sampler')
+    sampler.stop()
+
+    endpoint = re.sub(r'[^\w.-]', '_', request.endpoint or 'unmatched')
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    path = os.path.join(app.config['PROFILE_DIR'],
+                        f'{datetime.utcnow():%Y%m%dT%H%M%S%f}-{endpoint}-'
+                        f'{duration * 1000:.0f}ms')
+    profiler.dump_stats(f'{path}.prof')
+    with open(f'{path}.folded', 'w') as folded:
+        for stack, count in sampler.stacks.most_common():
+            folded.write(f'{stack} {count}\n')
+    app.logger.info(f'Profile of {request.method} {request.path} written '
+                    f'to {path}.prof')
+    return path
+
+
+def add_profile_header(response):
+    """
+    Names the files of a profiled request in its response
+    """
+    path = stop_profiling()
+    if path is not None:
+        response.headers['X-Profile-File'] = os.path.basename(path)
+    return response
+
+
+def discard_profiling(error=None):
+    """
+    Stops the profiling of a request that ended with an unhandled error
+    """
+    if 'profiler' in g:
+        stop_profiling()
+
+
+def init_profiling():
+    """
+    Installs the request hooks, only when a directory is configured so
+    that the requests pay nothing otherwise
+    """
+    if start_profiling not in app.before_request_funcs.get(None, []):
+        app.before_request(start_profiling)
+        app.after_request(add_profile_header)
+        app.teardown_request(discard_profiling)
+
+
+if app.config['PROFILE_DIR']:
+    init_profiling()
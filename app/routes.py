@@ -2,15 +2,24 @@
 Routes for the app
 """
 
-from flask import render_template, flash, redirect, url_for, request, g
+import hmac
+from flask import render_template, flash, redirect, url_for, request, g, \
+    abort, Response
 from flask_login import current_user, login_user, logout_user, login_required
 from app import app, db
 from app.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm,\
     PostForm, ResetPasswordRequestForm, ResetPasswordForm, SearchForm
-from app.models import User, Post
+from app.models import User, Post, preload_authors
+from app.accounts import account_deleter
 from app.email import send_password_reset_email
+from app.activity import last_seen_buffer
+from app.metrics import metrics
+from app.conditional import not_modified
+from app.explore import paginate_explore
+from app.passwords import PasswordHasherBusy
+from app.pagination import paginate_posts, encode_search_cursor, \
+    decode_search_cursor
 from werkzeug.urls import url_parse
-from datetime import datetime
 
 
 def post(form):
@@ -31,23 +40,24 @@ def index():
     """
     post_form = PostForm()
     delete_form = EmptyForm()
-    page = request.args.get('page', 1, type=int)
     if post_form.validate_on_submit():
         post(post_form)
         return redirect(redirect_url())
-    posts = current_user.followed_posts().paginate(
-        page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('index',
-                       page=posts.prev_num if posts.prev_num > 1 else None) \
-        if posts.has_prev else None
+    cached = not_modified(current_user.timeline_version())
+    if cached is not None:
+        return cached
+    posts, next_url, prev_url = paginate_posts(
+        *current_user.timeline(), 'index')
+    # the new posts are added to the first page
+    stream_url = url_for('stream') \
+        if app.config['SSE_ENABLED'] and prev_url is None else None
     return render_template('index.html',
                            form=post_form,
-                           posts=posts.items,
+                           posts=preload_authors(posts),
                            next_url=next_url,
                            prev_url=prev_url,
-                           delete_form=delete_form)
+                           delete_form=delete_form,
+                           stream_url=stream_url)
 
 
 @app.route('/explore', methods=['GET', 'POST'])
@@ -58,21 +68,17 @@ def explore():
     """
     post_form = PostForm()
     delete_form = EmptyForm()
-    page = request.args.get('page', 1, type=int)
     if post_form.validate_on_submit():
         post(post_form)
         return redirect(redirect_url())
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('explore',
-                       page=posts.prev_num if posts.prev_num > 1 else None) \
-        if posts.has_prev else None
+    cached = not_modified(User.last_change())
+    if cached is not None:
+        return cached
+    posts, next_url, prev_url = paginate_explore()
     return render_template('index.html',
                            title='All posts',
                            form=post_form,
-                           posts=posts.items,
+                           posts=preload_authors(posts),
                            next_url=next_url,
                            prev_url=prev_url,
                            delete_form=delete_form)
@@ -88,20 +94,27 @@ def search():
     if not g.search_form.validate():
         return redirect(url_for('explore'))
     query = g.search_form.q.data
-    page = request.args.get('page', 1, type=int)
+    per_page = app.config['POSTS_PER_PAGE']
+    # deep pages continue after the last result instead of skipping offsets
+    cursor = decode_search_cursor(request.args['cursor']) \
+        if 'cursor' in request.args else None
+    page, after = cursor or (request.args.get('page', 1, type=int), None)
     if page <= 0:
         return redirect(url_for('index'))
-    posts, total = Post.search(query,
-                               page,
-                               app.config['POSTS_PER_PAGE'])
-    next_url = url_for('search', q=query, page=page + 1) \
-        if total > page * app.config['POSTS_PER_PAGE'] else None
+    posts, total, position = Post.search(query, page, per_page, after)
+    # Elasticsearch stops counting the results at 10,000
+    next_url = url_for('search', q=query,
+                       cursor=encode_search_cursor(page + 1, position)) \
+        if position and (total > page * per_page or
+                         total >= app.config['SEARCH_MAX_OFFSET']) else None
+    # previous pages are only reachable by offset when it is not too deep
     prev_url = url_for('search', q=query, page=page - 1) \
-        if page > 1 else None
+        if page > 1 and \
+        (page - 1) * per_page <= app.config['SEARCH_MAX_OFFSET'] else None
     return render_template('search.html',
                            title=query,
                            total=total,
-                           posts=posts,
+                           posts=preload_authors(posts),
                            next_url=next_url,
                            prev_url=prev_url,
                            delete_form=delete_form)
@@ -134,7 +147,8 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user_to_log = User.query.filter_by(username=form.username.data).first()
+        user_to_log = User.query.filter_by(username=form.username.data,
+                                           deleted_at=None).first()
 
         if (user_to_log is None or
                 not user_to_log.check_password(form.password.data)):
@@ -142,6 +156,8 @@ def login():
             return redirect(url_for('login'))
 
         login_user(user_to_log, remember=form.remember_me.data)
+        # saves the upgraded password hash
+        db.session.commit()
 
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
@@ -229,25 +245,24 @@ def user(username):
     post_form = PostForm()
     delete_form = EmptyForm()
     follow_form = EmptyForm()
-    profile_user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
+    profile_user = User.query.filter_by(username=username,
+                                        deleted_at=None).first_or_404()
     if post_form.validate_on_submit():
         post(post_form)
         return redirect(redirect_url())
-    posts = profile_user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('user',
-                       username=profile_user.username,
-                       page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('user',
-                       username=profile_user.username,
-                       page=posts.prev_num if posts.prev_num > 1 else None) \
-        if posts.has_prev else None
+    last_seen = last_seen_buffer.seen(profile_user)
+    cached = not_modified(profile_user.updated_at, last_seen)
+    if cached is not None:
+        return cached
+    posts, next_url, prev_url = paginate_posts(
+        profile_user.posts.order_by(Post.timestamp.desc()),
+        (Post.timestamp, Post.id), 'user',
+        username=profile_user.username)
     return render_template('user.html',
                            title=profile_user.username,
                            user=profile_user,
-                           posts=posts.items,
+                           last_seen=last_seen,
+                           posts=preload_authors(posts),
                            follow_form=follow_form,
                            delete_form=delete_form,
                            post_form=post_form,
@@ -286,11 +301,8 @@ def delete_account():
     """
     delete_form = EmptyForm()
     if delete_form.validate_on_submit():
-        user = User.query.filter_by(username=current_user.username).first()
-        for post in user.posts:
-            db.session.delete(post)
-        db.session.delete(user)
-        db.session.commit()
+        account_deleter.request(current_user._get_current_object())
+        logout_user()
         flash('Your account was deleted')
         return redirect(url_for('login'))
     return redirect(redirect_url())
@@ -302,19 +314,31 @@ def user_popup(username):
     """
     Profile page popup
     """
-    target_user = User.query.filter_by(username=username).first_or_404()
+    target_user = User.query.filter_by(username=username,
+                                       deleted_at=None).first_or_404()
+    cached = not_modified(target_user.updated_at)
+    if cached is not None:
+        return cached
     form = EmptyForm()
     return render_template('user_popup.html', user=target_user, form=form)
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """
+    Sheds the password checks of a burst of logins
+    """
+    flash('Too many requests right now, please try again', 'error')
+    return redirect(request.url)
+
+
 @app.before_request
 def before_request():
     """
     Logic happening before the request
     """
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen_buffer.touch(current_user.id)
         g.search_form = SearchForm()
 
 
@@ -326,7 +350,8 @@ def toggle_follow(username):
     """
     form = EmptyForm()
     if form.validate_on_submit():
-        target_user = User.query.filter_by(username=username).first()
+        target_user = User.query.filter_by(username=username,
+                                           deleted_at=None).first()
         if target_user is None:
             flash(f'User {username} not found', 'error')
             return redirect(url_for('index'))
@@ -347,6 +372,23 @@ def toggle_follow(username):
     return redirect(url_for('index'))
 
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Metrics of all the workers in the Prometheus text format
+    """
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                   f'Bearer {token}'):
+            abort(401)
+    elif request.remote_addr not in ('127.0.0.1', '::1') or \
+            'X-Forwarded-For' in request.headers:
+        # without a token, only scraped from the host itself
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     """
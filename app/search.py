@@ -1,40 +1,504 @@
 """
 Search functions
+The index is kept in Elasticsearch when it is configured, otherwise in the
+database itself (SQLite FTS5 or PostgreSQL tsvector)
 """
-from app import app
+from itertools import groupby
+import json
+import os
+from elasticsearch import NotFoundError
+from app import app, db
+from app.cache import LRUCache, Generation, SharedGeneration
+from app.metrics import metrics
 
+ELASTICSEARCH_DURATION = metrics.histogram(
+    'microblog_elasticsearch_request_duration_seconds',
+    'Elasticsearch calls by operation')
 
-def add_to_index(index, model):
+
+def document(model):
     """
-    Adds an object to the search index
+    Returns the document indexed for an object
     """
-    if not app.elasticsearch:
-        return
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    app.elasticsearch.index(index=index, id=model.id, body=payload)
+    return payload
+
+
+class SearchBackend:
+    """
+    Interface of the search backends, without any index
+    """
+    # mutations are applied in the transaction of the change instead of
+    # going through the search outbox
+    transactional = False
+    enabled = False
+
+    def create_index(self, connection, index, fields):
+        """
+        Creates the database structures of an index
+        """
+
+    def drop_index(self, connection, index):
+        """
+        Drops the database structures of an index
+        """
+
+    def bulk(self, operations):
+        """
+        Applies (operation, index, id, document) mutations
+        Returns the errors of the failed mutations by position
+        """
+        return {}
+
+    # ids per statement of the database backends, below the SQLite limit of
+    # bound parameters
+    delete_chunk_size = 500
+
+    def delete_runs(self, operations, table, column):
+        """
+        Yields the (index, mutations) runs of consecutive mutations other
+        than the deletions, which are applied with a statement per run
+        """
+        for (operation, index), run in groupby(
+                operations, key=lambda operation: operation[:2]):
+            if operation != 'delete':
+                yield index, list(run)
+                continue
+            ids = [object_id for _, _, object_id, _ in run]
+            for start in range(0, len(ids), self.delete_chunk_size):
+                db.session.execute(
+                    db.text(f'DELETE FROM {table.format(index)} '
+                            f'WHERE {column} IN :ids')
+                    .bindparams(db.bindparam('ids', expanding=True)),
+                    {'ids': ids[start:start + self.delete_chunk_size]})
+
+    def query(self, index, query, page, per_page, after=None):
+        """
+        Returns the ids of a page of results, the total number of results and
+        the position after the last result
+        The page is ignored when an `after` position is given, results are
+        then returned from that position on
+        """
+        return [], 0, None
+
+
+class ElasticsearchBackend(SearchBackend):
+    """
+    Search index stored in Elasticsearch
+    Mutations go through the search outbox and are sent in bulk requests,
+    deleting a missing object is not an error
+    """
+
+    @property
+    def enabled(self):
+        return app.elasticsearch is not None
+
+    def bulk(self, operations):
+        body = []
+        for operation, index, object_id, payload in operations:
+            body.append({operation: {'_index': index, '_id': object_id}})
+            if operation == 'index':
+                body.append(payload)
+        with metrics.timer(ELASTICSEARCH_DURATION, operation='bulk'):
+            response = app.elasticsearch.bulk(body=body)
+        errors = {}
+        if response['errors']:
+            for position, item in enumerate(response['items']):
+                result = next(iter(item.values()))
+                if result['status'] >= 300 and not \
+                        (result['status'] == 404 and 'delete' in item):
+                    errors[position] = result.get('error', result['status'])
+        return errors
+
+    # lifetime of a point in time between two pages
+    keep_alive = '1m'
+
+    def open_point_in_time(self, index):
+        """
+        Returns the id of a new point in time of an index
+        """
+        with metrics.timer(ELASTICSEARCH_DURATION,
+                           operation='open_point_in_time'):
+            return app.elasticsearch.transport.perform_request(
+                'POST', f'/{index}/_pit',
+                params={'keep_alive': self.keep_alive})['id']
+
+    def query(self, index, query, page, per_page, after=None):
+        body = {'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                'size': per_page,
+                'sort': [{'_score': 'desc'}, {'_id': 'asc'}]}
+        if after:
+            body['search_after'] = after['sort']
+        else:
+            body['from'] = (page - 1) * per_page
+        pit = None
+        if app.config['SEARCH_POINT_IN_TIME']:
+            # the pages of a search see the index as it was on the first one
+            body['sort'][-1] = {'_shard_doc': 'asc'}
+            pit = after.get('pit') if after else None
+            try:
+                body['pit'] = {'id': pit or self.open_point_in_time(index),
+                               'keep_alive': self.keep_alive}
+                with metrics.timer(ELASTICSEARCH_DURATION, operation='search'):
+                    search = app.elasticsearch.search(body=body)
+            except NotFoundError:
+                # expired, continue on the current state of the index
+                body['pit']['id'] = self.open_point_in_time(index)
+                with metrics.timer(ELASTICSEARCH_DURATION, operation='search'):
+                    search = app.elasticsearch.search(body=body)
+            pit = search.get('pit_id', body['pit']['id'])
+        else:
+            with metrics.timer(ELASTICSEARCH_DURATION, operation='search'):
+                search = app.elasticsearch.search(index=index, body=body)
+        hits = search['hits']['hits']
+        position = None
+        if hits:
+            position = {'sort': hits[-1]['sort']}
+            if pit:
+                position['pit'] = pit
+        return ([int(hit['_id']) for hit in hits],
+                search['hits']['total']['value'], position)
+
+
+class SQLiteBackend(SearchBackend):
+    """
+    Search index stored in an FTS5 virtual table `<index>_fts` whose rowids
+    are the ids of the objects, ranked with bm25
+    Mutations are applied in the transaction of the change
+    """
+    transactional = True
+    enabled = True
+
+    def create_index(self, connection, index, fields):
+        connection.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {index}_fts '
+                           f'USING fts5({", ".join(fields)})')
+
+    def drop_index(self, connection, index):
+        connection.execute(f'DROP TABLE IF EXISTS {index}_fts')
+
+    def bulk(self, operations):
+        for index, run in self.delete_runs(operations, '{}_fts', 'rowid'):
+            # executemany of the documents of a run, replaced if indexed
+            db.session.execute(f'DELETE FROM {index}_fts WHERE rowid = :id',
+                               [{'id': object_id}
+                                for _, _, object_id, _ in run])
+            fields = sorted(run[0][3])
+            db.session.execute(
+                f'INSERT INTO {index}_fts (rowid, {", ".join(fields)}) '
+                f'VALUES (:id, {", ".join(":" + f for f in fields)})',
+                [dict(payload, id=object_id)
+                 for _, _, object_id, payload in run])
+        return {}
+
+    @staticmethod
+    def match(query):
+        """
+        Returns an FTS5 query matching any of the words of a user query
+        """
+        return ' OR '.join('"' + word.replace('"', '""') + '"'
+                           for word in query.split())
+
+    def query(self, index, query, page, per_page, after=None):
+        match = self.match(query)
+        if not match:
+            return [], 0, None
+        parameters = {'match': match, 'limit': per_page,
+                      'offset': (page - 1) * per_page}
+        condition = ''
+        if after:
+            condition = 'WHERE score > :score OR ' \
+                '(score = :score AND rowid > :id)'
+            parameters.update(score=after['sort'][0], id=after['sort'][1],
+                              offset=0)
+        hits = db.session.execute(
+            f'SELECT rowid, score FROM (SELECT rowid, bm25({index}_fts) '
+            f'AS score FROM {index}_fts WHERE {index}_fts MATCH :match) '
+            f'{condition} ORDER BY score, rowid LIMIT :limit OFFSET :offset',
+            parameters).fetchall()
+        total = db.session.execute(
+            f'SELECT count(*) FROM {index}_fts WHERE {index}_fts MATCH :match',
+            {'match': match}).scalar()
+        return ([object_id for object_id, _ in hits], total,
+                {'sort': [hits[-1][1], hits[-1][0]]} if hits else None)
+
+
+class PostgresBackend(SearchBackend):
+    """
+    Search index stored as tsvector documents in a `<index>_search` table
+    with a GIN index, ranked with ts_rank
+    Mutations are applied in the transaction of the change
+    """
+    transactional = True
+    enabled = True
+
+    def create_index(self, connection, index, fields):
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {index}_search '
+                           f'(id INTEGER PRIMARY KEY, document TSVECTOR)')
+        connection.execute(f'CREATE INDEX IF NOT EXISTS ix_{index}_search '
+                           f'ON {index}_search USING GIN (document)')
+
+    def drop_index(self, connection, index):
+        connection.execute(f'DROP TABLE IF EXISTS {index}_search')
+
+    def bulk(self, operations):
+        for index, run in self.delete_runs(operations, '{}_search', 'id'):
+            db.session.execute(
+                f'INSERT INTO {index}_search (id, document) '
+                f"VALUES (:id, to_tsvector('english', :text)) "
+                f'ON CONFLICT (id) DO UPDATE '
+                f'SET document = excluded.document',
+                [{'id': object_id,
+                  'text': ' '.join(str(value) for value in payload.values()
+                                   if value is not None)}
+                 for _, _, object_id, payload in run])
+        return {}
+
+    # matches any of the words of the query
+    tsquery = "CAST(replace(CAST(plainto_tsquery('english', :query) " \
+        "AS TEXT), '&', '|') AS TSQUERY)"
+
+    def query(self, index, query, page, per_page, after=None):
+        parameters = {'query': query, 'limit': per_page,
+                      'offset': (page - 1) * per_page}
+        condition = ''
+        if after:
+            # compared as REAL like the ranks to find the exact same value
+            condition = 'WHERE score < CAST(:score AS REAL) OR ' \
+                '(score = CAST(:score AS REAL) AND id > :id)'
+            parameters.update(score=after['sort'][0], id=after['sort'][1],
+                              offset=0)
+        hits = db.session.execute(
+            f'SELECT id, score FROM (SELECT id, ts_rank(document, query) '
+            f'AS score FROM {index}_search, {self.tsquery} query '
+            f'WHERE document @@ query) hits {condition} '
+            f'ORDER BY score DESC, id LIMIT :limit OFFSET :offset',
+            parameters).fetchall()
+        total = db.session.execute(
+            f'SELECT count(*) FROM {index}_search '
+            f'WHERE document @@ {self.tsquery}',
+            {'query': query}).scalar()
+        return ([object_id for object_id, _ in hits], total,
+                {'sort': [hits[-1][1], hits[-1][0]]} if hits else None)
+
+
+BACKENDS = {
+    'elasticsearch': ElasticsearchBackend(),
+    'sqlite': SQLiteBackend(),
+    'postgresql': PostgresBackend(),
+    'none': SearchBackend(),
+}
+
+
+class SearchCache:
+    """
+    Cache of (normalized query, page) -> (ids, total, position) search
+    results
+    Entries are invalidated at once by bumping a generation counter when
+    searchable objects change, the counter can be shared between processes
+    """
+
+    def __init__(self):
+        self.cache = None
+        self.generation = None
+
+    def setup(self):
+        """
+        Creates the cache from the configuration
+        """
+        self.cache = LRUCache(app.config['SEARCH_CACHE_SIZE'],
+                              app.config['SEARCH_CACHE_TTL'])
+        path = app.config['SEARCH_CACHE_SHARED_PATH']
+        if path is None:
+            # shared by the workers of the instance unless disabled with ''
+            path = os.path.join(app.instance_path, 'search-generation')
+            os.makedirs(app.instance_path, exist_ok=True)
+        self.generation = SharedGeneration(path) if path else Generation()
+
+    def key(self, index, query, page, per_page, after=None):
+        """
+        Returns the cache key of a search
+        """
+        if self.cache is None:
+            self.setup()
+        return (self.generation.get(), index, ' '.join(query.lower().split()),
+                page, per_page, json.dumps(after, sort_keys=True))
+
+    def get(self, key):
+        """
+        Returns the cached (ids, total, position) of a search, or None
+        """
+        return self.cache.get(key)
+
+    def set(self, key, result):
+        """
+        Stores the (ids, total, position) of a search
+        """
+        self.cache.set(key, result)
+
+    def invalidate(self):
+        """
+        Invalidates all the cached results
+        """
+        if self.cache is None:
+            self.setup()
+        self.generation.bump()
+
+    def stats(self):
+        """
+        Returns the hit/miss counters of the cache
+        """
+        if self.cache is None:
+            self.setup()
+        return self.cache.stats()
+
+
+search_cache = SearchCache()
+
+
+class HydrationCache:
+    """
+    Cache of the column values of recently loaded searchable objects by
+    (index, id), to turn search hits back into objects without a query
+    """
+
+    def __init__(self):
+        self.cache = None
+
+    def setup(self):
+        """
+        Creates the cache from the configuration
+        """
+        self.cache = LRUCache(app.config['SEARCH_HYDRATION_CACHE_SIZE'],
+                              app.config['SEARCH_HYDRATION_CACHE_TTL'])
+
+    def get(self, index, object_id):
+        """
+        Returns the column values of an object, or None
+        """
+        if self.cache is None:
+            self.setup()
+        return self.cache.get((index, object_id))
+
+    def set(self, index, object_id, values):
+        """
+        Stores the column values of an object
+        """
+        if self.cache is None:
+            self.setup()
+        self.cache.set((index, object_id), values)
+
+    def discard(self, index, object_ids):
+        """
+        Removes objects from the cache
+        """
+        if self.cache is None:
+            self.setup()
+        for object_id in object_ids:
+            self.cache.delete((index, object_id))
+
+    def stats(self):
+        """
+        Returns the hit/miss counters of the cache
+        """
+        if self.cache is None:
+            self.setup()
+        return self.cache.stats()
+
+
+hydration_cache = HydrationCache()
+
+CACHE_REQUESTS = metrics.counter('microblog_search_cache_requests_total',
+                                 'Lookups of the search caches by result')
+CACHE_ENTRIES = metrics.gauge('microblog_search_cache_entries',
+                              'Entries of the search caches')
+
+
+@metrics.collector
+def search_cache_metrics():
+    """
+    Returns the counters of the search caches
+    """
+    for name, cache in (('results', search_cache),
+                        ('hydration', hydration_cache)):
+        stats = cache.stats()
+        yield CACHE_REQUESTS, stats['hits'], {'cache': name, 'result': 'hit'}
+        yield CACHE_REQUESTS, stats['misses'], {'cache': name,
+                                                'result': 'miss'}
+        yield CACHE_ENTRIES, stats['size'], {'cache': name}
+
+
+def search_backend(dialect=None):
+    """
+    Returns the configured search backend
+    By default Elasticsearch if it is configured, else the database
+    """
+    name = app.config['SEARCH_BACKEND'] or \
+        ('elasticsearch' if app.elasticsearch else 'database')
+    if name == 'database':
+        name = dialect or db.engine.dialect.name
+    return BACKENDS.get(name, BACKENDS['none'])
+
+
+def register_index(model):
+    """
+    Creates and drops the database search index of a model with its table
+    """
+    def create(target, connection, **kwargs):
+        search_backend(connection.dialect.name).create_index(
+            connection, model.__tablename__, model.__searchable__)
+
+    def drop(target, connection, **kwargs):
+        search_backend(connection.dialect.name).drop_index(
+            connection, model.__tablename__)
+
+    db.event.listen(model.__table__, 'after_create', create)
+    db.event.listen(model.__table__, 'before_drop', drop)
+
+
+def add_to_index(index, model):
+    """
+    Adds an object to the search index
+    """
+    bulk_index([('index', index, model.id, document(model))])
 
 
 def remove_from_index(index, model):
     """
     Removes an object from the search index
     """
-    if not app.elasticsearch:
-        return
-    app.elasticsearch.delete(index=index, id=model.id)
+    bulk_index([('delete', index, model.id, None)])
+
+
+def bulk_index(operations):
+    """
+    Applies (operation, index, id, document) mutations to the search index
+    Returns the errors of the failed mutations by position
+    """
+    backend = search_backend()
+    if not backend.enabled or not operations:
+        return {}
+    return backend.bulk(operations)
 
 
-def query_index(index, query, page, per_page):
+def query_index(index, query, page, per_page, after=None):
     """
-    Executes a search query
-    Returns the ids for this page and the total number of results (all pages)
+    Executes a search query, from a page number or after the position of the
+    last result of the previous page
+    Returns the ids for this page, the total number of results (all pages)
+    and the position of the last result
     """
-    if not app.elasticsearch:
-        return [], 0
-    search = app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    backend = search_backend()
+    if not backend.enabled:
+        return [], 0, None
+    key = search_cache.key(index, query, page, per_page, after)
+    result = search_cache.get(key)
+    if result is None:
+        ids, total, position = backend.query(index, query, page, per_page,
+                                             after)
+        result = (tuple(ids), total, position)
+        # points in time expire, their positions cannot be reused later
+        if not position or 'pit' not in position:
+            search_cache.set(key, result)
+    return list(result[0]), result[1], result[2]
@@ -0,0 +1,304 @@
+"""
+Server-sent events of the new posts of the followed users
+"""
+from collections import deque
+from datetime import datetime, timedelta
+import json
+import os
+from threading import Event, Lock, Thread
+from time import sleep
+from flask import Response, abort, request, stream_with_context
+from flask_login import current_user, login_required
+from app import app, db
+from app.explore import RecentPosts
+from app.forms import EmptyForm
+from app.fragments import post_fragments
+from app.metrics import metrics
+from app.models import Post, preload_authors
+
+
+class Subscription:
+    """
+    Connection of a user waiting for the posts of some authors
+    At most SSE_QUEUE_SIZE posts wait to be sent, a slower connection is
+    told to reload the page instead
+    """
+
+    def __init__(self, user_id, author_ids):
+        self.user_id = user_id
+        self.author_ids = frozenset(author_ids)
+        self.posts = deque()
+        self.overflowed = False
+        self.ready = Event()
+
+
+class PostBroker:
+    """
+    Publishes the committed posts to the subscriptions of this process
+    The posts committed by the other processes are polled from the database
+    by a relay thread, every SSE_RELAY_INTERVAL while there are subscriptions
+    The HTML of a post rendered for one of the followers is shared with the
+    others, only its author sees it with the delete form
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.subscriptions = {}
+        self.connections = 0
+        # posts already published, by id, for the relay
+        self.published = {}
+        self.rendered = {}
+        self.events = 0
+        self.overflows = 0
+        self.pid = None
+        self.thread = None
+
+    def setup(self):
+        """
+        Forgets the published posts
+        """
+        with self.lock:
+            self.published = {}
+            self.rendered = {}
+
+    def subscribe(self, user_id, author_ids):
+        """
+        Returns a new subscription to the posts of some authors
+        """
+        subscription = Subscription(user_id, author_ids)
+        with self.lock:
+            for author_id in subscription.author_ids:
+                self.subscriptions.setdefault(author_id, set()) \
+                    .add(subscription)
+            self.connections += 1
+        self.start_relay()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Ends a subscription
+        """
+        with self.lock:
+            for author_id in subscription.author_ids:
+                subscriptions = self.subscriptions.get(author_id)
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[author_id]
+            self.connections -= 1
+
+    def publish(self, entries):
+        """
+        Pushes (timestamp, id, author id, body) posts to the subscriptions
+        of their authors, once
+        """
+        size = app.config['SSE_QUEUE_SIZE']
+        since = datetime.utcnow() - \
+            timedelta(seconds=app.config['SSE_RELAY_WINDOW'])
+        with self.lock:
+            # the posts left the window of the relay, oldest first
+            while self.published and \
+                    next(iter(self.published.values())) <= since:
+                post_id = next(iter(self.published))
+                del self.published[post_id]
+                self.rendered.pop(post_id, None)
+            for entry in entries:
+                if entry[1] in self.published:
+                    continue
+                self.published[entry[1]] = entry[0]
+                for subscription in self.subscriptions.get(entry[2], ()):
+                    if len(subscription.posts) >= size:
+                        subscription.posts.clear()
+                        if not subscription.overflowed:
+                            self.overflows += 1
+                        subscription.overflowed = True
+                    elif not subscription.overflowed:
+                        subscription.posts.append(entry)
+                    subscription.ready.set()
+
+    def wait(self, subscription, timeout):
+        """
+        Returns the posts of a subscription, waiting for them up to a
+        timeout, and whether some were dropped
+        """
+        subscription.ready.wait(timeout)
+        with self.lock:
+            subscription.ready.clear()
+            entries = list(subscription.posts)
+            subscription.posts.clear()
+            self.events += len(entries)
+            return entries, subscription.overflowed
+
+    def share(self, post_id, html):
+        """
+        Keeps the HTML of a published post for the other followers
+        """
+        with self.lock:
+            if post_id in self.published:
+                self.rendered[post_id] = html
+
+    def poll(self, prime=False):
+        """
+        Publishes the recent posts committed by the other processes
+        The first poll only records them, they are older than the pages
+        """
+        since = datetime.utcnow() - \
+            timedelta(seconds=app.config['SSE_RELAY_WINDOW'])
+        rows = db.session.query(Post.timestamp, Post.id, Post.user_id,
+                                Post.body) \
+            .filter(Post.timestamp > since) \
+            .order_by(Post.timestamp, Post.id).all()
+        if prime:
+            with self.lock:
+                self.published.update((row[1], row[0]) for row in rows)
+            return
+        self.publish([tuple(row) for row in rows])
+
+    def relay(self):
+        """
+        Polls the database while there are subscriptions
+        """
+        prime = True
+        while True:
+            sleep(app.config['SSE_RELAY_INTERVAL'])
+            if not self.connections:
+                prime = True
+                continue
+            with app.app_context():
+                try:
+                    self.poll(prime)
+                    prime = False
+                except Exception:
+                    app.logger.exception('Post relay error')
+                finally:
+                    db.session.remove()
+
+    def start_relay(self):
+        """
+        Starts the relay thread of this process if needed
+        """
+        if not app.config['SSE_RELAY_INTERVAL']:
+            return
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = Thread(target=self.relay, daemon=True,
+                                     name='post-relay')
+                self.thread.start()
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """
+        Saves the posts created by the flush
+        """
+        session.info.setdefault('stream', []).extend(
+            (obj.timestamp, obj.id, obj.user_id, obj.body)
+            for obj in session.new if isinstance(obj, Post))
+
+    def after_commit(self, session):
+        """
+        Publishes the committed posts
+        """
+        entries = session.info.pop('stream', None)
+        if entries:
+            self.publish(entries)
+
+    @staticmethod
+    def after_rollback(session):
+        """
+        Forgets the posts of a rolled back transaction
+        """
+        session.info.pop('stream', None)
+
+
+broker = PostBroker()
+db.event.listen(db.session, 'after_flush', broker.after_flush)
+db.event.listen(db.session, 'after_commit', broker.after_commit)
+db.event.listen(db.session, 'after_rollback', broker.after_rollback)
+
+
+def event(name, data, event_id=None):
+    """
+    Returns a server-sent event
+    """
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {name}',
+              f'data: {json.dumps(data, separators=(",", ":"))}']
+    return '\n'.join(lines) + '\n\n'
+
+
+@app.route('/stream')
+@login_required
+def stream():
+    """
+    Server-sent events of the new posts of the followed users, with their
+    HTML unless ?html=0
+    """
+    if not app.config['SSE_ENABLED']:
+        abort(404)
+    html = request.args.get('html') != '0'
+    user_id = current_user.id
+    author_ids = set(current_user.followed_ids()) | {user_id}
+    # the database connection is not held by the idle connections, which
+    # must not load the expired current user again
+    db.session.commit()
+
+    def events():
+        subscription = broker.subscribe(user_id, author_ids)
+        try:
+            yield f'retry: {app.config["SSE_HEARTBEAT"] * 1000}\n\n'
+            while True:
+                entries, overflowed = broker.wait(
+                    subscription, app.config['SSE_HEARTBEAT'])
+                if overflowed:
+                    yield event('reload', {})
+                    return
+                if not entries:
+                    # detects the closed connections
+                    yield ': keepalive\n\n'
+                    continue
+                fragments = {}
+                if html:
+                    fragments = {entry[1]: broker.rendered.get(entry[1])
+                                 for entry in entries
+                                 if entry[2] != subscription.user_id}
+                    missing = [entry for entry in entries
+                               if fragments.get(entry[1]) is None]
+                    if missing:
+                        delete_form = EmptyForm()
+                        for post in preload_authors(
+                                RecentPosts.posts(missing)):
+                            fragments[post.id] = str(post_fragments.render(
+                                post, delete_form))
+                            if post.user_id != subscription.user_id:
+                                broker.share(post.id, fragments[post.id])
+                        db.session.commit()
+                for _, post_id, author_id, _ in entries:
+                    data = {'id': post_id, 'user_id': author_id}
+                    if html:
+                        data['html'] = fragments.get(post_id)
+                    yield event('post', data, post_id)
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+SSE_CONNECTIONS = metrics.gauge('microblog_sse_connections',
+                                'Open server-sent events connections')
+SSE_EVENTS = metrics.counter('microblog_sse_events_total',
+                             'Posts sent through server-sent events')
+SSE_OVERFLOWS = metrics.counter('microblog_sse_overflows_total',
+                                'Connections told to reload, too slow')
+
+
+@metrics.collector
+def stream_metrics():
+    """
+    Returns the counters of the server-sent events
+    """
+    yield SSE_CONNECTIONS, broker.connections, {}
+    yield SSE_EVENTS, broker.events, {}
+    yield SSE_OVERFLOWS, broker.overflows, {}
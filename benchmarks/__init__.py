@@ -0,0 +1,4 @@
+"""
+Benchmarks of the app
+Run them as modules, e.g. `python -m benchmarks.search`
+"""
@@ -0,0 +1,99 @@
+"""
+Server time and payload size of the JSON API against the HTML pages
+Requests the same pages of posts from both, through the test client with
+CSRF protection on, as a logged in user following some of the authors
+
+Usage: python -m benchmarks.api [--posts N] [--repeat N]
+"""
+import argparse
+import os
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+from app import app, db
+from app.activity import last_seen_buffer
+from app.models import User, Post
+from benchmarks.search import percentile
+
+PAGES = [
+    ('home', '/', '/api/v1/timeline'),
+    ('explore', '/explore', '/api/v1/explore'),
+    ('profile', '/user/user1', '/api/v1/users/user1/posts'),
+    ('search', '/search?q=number', '/api/v1/search?q=number'),
+    ('sparse explore', '/explore', '/api/v1/explore?fields=id,body'),
+]
+
+
+def populate(posts, authors=10):
+    """
+    Creates authors with posts spread between them, the first one following
+    half of the others
+    """
+    db.create_all()
+    users = [User(username=f'user{i}', email=f'user{i}@example.com')
+             for i in range(authors)]
+    users[0].set_password('cat')
+    db.session.add_all(users)
+    for user in users[1:authors // 2 + 1]:
+        users[0].follow(user)
+    now = datetime.utcnow()
+    db.session.add_all([Post(body=f'post number {i} ' * 5,
+                             author=users[i % authors],
+                             timestamp=now - timedelta(seconds=i))
+                        for i in range(posts)])
+    db.session.commit()
+
+
+def measure(client, url, repeat):
+    """
+    Returns the latencies of a page in ms and its size in bytes
+    """
+    latencies = []
+    for _ in range(repeat + 1):
+        started = perf_counter()
+        response = client.get(url)
+        latencies.append((perf_counter() - started) * 1000)
+        assert response.status_code == 200, url
+    # the first one warms up the caches
+    return latencies[1:], len(response.data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        path = os.path.join(tempfile.mkdtemp(), 'api.db')
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['SEARCH_INDEXER_THREAD'] = False
+    app.config['CONDITIONAL_GET'] = False
+    app.elasticsearch = None
+
+    results = []
+    with app.app_context():
+        populate(args.posts)
+        client = app.test_client()
+        app.config['WTF_CSRF_ENABLED'] = False
+        client.post('/login', data={'username': 'user0', 'password': 'cat'})
+        app.config['WTF_CSRF_ENABLED'] = True
+        for name, html_url, api_url in PAGES:
+            html, html_size = measure(client, html_url, args.repeat)
+            api, api_size = measure(client, api_url, args.repeat)
+            results.append((name, html, html_size, api, api_size))
+        last_seen_buffer.clear()
+        db.drop_all()
+
+    print(f'{args.posts} posts, {app.config["POSTS_PER_PAGE"]} per page, '
+          f'{args.repeat} requests')
+    print(f'{"":>16} {"HTML p50":>10} {"JSON p50":>10} '
+          f'{"HTML size":>10} {"JSON size":>10}')
+    for name, html, html_size, api, api_size in results:
+        print(f'{name:>16} {percentile(html, 0.5):7.2f} ms '
+              f'{percentile(api, 0.5):7.2f} ms {html_size:8d} B '
+              f'{api_size:8d} B  ({api_size / html_size:.0%} of the bytes)')
+
+
+if __name__ == '__main__':
+    main()
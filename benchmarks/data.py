@@ -0,0 +1,154 @@
+"""
+Synthetic social graph generator
+Follows and posts follow power laws: a few accounts have most of the
+followers and a few users write most of the posts. The same seed always
+generates the same data
+
+Usage: python -m benchmarks.data [--users N] [--posts N] [--seed N]
+(fills the database of DATABASE_URL)
+"""
+import argparse
+from hashlib import md5
+from itertools import accumulate
+import random
+from datetime import datetime, timedelta
+from time import perf_counter
+from app import app, db
+from app.models import User, Post, Timeline, followers
+from app.passwords import password_hasher
+from benchmarks.search import vocabulary
+
+PASSWORD = 'password'
+
+
+def power_law(rng, count, exponent):
+    """
+    Returns the cumulative weights of `count` items ranked by a Zipf law,
+    the ranks being shuffled so that the heaviest items are spread out
+    """
+    weights = [1 / rank ** exponent for rank in range(1, count + 1)]
+    rng.shuffle(weights)
+    return list(accumulate(weights))
+
+
+def batches(rows, batch_size):
+    """
+    Groups an iterable of rows in lists
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(users, posts, seed=42, follows=20, exponent=1.1,
+             batch_size=10000, timelines=True, search=True, progress=None):
+    """
+    Fills an empty database with users, follows and posts in bulk, then
+    computes the counters, the home timelines and the search index
+    Returns the number of rows of each table
+    """
+    progress = progress or (lambda message: None)
+    rng = random.Random(seed)
+    started = perf_counter()
+    db.create_all()
+
+    password_hash = password_hasher.hash(PASSWORD)
+    now = datetime.utcnow()
+    for batch in batches(({'id': i, 'username': f'user{i}',
+                           'email': f'user{i}@example.com',
+                           'email_hash': md5(f'user{i}@example.com'.encode(
+                               'utf-8')).hexdigest(),
+                           'password_hash': password_hash,
+                           'last_seen': now - timedelta(minutes=i)}
+                          for i in range(1, users + 1)), batch_size):
+        db.session.execute(User.__table__.insert(), batch)
+    progress(f'{users} users')
+
+    # each user follows a Pareto distributed number of accounts, picked
+    # by popularity
+    popularity = power_law(rng, users, exponent)
+    user_ids = range(1, users + 1)
+
+    def follow_rows():
+        for follower_id in user_ids:
+            degree = min(users - 1, int(rng.paretovariate(1.5) * follows / 3))
+            followed_ids = set(rng.choices(user_ids, cum_weights=popularity,
+                                           k=degree))
+            for followed_id in followed_ids:
+                if followed_id != follower_id:
+                    yield {'follower_id': follower_id,
+                           'followed_id': followed_id}
+
+    follow_count = 0
+    for batch in batches(follow_rows(), batch_size):
+        db.session.execute(followers.insert(), batch)
+        follow_count += len(batch)
+    progress(f'{follow_count} follows')
+
+    # posts spread over a year, written by authors picked by activity
+    activity = power_law(rng, users, exponent)
+    words = vocabulary(rng)
+    start = now - timedelta(days=365)
+    step = timedelta(days=365) / max(posts, 1)
+
+    def post_rows():
+        for i in range(posts):
+            yield {'id': i + 1,
+                   'body': ' '.join(rng.choice(words)
+                                    for _ in range(rng.randint(3, 20))),
+                   'timestamp': start + step * i,
+                   'user_id': rng.choices(user_ids, cum_weights=activity)[0]}
+
+    for batch in batches(post_rows(), batch_size):
+        db.session.execute(Post.__table__.insert(), batch)
+        db.session.commit()
+    progress(f'{posts} posts')
+
+    user = User.__table__
+    db.session.execute(user.update().values(
+        followers_count=db.select([db.func.count()]).where(
+            followers.c.followed_id == user.c.id).as_scalar(),
+        followed_count=db.select([db.func.count()]).where(
+            followers.c.follower_id == user.c.id).as_scalar(),
+        posts_count=db.select([db.func.count()]).where(
+            Post.user_id == user.c.id).as_scalar()))
+    db.session.commit()
+
+    if timelines:
+        for first in range(1, users + 1, 1000):
+            Timeline.rebuild(list(range(first, min(users + 1, first + 1000))))
+            db.session.commit()
+        progress('timelines rebuilt')
+    if search:
+        Post.reindex(batch_size=batch_size)
+        db.session.commit()
+        progress('search index built')
+    progress(f'generated in {perf_counter() - started:.1f} s')
+    return {'users': users, 'follows': follow_count, 'posts': posts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='average number of followed accounts')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-timelines', action='store_true')
+    parser.add_argument('--no-search', action='store_true')
+    args = parser.parse_args()
+
+    app.config['SEARCH_INDEXER_THREAD'] = False
+    with app.app_context():
+        generate(args.users, args.posts, args.seed, args.follows,
+                 timelines=not args.no_timelines, search=not args.no_search,
+                 progress=print)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Template rendering time of a 50 post page with and without the cache of
+the rendered posts
+Renders the explore page of a viewer who wrote some of the posts, so that
+both viewer classes (author or not) are measured
+
+Usage: python -m benchmarks.fragments [--posts N] [--repeat N]
+"""
+import argparse
+import os
+import tempfile
+from time import perf_counter
+from flask import render_template
+from flask_login import login_user
+from app import app, db
+from app.forms import EmptyForm, PostForm
+from app.fragments import post_fragments
+from app.models import User, Post, preload_authors
+from benchmarks.search import percentile
+
+
+def populate(posts, authors=10):
+    """
+    Creates authors with posts spread between them
+    """
+    db.create_all()
+    users = [User(username=f'user{i}', email=f'user{i}@example.com')
+             for i in range(authors)]
+    db.session.add_all(users)
+    db.session.add_all([Post(body=f'post number {i} ' * 5,
+                             author=users[i % authors])
+                        for i in range(posts)])
+    db.session.commit()
+
+
+def measure(posts, repeat):
+    """
+    Returns the latencies of the page rendering in ms
+    """
+    latencies = []
+    with app.test_request_context('/explore'):
+        login_user(User.query.filter_by(username='user0').one())
+        page = preload_authors(Post.query.order_by(Post.timestamp.desc())
+                               .limit(posts).all())
+        post_form, delete_form = PostForm(), EmptyForm()
+        for _ in range(repeat + 1):
+            started = perf_counter()
+            render_template('index.html', title='All posts', form=post_form,
+                            posts=page, next_url=None, prev_url=None,
+                            delete_form=delete_form)
+            latencies.append((perf_counter() - started) * 1000)
+    # the first one fills the cache
+    return latencies[1:]
+
+
+def report(name, latencies):
+    print(f'{name:>20}: p50 {percentile(latencies, 0.5):7.2f} ms, '
+          f'p99 {percentile(latencies, 0.99):7.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--posts', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        path = os.path.join(tempfile.mkdtemp(), 'fragments.db')
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['SEARCH_INDEXER_THREAD'] = False
+
+    with app.app_context():
+        populate(args.posts)
+        app.config['POST_FRAGMENT_CACHE_SIZE'] = 0
+        post_fragments.setup()
+        uncached = measure(args.posts, args.repeat)
+        app.config['POST_FRAGMENT_CACHE_SIZE'] = 10000
+        post_fragments.setup()
+        cached = measure(args.posts, args.repeat)
+        stats = post_fragments.stats()
+        db.drop_all()
+
+    print(f'{args.posts} posts per page, {args.repeat} renders')
+    report('without cache', uncached)
+    report('with cache', cached)
+    saved = percentile(uncached, 0.5) - percentile(cached, 0.5)
+    print(f'{"saved":>20}: {saved:7.2f} ms per page '
+          f'({saved / percentile(uncached, 0.5):.0%}), '
+          f'hit rate {stats["hit_rate"]:.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Login latency and its impact on concurrent timeline requests
+Compares password hashing inline in the request threads with the process
+pool, both run for a baseline without logins then during a login storm
+
+Usage: python -m benchmarks.login [--users N] [--threads N] [--seconds S]
+"""
+import argparse
+import os
+import tempfile
+from threading import Thread
+from time import perf_counter
+from app import app, db
+from app.activity import last_seen_buffer
+from app.models import User, Post
+from app.passwords import password_hasher
+from benchmarks.search import percentile
+
+
+def populate(users, posts):
+    """
+    Creates users following each other with a few posts each
+    """
+    db.create_all()
+    password_hash = password_hasher.hash('password')
+    accounts = [User(username=f'user{i}', email=f'user{i}@example.com',
+                     password_hash=password_hash) for i in range(users)]
+    db.session.add_all(accounts)
+    for i, account in enumerate(accounts):
+        for offset in range(1, 6):
+            account.follow(accounts[(i + offset) % users])
+        db.session.add_all([Post(body=f'post {j} of user {i}', author=account)
+                            for j in range(posts)])
+    db.session.commit()
+
+
+def login(client, i):
+    """
+    Logs in a client as a user
+    """
+    response = client.post('/login', data={'username': f'user{i}',
+                                           'password': 'password'})
+    assert response.status_code == 302, response.status_code
+
+
+def run(seconds, workloads):
+    """
+    Runs each (request, latencies) workload in its own thread until the
+    deadline, collecting the latencies in ms
+    """
+    deadline = perf_counter() + seconds
+
+    def loop(request, latencies):
+        while perf_counter() < deadline:
+            started = perf_counter()
+            request()
+            latencies.append((perf_counter() - started) * 1000)
+
+    threads = [Thread(target=loop, args=workload) for workload in workloads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def report(name, latencies):
+    """
+    Prints the latency percentiles of a kind of request
+    """
+    print(f'{name:>26}: p50 {percentile(latencies, 0.5):8.2f} ms, '
+          f'p99 {percentile(latencies, 0.99):8.2f} ms '
+          f'({len(latencies)} requests)')
+
+
+def measure(users, threads, seconds):
+    """
+    Measures the timelines alone, then the timelines and logins together
+    """
+    readers = []
+    for i in range(threads):
+        client = app.test_client()
+        login(client, i % users)
+        readers.append(client)
+
+    baseline = [[] for _ in readers]
+    run(seconds, [(lambda client=client: client.get('/'), latencies)
+                  for client, latencies in zip(readers, baseline)])
+    report('timeline alone', sum(baseline, []))
+
+    timelines = [[] for _ in readers]
+    logins = [[] for _ in range(threads)]
+    workloads = [(lambda client=client: client.get('/'), latencies)
+                 for client, latencies in zip(readers, timelines)]
+    workloads += [(lambda i=i: login(app.test_client(use_cookies=False),
+                                     i % users), latencies)
+                  for i, latencies in enumerate(logins)]
+    run(seconds, workloads)
+    report('login during storm', sum(logins, []))
+    report('timeline during storm', sum(timelines, []))
+    slowdown = percentile(sum(timelines, []), 0.5) / \
+        percentile(sum(baseline, []), 0.5)
+    print(f'{"timeline p50 slowdown":>26}: x{slowdown:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--posts', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--pool', type=int, default=2,
+                        help='worker processes of the hashing pool')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        path = os.path.join(tempfile.mkdtemp(), 'login.db')
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['SEARCH_INDEXER_THREAD'] = False
+    app.config['PASSWORD_HASH_WORKERS'] = 0
+
+    with app.app_context():
+        populate(args.users, args.posts)
+    print(f'Hashing with {password_hasher.method()}, '
+          f'{args.threads} readers and {args.threads} login threads, '
+          f'{os.cpu_count()} CPUs')
+    print('inline hashing')
+    measure(args.users, args.threads, args.seconds)
+    app.config['PASSWORD_HASH_WORKERS'] = args.pool
+    print(f'process pool of {args.pool}')
+    measure(args.users, args.threads, args.seconds)
+    last_seen_buffer.clear()
+    with app.app_context():
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
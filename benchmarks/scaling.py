@@ -0,0 +1,251 @@
+"""
+Scaling of the model queries and routes with the size of the data
+Generates a power-law social graph at increasing sizes and reports the
+latency, the number of SQL queries and the database work of each
+operation, written as JSON to compare runs between commits
+
+Usage: python -m benchmarks.scaling [--sizes 1000,10000,100000]
+       [--output FILE] [--compare FILE]
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import subprocess
+import tempfile
+from time import perf_counter
+from app import app, db
+from app.activity import last_seen_buffer
+from app.models import User, Post
+from app.search import search_cache, hydration_cache
+from benchmarks.data import generate, PASSWORD
+from benchmarks.search import percentile
+
+
+class Probe:
+    """
+    Counts the SQL queries of an operation and the work of the database:
+    the virtual machine steps on SQLite, the rows read by the scans of the
+    captured queries (EXPLAIN ANALYZE) on PostgreSQL
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.queries = 0
+        self.steps = 0
+        self.selects = []
+        db.event.listen(db.engine, 'before_cursor_execute', self.execute)
+        if db.engine.dialect.name == 'sqlite':
+            db.event.listen(db.engine, 'checkout', self.checkout)
+
+    def checkout(self, connection, record, proxy):
+        connection.set_progress_handler(self.step, 100)
+
+    def step(self):
+        if self.enabled:
+            self.steps += 100
+        return 0
+
+    def execute(self, connection, cursor, statement, parameters, context,
+                executemany):
+        if self.enabled:
+            self.queries += 1
+            if statement.lstrip().upper().startswith('SELECT'):
+                self.selects.append((statement, parameters))
+
+    def measure(self, operation):
+        """
+        Runs an operation once and returns its query count and database work
+        """
+        self.enabled, self.queries, self.steps, self.selects = \
+            True, 0, 0, []
+        try:
+            operation()
+        finally:
+            self.enabled = False
+        if db.engine.dialect.name == 'sqlite':
+            return {'queries': self.queries, 'vm_steps': self.steps}
+        return {'queries': self.queries, 'rows_scanned': sum(
+            self.rows_scanned(statement, parameters)
+            for statement, parameters in self.selects)}
+
+    @staticmethod
+    def rows_scanned(statement, parameters):
+        """
+        Returns the rows read by the scans of a PostgreSQL query
+        """
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + statement,
+                           parameters)
+            plan = cursor.fetchone()[0][0]['Plan']
+        finally:
+            connection.close()
+        rows, nodes = 0, [plan]
+        while nodes:
+            node = nodes.pop()
+            if 'Scan' in node['Node Type']:
+                rows += node.get('Actual Rows', 0) * \
+                    node.get('Actual Loops', 1) + \
+                    node.get('Rows Removed by Filter', 0)
+            nodes.extend(node.get('Plans', []))
+        return rows
+
+
+def operations(client, reader, popular, word):
+    """
+    Returns the model queries and the routes to measure
+    """
+    per_page = app.config['POSTS_PER_PAGE']
+
+    def search():
+        # measures the whole path, not the caches
+        search_cache.setup()
+        hydration_cache.setup()
+        Post.search(word, 1, per_page)
+
+    def get(url):
+        def request():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+        return request
+
+    return {
+        'followed_posts': lambda: User.query.get(reader).followed_posts()
+        .limit(per_page).all(),
+        'timeline_posts': lambda: User.query.get(reader).timeline_posts()
+        .limit(per_page).all(),
+        'explore_posts': lambda: Post.query.order_by(Post.timestamp.desc())
+        .limit(per_page).all(),
+        'profile_posts': lambda: User.query.get(popular).posts
+        .order_by(Post.timestamp.desc()).limit(per_page).all(),
+        'profile_counters': lambda: User.query.get(popular).followers_count,
+        'followers_count_query': lambda: User.query.get(popular).followers
+        .count(),
+        'search': search,
+        'route_index': get('/'),
+        'route_explore': get('/explore'),
+        'route_profile': get(f'/user/user{popular}'),
+        'route_popup': get(f'/user/user{popular}/popup'),
+        'route_search': get(f'/search?q={word}'),
+    }
+
+
+def run_size(posts, users, args):
+    """
+    Generates the data of one size and measures every operation
+    """
+    if not os.environ.get('DATABASE_URL'):
+        path = os.path.join(tempfile.mkdtemp(), f'scaling-{posts}.db')
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    with app.app_context():
+        db.drop_all()
+        started = perf_counter()
+        counts = generate(users, posts, args.seed, args.follows,
+                          progress=lambda message: print(f'  {message}'))
+        counts['generate_seconds'] = round(perf_counter() - started, 2)
+        reader = db.session.query(User.id).order_by(
+            User.followed_count.desc()).limit(1).scalar()
+        popular = db.session.query(User.id).order_by(
+            User.followers_count.desc()).limit(1).scalar()
+        word = db.session.query(Post.body).filter_by(id=1).scalar().split()[0]
+        db.session.remove()
+        probe = Probe()
+
+    client = app.test_client()
+    client.post('/login', data={'username': f'user{reader}',
+                                'password': PASSWORD})
+    results = {}
+    for name, operation in operations(client, reader, popular, word).items():
+        with app.app_context():
+            operation()
+            latencies = []
+            for _ in range(args.repeat):
+                db.session.remove()
+                started = perf_counter()
+                operation()
+                latencies.append((perf_counter() - started) * 1000)
+            db.session.remove()
+            result = {'p50_ms': round(percentile(latencies, 0.5), 3),
+                      'p95_ms': round(percentile(latencies, 0.95), 3)}
+            result.update(probe.measure(operation))
+            db.session.remove()
+        results[name] = result
+        work = ', '.join(f'{key} {value}' for key, value in result.items()
+                         if key not in ('p50_ms', 'p95_ms'))
+        print(f'  {name:>22}: p50 {result["p50_ms"]:8.2f} ms, '
+              f'p95 {result["p95_ms"]:8.2f} ms, {work}')
+    # the visits of the benchmark are not written
+    last_seen_buffer.clear()
+    with app.app_context():
+        db.drop_all()
+    return dict(counts, operations=results)
+
+
+def commit():
+    """
+    Returns the current git commit, if any
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    """
+    Prints the p50 latency ratios of the operations of two runs
+    """
+    print(f'Compared with {previous.get("commit")}:')
+    old = {size['posts']: size['operations'] for size in previous['sizes']}
+    for size in current['sizes']:
+        for name, result in size['operations'].items():
+            before = old.get(size['posts'], {}).get(name)
+            if before and before['p50_ms']:
+                print(f'  {size["posts"]:>9} posts {name:>22}: '
+                      f'x{result["p50_ms"] / before["p50_ms"]:.2f}, '
+                      f'queries {before["queries"]} -> {result["queries"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated numbers of posts')
+    parser.add_argument('--posts-per-user', type=int, default=20)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='average number of followed accounts')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON file of a previous run')
+    args = parser.parse_args()
+
+    app.config['SEARCH_INDEXER_THREAD'] = False
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['LAST_SEEN_FLUSH_INTERVAL'] = 0
+    app.config['PASSWORD_HASH_WORKERS'] = 0
+    # the logins are not measured
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+
+    run = {'commit': commit(), 'date': datetime.utcnow().isoformat(),
+           'seed': args.seed, 'repeat': args.repeat, 'sizes': []}
+    for posts in (int(size) for size in args.sizes.split(',')):
+        users = max(50, posts // args.posts_per_user)
+        print(f'{posts} posts, {users} users')
+        run['sizes'].append(run_size(posts, users, args))
+    run['database'] = db.engine.dialect.name
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(run, output, indent=2)
+        print(f'Results written to {args.output}')
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Query latency of the database search backend against Elasticsearch
+Elasticsearch is only measured when ELASTICSEARCH_URL is set
+
+Usage: python -m benchmarks.search [--posts N] [--queries N]
+"""
+import argparse
+import os
+import random
+import tempfile
+from time import perf_counter
+from app import app, db
+from app.models import User, Post
+from app.search import search_backend, query_index
+
+
+def percentile(values, fraction):
+    """
+    Returns a percentile of a list of values
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def vocabulary(rng, size=2000):
+    """
+    Returns a list of random words
+    """
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+            for _ in range(size)]
+
+
+def populate(rng, words, posts):
+    """
+    Inserts random posts in bulk and indexes them
+    """
+    db.create_all()
+    db.session.execute(User.__table__.insert(),
+                       [{'username': 'bench', 'email': 'bench@example.com'}])
+    user_id = db.session.query(User.id).scalar()
+    for start in range(0, posts, 5000):
+        db.session.execute(Post.__table__.insert(), [
+            {'body': ' '.join(rng.choice(words) for _ in range(12)),
+             'user_id': user_id}
+            for _ in range(start, min(posts, start + 5000))])
+    Post.reindex()
+    db.session.commit()
+
+
+def measure(rng, words, queries, per_page=10):
+    """
+    Returns the latencies of random one and two word queries in ms
+    """
+    latencies = []
+    for _ in range(queries):
+        query = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 2)))
+        started = perf_counter()
+        query_index('post', query, 1, per_page)
+        latencies.append((perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(name, latencies):
+    """
+    Prints the latency percentiles of a backend
+    """
+    print(f'{name:>14}: p50 {percentile(latencies, 0.5):7.2f} ms, '
+          f'p95 {percentile(latencies, 0.95):7.2f} ms, '
+          f'p99 {percentile(latencies, 0.99):7.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        path = os.path.join(tempfile.mkdtemp(), 'search.db')
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['SEARCH_INDEXER_THREAD'] = False
+    rng = random.Random(args.seed)
+    words = vocabulary(rng)
+
+    with app.app_context():
+        app.config['SEARCH_BACKEND'] = 'database'
+        print(f'Indexing {args.posts} posts in the database '
+              f'({search_backend().__class__.__name__})')
+        populate(rng, words, args.posts)
+        report('database', measure(random.Random(args.seed), words,
+                                   args.queries))
+        if app.elasticsearch:
+            app.config['SEARCH_BACKEND'] = 'elasticsearch'
+            Post.reindex()
+            app.elasticsearch.indices.refresh(index='post')
+            report('elasticsearch', measure(random.Random(args.seed), words,
+                                            args.queries))
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
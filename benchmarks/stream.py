@@ -0,0 +1,160 @@
+"""
+Idle server-sent events connections held by one worker
+Opens more and more connections to /stream of a threaded server, then
+measures the memory they take and how long a new post takes to reach all
+of them
+
+Usage: python -m benchmarks.stream [--connections N ...]
+"""
+import argparse
+import os
+import resource
+import selectors
+import socket
+import tempfile
+import threading
+from time import perf_counter, sleep
+from werkzeug.serving import make_server
+from app import app, db
+from app.activity import last_seen_buffer
+from app.models import User, Post
+from app.stream import broker
+from benchmarks.search import percentile
+
+
+def populate():
+    """
+    Creates a listener following an author
+    """
+    db.create_all()
+    listener = User(username='listener', email='listener@example.com')
+    author = User(username='author', email='author@example.com')
+    listener.set_password('cat')
+    db.session.add_all([listener, author])
+    listener.follow(author)
+    db.session.commit()
+
+
+def session_cookie():
+    """
+    Returns the session cookie of the logged in listener
+    """
+    client = app.test_client()
+    app.config['WTF_CSRF_ENABLED'] = False
+    client.post('/login', data={'username': 'listener', 'password': 'cat'})
+    app.config['WTF_CSRF_ENABLED'] = True
+    return next(cookie.value for cookie in client.cookie_jar
+                if cookie.name == app.session_cookie_name)
+
+
+def rss():
+    """
+    Returns the resident memory of the process in MB
+    """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / \
+            2 ** 20
+
+
+def connect(port, cookie, count):
+    """
+    Opens connections to the stream, returns once they are all subscribed
+    """
+    request = (f'GET /stream HTTP/1.1\r\nHost: localhost\r\n'
+               f'Cookie: {app.session_cookie_name}={cookie}\r\n\r\n').encode()
+    connections = []
+    for _ in range(count):
+        connection = socket.create_connection(('127.0.0.1', port))
+        connection.sendall(request)
+        connections.append(connection)
+    while broker.connections < count:
+        sleep(0.01)
+    return connections
+
+
+def disconnect(connections):
+    """
+    Closes connections, returns once the server noticed it
+    """
+    for connection in connections:
+        connection.close()
+    # the server side notices at the next write
+    app.config['SSE_HEARTBEAT'] = 0.1
+    while broker.connections:
+        sleep(0.05)
+    app.config['SSE_HEARTBEAT'] = 15
+
+
+def deliver(connections):
+    """
+    Commits a post and returns the delays until each connection received it
+    in ms
+    """
+    selector = selectors.DefaultSelector()
+    for connection in connections:
+        selector.register(connection, selectors.EVENT_READ, b'')
+    author = User.query.filter_by(username='author').one()
+    started = perf_counter()
+    db.session.add(Post(body='hello', author=author))
+    db.session.commit()
+    delays = []
+    while len(delays) < len(connections):
+        for key, _ in selector.select(timeout=30):
+            received = key.data + key.fileobj.recv(65536)
+            if b'event: post' in received:
+                delays.append((perf_counter() - started) * 1000)
+                selector.unregister(key.fileobj)
+            else:
+                selector.modify(key.fileobj, selectors.EVENT_READ, received)
+    selector.close()
+    return delays
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--connections', type=int, nargs='+',
+                        default=[100, 500, 1000])
+    args = parser.parse_args()
+
+    # two descriptors per connection, the client and the server sides
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    threading.stack_size(256 * 1024)
+    if not os.environ.get('DATABASE_URL'):
+        path = os.path.join(tempfile.mkdtemp(), 'stream.db')
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['SEARCH_INDEXER_THREAD'] = False
+    app.config['SSE_ENABLED'] = True
+    app.config['SSE_RELAY_INTERVAL'] = 0
+
+    with app.app_context():
+        populate()
+        cookie = session_cookie()
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        server.socket.listen(max(args.connections))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f'{"connections":>12} {"RSS":>9} {"per conn":>10} '
+              f'{"threads":>8} {"p50":>9} {"p99":>9} {"max":>9}')
+        # the templates are compiled by the first post
+        connections = connect(server.port, cookie, 1)
+        deliver(connections)
+        disconnect(connections)
+        baseline = rss()
+        for count in args.connections:
+            connections = connect(server.port, cookie, count)
+            memory = rss()
+            threads = threading.active_count()
+            delays = deliver(connections)
+            print(f'{count:>12} {memory:6.1f} MB '
+                  f'{(memory - baseline) * 1024 / count:6.1f} kB '
+                  f'{threads:>8} {percentile(delays, 0.5):6.1f} ms '
+                  f'{percentile(delays, 0.99):6.1f} ms '
+                  f'{max(delays):6.1f} ms')
+            disconnect(connections)
+        server.shutdown()
+        last_seen_buffer.clear()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
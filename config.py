@@ -21,9 +21,113 @@ class Config():
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    # passwords are hashed in a pool of processes (0 for inline), logins
+    # wait at most the timeout for one of the queue places, stored hashes
+    # are upgraded to the method and cost on login
+    PASSWORD_HASH_METHOD = \
+        os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 16)
+    PASSWORD_HASH_TIMEOUT = 5
+    # emails are sent by a pool of workers reusing their SMTP connection,
+    # when the queue is full they wait for a place (block) or are dropped
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 100)
+    MAIL_QUEUE_FULL = os.environ.get('MAIL_QUEUE_FULL') or 'block'
+    MAIL_QUEUE_TIMEOUT = 5
+    MAIL_IDLE_TIMEOUT = 10
     ADMINS = ['symeon.smith@gmail.com']
     POSTS_PER_PAGE = 10
+    # timelines, profiles and popups answer 304 when they did not change
+    CONDITIONAL_GET = \
+        os.environ.get('CONDITIONAL_GET', 'true').lower() != 'false'
+    # visits are written at most once per user and granularity (seconds),
+    # batched every interval and when the process exits (0 for only then)
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = \
+        int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL', 10))
+    # timelines are paginated with opaque cursors instead of page numbers
+    CURSOR_PAGINATION = os.environ.get('CURSOR_PAGINATION') is not None
+    # followed ids of a user kept in a sorted array instead of a set above
+    FOLLOWED_IDS_ARRAY_THRESHOLD = 10000
+    # authors with more followers are merged into home timelines on read
+    TIMELINE_FANOUT_THRESHOLD = int(
+        os.environ.get('TIMELINE_FANOUT_THRESHOLD') or 5000)
+    # the first pages of /explore are served from a ring of the newest
+    # posts (0 to disable), shared by the processes through the file when
+    # there are several of them
+    EXPLORE_BUFFER_SIZE = int(os.environ.get('EXPLORE_BUFFER_SIZE') or 0)
+    EXPLORE_BUFFER_PATH = os.environ.get('EXPLORE_BUFFER_PATH')
+    # rendered posts kept per process, 0 to always render them
+    POST_FRAGMENT_CACHE_SIZE = \
+        int(os.environ.get('POST_FRAGMENT_CACHE_SIZE', 10000))
+    # new posts are pushed to the home pages through server-sent events,
+    # each connection holds a thread (gthread or gevent workers) and at most
+    # SSE_QUEUE_SIZE posts; the posts of the other processes are polled from
+    # the database every interval (seconds, 0 for a single process)
+    SSE_ENABLED = os.environ.get('SSE_ENABLED') is not None
+    SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE') or 100)
+    SSE_HEARTBEAT = 15
+    SSE_RELAY_INTERVAL = float(os.environ.get('SSE_RELAY_INTERVAL', 2))
+    SSE_RELAY_WINDOW = 30
+    # deleted accounts are hidden at once, those with more posts than the
+    # limit are then deleted in batches by a thread of each process unless
+    # a separate `flask account worker` is used; a job not progressing for
+    # ACCOUNT_DELETION_STALE seconds is resumed by another worker
+    ACCOUNT_DELETION_SYNC_LIMIT = \
+        int(os.environ.get('ACCOUNT_DELETION_SYNC_LIMIT') or 1000)
+    ACCOUNT_DELETION_BATCH_SIZE = 1000
+    ACCOUNT_DELETION_THREAD = \
+        os.environ.get('ACCOUNT_DELETION_THREAD', 'true').lower() != 'false'
+    ACCOUNT_DELETION_INTERVAL = 30
+    ACCOUNT_DELETION_STALE = 300
     # available: mp, identicon, monsterid, wavatar, retro, robohash, blank
     AVATAR_STYLE = 'retro'
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # elasticsearch, database or none, by default elasticsearch if it is
+    # configured, else the full-text search of the database
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    # cached search results, invalidated when the posts change, the
+    # invalidations are shared by the processes through a file, by default
+    # in the instance folder, an empty path keeps them to each process
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1024)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 60)
+    SEARCH_CACHE_SHARED_PATH = os.environ.get('SEARCH_CACHE_SHARED_PATH')
+    # recently loaded posts turned back into objects for the search hits
+    # without a query, dropped when they are updated or deleted
+    SEARCH_HYDRATION_CACHE_SIZE = \
+        int(os.environ.get('SEARCH_HYDRATION_CACHE_SIZE') or 4096)
+    SEARCH_HYDRATION_CACHE_TTL = \
+        int(os.environ.get('SEARCH_HYDRATION_CACHE_TTL') or 300)
+    # search pages are chained with cursors, the previous pages are only
+    # linked by offset up to the maximum, the pages of a search can see the
+    # Elasticsearch index at the time of the first one (7.12+)
+    SEARCH_MAX_OFFSET = int(os.environ.get('SEARCH_MAX_OFFSET') or 10000)
+    SEARCH_POINT_IN_TIME = os.environ.get('SEARCH_POINT_IN_TIME') is not None
+    # the search outbox is drained by a thread of each process unless a
+    # separate `flask search worker` is used, one process at a time through
+    # a lease renewed every batch
+    SEARCH_INDEXER_THREAD = \
+        os.environ.get('SEARCH_INDEXER_THREAD', 'true').lower() != 'false'
+    SEARCH_INDEXER_BATCH_SIZE = \
+        int(os.environ.get('SEARCH_INDEXER_BATCH_SIZE') or 500)
+    SEARCH_REINDEX_WORKERS = \
+        int(os.environ.get('SEARCH_REINDEX_WORKERS') or 4)
+    SEARCH_INDEXER_INTERVAL = 5
+    SEARCH_INDEXER_BACKOFF = 2
+    SEARCH_INDEXER_MAX_BACKOFF = 600
+    SEARCH_INDEXER_LEASE = 60
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    # each process writes its metrics to the directory every interval
+    # (seconds) for /metrics to add up the workers, the directory should be
+    # emptied when the server starts; /metrics requires the bearer token
+    # when one is set, and is only served to the host itself otherwise
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_WRITE_INTERVAL = 5
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # requests are profiled to the directory when they carry a token of
+    # `flask profile token`, when an admin adds ?profile to the url, or for
+    # the sampled fraction; nothing is installed without a directory
+    PROFILE_DIR = os.environ.get('PROFILE_DIR')
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    PROFILE_SAMPLE_INTERVAL = 0.001
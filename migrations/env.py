@@ -1,6 +1,7 @@
 from __future__ import with_statement
 
 import logging
+import re
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -27,6 +28,20 @@ config.set_main_option(
     str(current_app.extensions['migrate'].db.engine.url).replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+# the tables of the search backends, `<index>_fts*` on SQLite and
+# `<index>_search` on PostgreSQL, are created by the application itself
+search_tables = re.compile(r'({})_(fts(_\w+)?|search)$'.format(
+    '|'.join(re.escape(name) for name in target_metadata.tables)))
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """
+    Leaves the tables of the search backends out of autogenerate
+    """
+    return not (type_ == 'table' and reflected and compare_to is None and
+                search_tables.match(name))
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -47,7 +62,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -83,6 +99,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,59 @@
+"""social graph indexes
+
+Revision ID: 2b7d9e4a1c36
+Revises: f1a5c8e27d60
+Create Date: 2026-10-18 19:21:08.530617
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7d9e4a1c36'
+down_revision = 'f1a5c8e27d60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the table is rebuilt to add the primary key on every database,
+    # keeping one row per (follower, followed) pair
+    op.create_table('followers_new',
+                    sa.Column('follower_id', sa.Integer(), nullable=False),
+                    sa.Column('followed_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+                    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+                    sa.PrimaryKeyConstraint('follower_id', 'followed_id',
+                                            name='pk_followers')
+                    )
+    op.execute('INSERT INTO followers_new (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    op.create_index('ix_followers_followed_id_follower_id', 'followers',
+                    ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_post_user_id_timestamp', 'post',
+                    ['user_id', 'timestamp'], unique=False)
+    # the duplicated rows were also counted
+    op.execute('UPDATE "user" SET followers_count = (SELECT count(*) '
+               'FROM followers WHERE followers.followed_id = "user".id), '
+               'followed_count = (SELECT count(*) FROM followers '
+               'WHERE followers.follower_id = "user".id)')
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.create_table('followers_old',
+                    sa.Column('follower_id', sa.Integer(), nullable=True),
+                    sa.Column('followed_id', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+                    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], )
+                    )
+    op.execute('INSERT INTO followers_old (follower_id, followed_id) '
+               'SELECT follower_id, followed_id FROM followers')
+    op.drop_index('ix_followers_followed_id_follower_id',
+                  table_name='followers')
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
@@ -0,0 +1,28 @@
+"""post index id
+
+Revision ID: 3e8a5c2d7f41
+Revises: 7d3c1f5b9e24
+Create Date: 2026-10-21 11:42:06.218734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8a5c2d7f41'
+down_revision = '7d3c1f5b9e24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.create_index('ix_post_user_id_timestamp', 'post',
+                    ['user_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.create_index('ix_post_user_id_timestamp', 'post',
+                    ['user_id', 'timestamp'], unique=False)
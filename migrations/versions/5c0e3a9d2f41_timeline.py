@@ -0,0 +1,43 @@
+"""timeline
+
+Revision ID: 5c0e3a9d2f41
+Revises: 950a724b57da
+Create Date: 2026-10-18 09:12:31.402113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c0e3a9d2f41'
+down_revision = '950a724b57da'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('post_id', sa.Integer(), nullable=False),
+                    sa.Column('timestamp', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+                    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+                    sa.PrimaryKeyConstraint('user_id', 'post_id')
+                    )
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline',
+                    ['user_id', 'timestamp'], unique=False)
+    # backfill with the own posts and the posts of the followed users
+    op.execute('INSERT INTO timeline (user_id, post_id, timestamp) '
+               'SELECT user_id, id, timestamp FROM post '
+               'WHERE user_id IS NOT NULL')
+    op.execute('INSERT INTO timeline (user_id, post_id, timestamp) '
+               'SELECT DISTINCT followers.follower_id, post.id, '
+               'post.timestamp FROM post JOIN followers '
+               'ON followers.followed_id = post.user_id '
+               'WHERE followers.follower_id != post.user_id')
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.drop_table('timeline')
@@ -0,0 +1,29 @@
+"""lease
+
+Revision ID: 6b2e9d4f8a17
+Revises: c5d81b3e6f29
+Create Date: 2026-10-20 10:41:07.315482
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b2e9d4f8a17'
+down_revision = 'c5d81b3e6f29'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('lease',
+                    sa.Column('name', sa.String(length=64), nullable=False),
+                    sa.Column('owner', sa.String(length=128), nullable=True),
+                    sa.Column('expires_at', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('name')
+                    )
+
+
+def downgrade():
+    op.drop_table('lease')
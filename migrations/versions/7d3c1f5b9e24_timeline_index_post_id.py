@@ -0,0 +1,28 @@
+"""timeline index post id
+
+Revision ID: 7d3c1f5b9e24
+Revises: 6b2e9d4f8a17
+Create Date: 2026-10-21 09:17:52.640318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3c1f5b9e24'
+down_revision = '6b2e9d4f8a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline',
+                    ['user_id', 'timestamp', 'post_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline',
+                    ['user_id', 'timestamp'], unique=False)
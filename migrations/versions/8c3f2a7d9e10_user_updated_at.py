@@ -0,0 +1,32 @@
+"""user updated at
+
+Revision ID: 8c3f2a7d9e10
+Revises: 2b7d9e4a1c36
+Create Date: 2026-10-18 20:42:17.316052
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3f2a7d9e10'
+down_revision = '2b7d9e4a1c36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('updated_at', sa.DateTime(),
+                                    nullable=True))
+    op.create_index(op.f('ix_user_updated_at'), 'user', ['updated_at'],
+                    unique=False)
+    # the existing users start at the time of the migration
+    user = sa.table('user', sa.column('updated_at', sa.DateTime))
+    op.execute(user.update().values(updated_at=datetime.utcnow()))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_updated_at'), table_name='user')
+    op.drop_column('user', 'updated_at')
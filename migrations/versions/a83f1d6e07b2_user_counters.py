@@ -0,0 +1,38 @@
+"""user counters
+
+Revision ID: a83f1d6e07b2
+Revises: 5c0e3a9d2f41
+Create Date: 2026-10-18 10:41:07.268590
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83f1d6e07b2'
+down_revision = '5c0e3a9d2f41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('followers_count', sa.Integer(),
+                                    server_default='0', nullable=False))
+    op.add_column('user', sa.Column('followed_count', sa.Integer(),
+                                    server_default='0', nullable=False))
+    op.add_column('user', sa.Column('posts_count', sa.Integer(),
+                                    server_default='0', nullable=False))
+    # backfill from the followers and post tables
+    op.execute('UPDATE "user" SET followers_count = (SELECT count(*) '
+               'FROM followers WHERE followers.followed_id = "user".id)')
+    op.execute('UPDATE "user" SET followed_count = (SELECT count(*) '
+               'FROM followers WHERE followers.follower_id = "user".id)')
+    op.execute('UPDATE "user" SET posts_count = (SELECT count(*) '
+               'FROM post WHERE post.user_id = "user".id)')
+
+
+def downgrade():
+    op.drop_column('user', 'posts_count')
+    op.drop_column('user', 'followed_count')
+    op.drop_column('user', 'followers_count')
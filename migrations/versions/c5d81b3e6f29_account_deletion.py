@@ -0,0 +1,50 @@
+"""account deletion
+
+Revision ID: c5d81b3e6f29
+Revises: 8c3f2a7d9e10
+Create Date: 2026-10-19 09:12:44.804213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d81b3e6f29'
+down_revision = '8c3f2a7d9e10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('deleted_at', sa.DateTime(),
+                                    nullable=True))
+    op.create_table('account_deletion',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('user_id', sa.Integer(), nullable=True),
+                    sa.Column('username', sa.String(length=64),
+                              nullable=True),
+                    sa.Column('status', sa.String(length=16), nullable=True),
+                    sa.Column('posts_total', sa.Integer(), nullable=True),
+                    sa.Column('posts_deleted', sa.Integer(), nullable=True),
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.Column('updated_at', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_account_deletion_status'), 'account_deletion',
+                    ['status'], unique=False)
+    op.create_index(op.f('ix_account_deletion_updated_at'),
+                    'account_deletion', ['updated_at'], unique=False)
+    op.create_index(op.f('ix_account_deletion_user_id'), 'account_deletion',
+                    ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_account_deletion_user_id'),
+                  table_name='account_deletion')
+    op.drop_index(op.f('ix_account_deletion_updated_at'),
+                  table_name='account_deletion')
+    op.drop_index(op.f('ix_account_deletion_status'),
+                  table_name='account_deletion')
+    op.drop_table('account_deletion')
+    op.drop_column('user', 'deleted_at')
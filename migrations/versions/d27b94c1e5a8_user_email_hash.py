@@ -0,0 +1,41 @@
+"""user email hash
+
+Revision ID: d27b94c1e5a8
+Revises: a83f1d6e07b2
+Create Date: 2026-10-18 11:58:44.031927
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd27b94c1e5a8'
+down_revision = 'a83f1d6e07b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('email_hash', sa.String(length=32),
+                                    nullable=True))
+    # backfill the Gravatar hashes of the existing emails
+    user = sa.table('user', sa.column('id', sa.Integer),
+                    sa.column('email', sa.String),
+                    sa.column('email_hash', sa.String))
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select([user.c.id, user.c.email])
+        .where(user.c.email.isnot(None))).fetchall()
+    if rows:
+        connection.execute(
+            user.update().where(user.c.id == sa.bindparam('user_id'))
+            .values(email_hash=sa.bindparam('digest')),
+            [{'user_id': user_id,
+              'digest': md5(email.lower().encode('utf-8')).hexdigest()}
+             for user_id, email in rows])
+
+
+def downgrade():
+    op.drop_column('user', 'email_hash')
@@ -0,0 +1,38 @@
+"""search outbox
+
+Revision ID: e4b61c0f93d7
+Revises: d27b94c1e5a8
+Create Date: 2026-10-18 14:20:19.553016
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b61c0f93d7'
+down_revision = 'd27b94c1e5a8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('search_outbox',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('index', sa.String(length=64), nullable=True),
+                    sa.Column('object_id', sa.Integer(), nullable=True),
+                    sa.Column('operation', sa.String(length=8),
+                              nullable=True),
+                    sa.Column('payload', sa.Text(), nullable=True),
+                    sa.Column('attempts', sa.Integer(), nullable=True),
+                    sa.Column('next_attempt', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_search_outbox_next_attempt'), 'search_outbox',
+                    ['next_attempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_search_outbox_next_attempt'),
+                  table_name='search_outbox')
+    op.drop_table('search_outbox')
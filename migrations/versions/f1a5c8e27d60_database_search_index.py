@@ -0,0 +1,41 @@
+"""database search index
+
+Revision ID: f1a5c8e27d60
+Revises: e4b61c0f93d7
+Create Date: 2026-10-18 16:05:52.718349
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1a5c8e27d60'
+down_revision = 'e4b61c0f93d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts '
+                   'USING fts5(body)')
+        op.execute('INSERT INTO post_fts (rowid, body) '
+                   'SELECT id, body FROM post')
+    elif dialect == 'postgresql':
+        op.execute('CREATE TABLE IF NOT EXISTS post_search '
+                   '(id INTEGER PRIMARY KEY, document TSVECTOR)')
+        op.execute('CREATE INDEX IF NOT EXISTS ix_post_search '
+                   'ON post_search USING GIN (document)')
+        op.execute("INSERT INTO post_search (id, document) "
+                   "SELECT id, to_tsvector('english', coalesce(body, '')) "
+                   "FROM post")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS post_fts')
+    elif dialect == 'postgresql':
+        op.execute('DROP TABLE IF EXISTS post_search')
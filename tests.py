@@ -2,9 +2,36 @@
 Unit testing for the application
 """
 from datetime import datetime, timedelta
+import json
+import os
+import pstats
+import re
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures.process import BrokenProcessPool
 from app import app, db
-from app.models import User, Post
+from app.models import User, Post, Counters, Timeline, search_outbox, \
+    AccountDeletion, timeline, lease
+from app.pagination import keyset_paginate, decode_search_cursor
+from app.indexer import indexer, Reindexer
+from app.activity import last_seen_buffer
+from app.email import MailQueue
+from app.metrics import metrics
+from app.profiling import init_profiling, profile_token
+from app.fragments import post_fragments
+from app.explore import RecentPosts, recent_posts
+from app.stream import broker
+from app.accounts import account_deleter
+from app.passwords import PasswordHasher, PasswordHasherBusy
+from flask_mail import Message
+from app.search import query_index, search_cache, hydration_cache
+from app.cache import LRUCache, SharedGeneration
+from elasticsearch import ConnectionError as ElasticsearchConnectionError
+from sqlalchemy.exc import OperationalError
 
 
 class UserModelCase(unittest.TestCase):
@@ -15,10 +42,15 @@ class UserModelCase(unittest.TestCase):
     def setUp(self):
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
         db.create_all()
+        # restored after the tests changing the password hashing
+        self.password_config = {key: value for key, value in
+                                app.config.items()
+                                if key.startswith('PASSWORD_HASH_')}
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        app.config.update(self.password_config)
 
     def test_password_hashing(self):
         u = User(username='susan')
@@ -26,6 +58,43 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_upgrade(self):
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(username='susan')
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        old_hash = u.password_hash
+        self.assertFalse(u.check_password('dog'))
+        self.assertEqual(u.password_hash, old_hash)
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_hasher_busy(self):
+        app.config['PASSWORD_HASH_QUEUE'] = 1
+        app.config['PASSWORD_HASH_TIMEOUT'] = 0
+        hasher = PasswordHasher()
+        password_hash = hasher.hash('cat')
+        self.assertTrue(hasher.verify(password_hash, 'cat'))
+        # no place left in the queue
+        hasher.slots.acquire()
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.verify(password_hash, 'cat')
+        hasher.slots.release()
+        hasher.pool.shutdown()
+
+    def test_password_hasher_crash(self):
+        hasher = PasswordHasher()
+        with self.assertRaises(BrokenProcessPool):
+            hasher.run(os._exit, 1)
+        broken = hasher.pool
+        # the broken pool is shut down and replaced
+        self.assertTrue(hasher.verify(hasher.hash('cat'), 'cat'))
+        self.assertIsNot(hasher.pool, broken)
+        self.assertIsNone(broken._call_queue)
+        hasher.pool.shutdown()
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128),
@@ -33,6 +102,14 @@ class UserModelCase(unittest.TestCase):
                           'd4c74594d841139328695756648b6bd6'
                           f"?s=128&d={app.config['AVATAR_STYLE']}"))
 
+    def test_email_hash(self):
+        u = User(username='john', email='John@example.com')
+        self.assertEqual(u.email_hash, 'd4c74594d841139328695756648b6bd6')
+        u.avatar(128)
+        u.email = 'susan@example.com'
+        self.assertNotEqual(u.email_hash, 'd4c74594d841139328695756648b6bd6')
+        self.assertIn(u.email_hash, u.avatar(128))
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -56,6 +133,37 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_followed_ids(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        saved = app.config['FOLLOWED_IDS_ARRAY_THRESHOLD']
+        try:
+            for threshold in (10000, 1):
+                app.config['FOLLOWED_IDS_ARRAY_THRESHOLD'] = threshold
+                u = users[0]
+                u.follow(users[1])
+                u.follow(users[2])
+                db.session.commit()
+                User.query.all()  # reloads the users expired by the commit
+                # answered from the loaded ids, kept up to date on changes
+                with QueryCounter() as counter:
+                    self.assertTrue(u.is_following(users[1]))
+                    self.assertFalse(u.is_following(users[3]))
+                    u.unfollow(users[1])
+                    u.follow(users[3])
+                    self.assertEqual([u.is_following(v) for v in users],
+                                     [False, False, True, True])
+                self.assertEqual(counter.count, 1)
+                db.session.commit()
+                self.assertEqual(len(u.followed_ids()), 2)
+                u.unfollow(users[2])
+                u.unfollow(users[3])
+                db.session.commit()
+        finally:
+            app.config['FOLLOWED_IDS_ARRAY_THRESHOLD'] = saved
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -94,6 +202,1547 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.add_all([Post(body='post from john', author=u1),
+                            Post(body='post from john', author=u1)])
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.posts_count, 2)
+        self.assertEqual(u1.followed_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+
+        u2.follow(u1)
+        u3.follow(u1)
+        db.session.delete(u1.posts.first())
+        db.session.commit()
+        self.assertEqual(u1.posts_count, 1)
+        self.assertEqual(u1.followers_count, 2)
+
+        u3.unfollow(u1)
+        db.session.commit()
+        self.assertEqual(u1.followers_count, 1)
+        self.assertEqual(u3.followed_count, 0)
+
+        # deleting an account updates the users it was linked to
+        for post in u1.posts:
+            db.session.delete(post)
+        db.session.delete(u1)
+        db.session.commit()
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(u2.followed_count, 0)
+        self.assertEqual(Counters.check([u2.id, u3.id]), [])
+
+        # drifted counters are reported and repaired
+        u2.posts_count = 5
+        db.session.commit()
+        self.assertEqual(Counters.check([u2.id], repair=True),
+                         [(u2.id, 'posts_count', 5, 0)])
+        db.session.commit()
+        self.assertEqual(u2.posts_count, 0)
+
+    def test_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        now = datetime.utcnow()
+        p1 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        db.session.commit()
+
+        # following backfills the posts of the followed user
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p1])
+
+        # new posts are fanned out to the followers
+        p2 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=2))
+        p3 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add_all([p2, p3])
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p3, p2, p1])
+        self.assertEqual(u2.timeline_posts().all(), [p3, p1])
+        self.assertEqual(u1.timeline_posts().all(),
+                         u1.followed_posts().all())
+
+        # deleted posts leave the timelines
+        db.session.delete(p3)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p2, p1])
+
+        # popular authors are merged on read
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        try:
+            u3.follow(u2)
+            db.session.commit()
+            p4 = Post(body="post from susan", author=u2,
+                      timestamp=now + timedelta(seconds=4))
+            db.session.add(p4)
+            db.session.commit()
+            self.assertEqual(u1.timeline_posts().all(), [p4, p2, p1])
+            self.assertEqual(u3.timeline_posts().all(), [p4, p1])
+        finally:
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = 5000
+        Timeline.rebuild([u1.id, u3.id])
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p4, p2, p1])
+
+        # unfollowing removes the posts of the unfollowed user
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p2])
+        self.assertEqual(u3.timeline_posts().all(), [p4, p1])
+
+    def test_timeline_backfill(self):
+        u1, u2, u3, u4 = [User(username=name, email=f'{name}@example.com')
+                          for name in ('john', 'susan', 'mary', 'david')]
+        db.session.add_all([u1, u2, u3, u4])
+        for follower in (u1, u3, u4):
+            follower.follow(u2)
+        db.session.commit()
+
+        def materialized(user):
+            return {post_id for post_id, in db.session.query(
+                timeline.c.post_id).filter(timeline.c.user_id == user.id)}
+
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 2
+        try:
+            p1 = Post(body='post from susan', author=u2)
+            db.session.add(p1)
+            db.session.commit()
+            self.assertEqual(materialized(u1), set())
+
+            # susan is no longer popular, her posts are fanned out
+            u3.unfollow(u2)
+            db.session.commit()
+            self.assertEqual(materialized(u1), {p1.id})
+            self.assertEqual(materialized(u4), {p1.id})
+
+            # so are they when a follower deletes the account
+            u3.follow(u2)
+            db.session.commit()
+            p2 = Post(body='another post from susan', author=u2)
+            db.session.add(p2)
+            db.session.commit()
+            db.session.delete(u3)
+            db.session.commit()
+            self.assertEqual(materialized(u1), {p1.id, p2.id})
+            self.assertEqual(u4.timeline_posts().all(), [p2, p1])
+        finally:
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = 5000
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed in a block
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        db.event.listen(db.engine, 'before_cursor_execute', self.execute)
+        return self
+
+    def __exit__(self, *args):
+        db.event.remove(db.engine, 'before_cursor_execute', self.execute)
+
+    def execute(self, connection, cursor, statement, *args):
+        self.count += 1
+        self.statements.append(statement)
+
+
+class RoutesCase(unittest.TestCase):
+    """
+    Tests for the routes
+    """
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 0
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        last_seen_buffer.clear()
+        app.config['WTF_CSRF_ENABLED'] = True
+        app.config['POSTS_PER_PAGE'] = 10
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 10
+
+    def login(self, username, password='cat'):
+        return self.client.post('/login', data={'username': username,
+                                                'password': password})
+
+    def create_users(self, *usernames):
+        users = []
+        for username in usernames:
+            u = User(username=username, email=f'{username}@example.com')
+            u.set_password('cat')
+            users.append(u)
+        db.session.add_all(users)
+        db.session.commit()
+        return users
+
+    def test_constant_queries_per_page(self):
+        # one author per post so that lazy loads cannot hit the identity map
+        users = self.create_users('john')
+        users += [User(username=f'user{i}', email=f'user{i}@example.com')
+                  for i in range(20)]
+        for u in users[1:]:
+            users[0].follow(u)
+        now = datetime.utcnow()
+        db.session.add_all([Post(body=f'post {i}', author=users[1 + i % 20],
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(40)])
+        db.session.commit()
+        self.login('john')
+        for url in ['/', '/explore', '/user/user1']:
+            counts = []
+            for per_page in (4, 20):
+                app.config['POSTS_PER_PAGE'] = per_page
+                with QueryCounter() as counter:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                counts.append(counter.count)
+            self.assertEqual(counts[0], counts[1], url)
+
+    def test_follow_queries(self):
+        self.create_users('john', 'susan')
+        self.login('john')
+        # the followed ids of the current user are loaded once per request,
+        # the unfollow checks whether susan stops being fanned out on read
+        for method, url, queries in [('get', '/user/susan', 5),
+                                     ('get', '/user/susan/popup', 3),
+                                     ('post', '/toggle-follow/susan', 7),
+                                     ('get', '/user/susan', 5),
+                                     ('post', '/toggle-follow/susan', 8)]:
+            with QueryCounter() as counter:
+                response = getattr(self.client, method)(url)
+            self.assertLess(response.status_code, 400)
+            self.assertEqual(counter.count, queries, url)
+            self.assertEqual(len([statement
+                                  for statement in counter.statements
+                                  if statement.startswith('SELECT') and
+                                  'FROM followers' in statement]), 1)
+        john, susan = User.query.order_by(User.id).all()
+        self.assertFalse(john.is_following(susan))
+
+    def test_last_seen(self):
+        john, = self.create_users('john')
+        john_id, stored = john.id, john.last_seen
+        self.login('john')
+        john = User.query.get(john_id)
+        self.client.get('/')
+
+        # the visit is buffered, but already shown on the profile
+        self.assertEqual(db.session.query(User.last_seen).scalar(), stored)
+        seen = last_seen_buffer.seen(john)
+        self.assertGreater(seen, stored)
+        self.assertIn(seen.strftime('%Y-%m-%dT%H:%M:%S').encode(),
+                      self.client.get('/user/john').data)
+
+        # written at most once per granularity
+        self.assertEqual(last_seen_buffer.flush(), 1)
+        self.assertEqual(db.session.query(User.last_seen).scalar(), seen)
+        self.client.get('/explore')
+        self.assertEqual(last_seen_buffer.flush(), 0)
+        self.assertTrue(last_seen_buffer.touch(
+            john.id, seen + timedelta(minutes=2)))
+        self.assertEqual(last_seen_buffer.flush(), 1)
+
+    def test_post_fragments(self):
+        john, susan = self.create_users('john', 'susan')
+        db.session.add_all([Post(body='from john', author=john),
+                            Post(body='from susan', author=susan)])
+        db.session.commit()
+        susan_id = susan.id
+        self.login('john')
+        post_fragments.setup()
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        first = self.client.get('/explore').data
+        second = self.client.get('/explore').data
+        self.assertEqual(post_fragments.stats()['hits'], 2)
+        # the delete form of the author gets the token of the session
+        for page in (first, second):
+            self.assertEqual(page.count(b'name="csrf_token"'), 2)
+            self.assertNotIn(b'\x00', page)
+        self.assertIn(b'class="user_popup"', second)
+        self.assertNotIn(b'class="user_popup"',
+                         self.client.get('/user/john').data)
+
+        # profile edits render the posts again
+        User.query.get(susan_id).username = 'suzy'
+        db.session.commit()
+        page = self.client.get('/explore').data
+        self.assertIn(b'suzy', page)
+        self.assertNotIn(b'/user/susan', page)
+
+        post = Post.query.filter_by(body='from susan').one()
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(post_fragments.stats()['size'], 2)
+
+    def test_explore_buffer(self):
+        app.config['EXPLORE_BUFFER_SIZE'] = 5
+        app.config['POSTS_PER_PAGE'] = 2
+        recent_posts.setup()
+        john, = self.create_users('john')
+        now = datetime.utcnow()
+        db.session.add_all([Post(body=f'post {i}', author=john,
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(4)])
+        db.session.commit()
+        self.login('john')
+
+        def explore(page):
+            with QueryCounter() as counter:
+                data = self.client.get(f'/explore?page={page}').data
+            buffered = not any('FROM post' in statement
+                               for statement in counter.statements)
+            return re.findall(rb'post (\d+)', data), buffered
+
+        # the first read of the process fills the ring
+        self.assertEqual(explore(1), ([b'3', b'2'], False))
+        self.assertEqual(explore(1), ([b'3', b'2'], True))
+        self.assertEqual(explore(2), ([b'1', b'0'], True))
+        self.assertEqual(explore(3), ([], True))
+
+        # once the oldest posts are overwritten, only the pages still in
+        # the ring are served from it
+        db.session.add_all([Post(body=f'post {i}', author=john,
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(4, 7)])
+        db.session.commit()
+        self.assertEqual(explore(1), ([b'6', b'5'], True))
+        self.assertEqual(explore(3), ([b'2', b'1'], False))
+
+        db.session.delete(Post.query.filter_by(body='post 5').one())
+        db.session.commit()
+        self.assertEqual(explore(1), ([b'6', b'4'], True))
+
+        app.config['CURSOR_PAGINATION'] = True
+        try:
+            with QueryCounter() as counter:
+                response = self.client.get('/explore')
+            self.assertFalse(any('FROM post' in statement
+                                 for statement in counter.statements))
+            cursor = re.search(rb'cursor=([\w-]+)', response.data).group(1)
+            data = self.client.get(f'/explore?cursor={cursor.decode()}').data
+            self.assertEqual(re.findall(rb'post (\d+)', data),
+                             [b'3', b'2'])
+        finally:
+            app.config['CURSOR_PAGINATION'] = False
+            app.config['EXPLORE_BUFFER_SIZE'] = 0
+
+    def test_shared_explore_buffer(self):
+        app.config['EXPLORE_BUFFER_SIZE'] = 10
+        app.config['EXPLORE_BUFFER_PATH'] = os.path.join(
+            tempfile.mkdtemp(), 'explore')
+        try:
+            recent_posts.setup()
+            other = RecentPosts()
+            john, = self.create_users('john')
+            self.assertEqual(other.newest(10), [])
+            # the posts committed in this process are seen by the other one
+            db.session.add(Post(body='hello', author=john))
+            db.session.commit()
+            (_, post_id, user_id, body), = other.newest(10)
+            self.assertEqual((user_id, body), (john.id, 'hello'))
+            db.session.delete(Post.query.get(post_id))
+            db.session.commit()
+            self.assertEqual(other.newest(10), [])
+        finally:
+            app.config['EXPLORE_BUFFER_SIZE'] = 0
+            app.config['EXPLORE_BUFFER_PATH'] = None
+
+    def test_conditional_get(self):
+        john, susan = self.create_users('john', 'susan')
+        susan_id = susan.id
+        self.login('john')
+        self.client.get('/')
+
+        def get(url):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual(response.headers['Cache-Control'],
+                             'private, no-cache')
+            self.assertIn('Cookie', response.headers['Vary'])
+            etag = response.headers['ETag']
+            self.assertTrue(etag.startswith('W/'))
+            with QueryCounter() as counter:
+                cached = self.client.get(url,
+                                         headers={'If-None-Match': etag})
+            self.assertEqual(cached.status_code, 304, url)
+            self.assertEqual(cached.headers['ETag'], etag)
+            return etag, counter.count
+
+        urls = ['/', '/explore', '/user/susan', '/user/susan/popup']
+        etags = {}
+        for url in urls:
+            etags[url], queries = get(url)
+            # the user of the session and the watermark
+            self.assertLessEqual(queries, 2, url)
+        # the other pages of a URL have their own ETag
+        self.assertNotEqual(get('/explore?page=2')[0], etags['/explore'])
+
+        # a post of susan changes the explore page and her profile
+        db.session.add(Post(body='hello', author=User.query.get(susan_id)))
+        db.session.commit()
+        for url, changed in [('/', False), ('/explore', True),
+                             ('/user/susan', True),
+                             ('/user/susan/popup', True)]:
+            etag, _ = get(url)
+            self.assertEqual(etag != etags[url], changed, url)
+            etags[url] = etag
+
+        # following her changes the home timeline and her popup
+        self.client.post('/toggle-follow/susan')
+        self.client.get('/')
+        for url in urls:
+            etag, _ = get(url)
+            self.assertNotEqual(etag, etags[url], url)
+            etags[url] = etag
+
+        # the flashed messages are only shown once
+        with self.client.session_transaction() as session:
+            session['_flashes'] = [('message', 'Welcome back')]
+        response = self.client.get('/', headers={'If-None-Match': etags['/']})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Welcome back', response.data)
+        self.assertNotIn('ETag', response.headers)
+        response = self.client.get('/', headers={'If-None-Match': etags['/']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_api_timelines(self):
+        john, susan, david = self.create_users('john', 'susan', 'david')
+        john.follow(susan)
+        now = datetime.utcnow()
+        db.session.add_all([Post(body=f'post {i}',
+                                 author=[susan, david][i % 2],
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(6)])
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/v1/timeline').status_code, 401)
+        self.login('john')
+
+        def pages(url):
+            bodies, cursor = [], None
+            while True:
+                response = self.client.get(
+                    url, query_string={'limit': 2, 'cursor': cursor,
+                                       'fields': 'body,author.username'})
+                self.assertEqual(response.mimetype, 'application/json')
+                payload = response.get_json()
+                for post in payload['posts']:
+                    self.assertEqual(set(post), {'body', 'author'})
+                    self.assertEqual(set(post['author']), {'username'})
+                    bodies.append(post['body'])
+                cursor = payload['next_cursor']
+                if cursor is None:
+                    return bodies
+
+        self.assertEqual(pages('/api/v1/timeline'),
+                         ['post 4', 'post 2', 'post 0'])
+        self.assertEqual(pages('/api/v1/explore'),
+                         [f'post {i}' for i in range(5, -1, -1)])
+        self.assertEqual(pages('/api/v1/users/david/posts'),
+                         ['post 5', 'post 3', 'post 1'])
+        response = self.client.get('/api/v1/explore?limit=1')
+        post = response.get_json()['posts'][0]
+        self.assertEqual(set(post), {'id', 'body', 'timestamp', 'author'})
+        self.assertEqual(set(post['author']), {'username', 'avatar'})
+        for url, status in [('/api/v1/users/nobody/posts', 404),
+                            ('/api/v1/explore?fields=password_hash', 400),
+                            ('/api/v1/explore?fields=author.email', 400),
+                            ('/api/v1/explore?limit=1000', 400),
+                            ('/api/v1/explore?cursor=invalid', 400)]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status, url)
+            self.assertIn('error', response.get_json())
+
+    def test_api_users(self):
+        self.create_users('john', 'susan', 'david')
+        self.login('john')
+        self.client.post('/toggle-follow/susan')
+        with QueryCounter() as counter:
+            response = self.client.get(
+                '/api/v1/users?usernames=susan,nobody,david,john'
+                '&fields=username,following,followers_count')
+        payload = response.get_json()
+        self.assertEqual(payload['users'], [
+            {'username': 'susan', 'following': True, 'followers_count': 1},
+            {'username': 'david', 'following': False, 'followers_count': 0},
+            {'username': 'john', 'following': False, 'followers_count': 0}])
+        self.assertEqual(payload['missing'], ['nobody'])
+        # the user of the session, the users and the followed ids
+        self.assertEqual(counter.count, 3)
+        self.assertEqual(self.client.get('/api/v1/users').status_code, 400)
+
+    def test_stream(self):
+        john, susan, david = self.create_users('john', 'susan', 'david')
+        john.follow(susan)
+        db.session.commit()
+        susan_id, david_id = susan.id, david.id
+        self.login('john')
+        self.assertEqual(self.client.get('/stream').status_code, 404)
+        self.assertNotIn(b'EventSource', self.client.get('/').data)
+        app.config['SSE_ENABLED'] = True
+        app.config['SSE_RELAY_INTERVAL'] = 0
+        app.config['SSE_QUEUE_SIZE'] = 2
+        broker.setup()
+        try:
+            self.assertIn(b'EventSource', self.client.get('/').data)
+            response = self.client.get('/stream')
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            events = iter(response.response)
+            self.assertTrue(next(events).startswith(b'retry:'))
+            self.assertEqual(broker.connections, 1)
+            # the idle connection holds no database connection
+            self.assertEqual(db.session().transaction._connections, {})
+
+            # only the posts of the followed users are sent
+            db.session.add_all([Post(body='not followed',
+                                     author=User.query.get(david_id)),
+                                Post(body='followed',
+                                     author=User.query.get(susan_id))])
+            db.session.commit()
+            post = next(events).decode()
+            self.assertIn('event: post', post)
+            data = json.loads(post.split('data: ')[1])
+            self.assertEqual(data['user_id'], susan_id)
+            self.assertIn('followed', data['html'])
+            self.assertIn('user_popup', data['html'])
+
+            # a post committed by another process is relayed once
+            db.session.execute(Post.__table__.insert().values(
+                body='relayed', user_id=susan_id,
+                timestamp=datetime.utcnow()))
+            db.session.commit()
+            broker.poll()
+            broker.poll()
+            self.assertIn('relayed', next(events).decode())
+
+            # too many waiting posts, the page is reloaded
+            db.session.add_all([Post(body=f'post {i}',
+                                     author=User.query.get(susan_id))
+                                for i in range(3)])
+            db.session.commit()
+            self.assertIn(b'event: reload', next(events))
+            self.assertRaises(StopIteration, next, events)
+            response.close()
+            self.assertEqual(broker.connections, 0)
+        finally:
+            app.config['SSE_ENABLED'] = False
+            app.config['SSE_RELAY_INTERVAL'] = 2
+            app.config['SSE_QUEUE_SIZE'] = 100
+
+    def test_delete_account(self):
+        john, susan, david = self.create_users('john', 'susan', 'david')
+        john.follow(susan)
+        david.follow(john)
+        db.session.add_all([Post(body=f'john {i}', author=john)
+                            for i in range(3)])
+        db.session.add(Post(body='susan', author=susan))
+        db.session.commit()
+        john_id = john.id
+        self.login('john')
+        with QueryCounter() as counter:
+            response = self.client.post('/delete-account')
+        self.assertEqual(response.status_code, 302)
+        # constant, whatever the number of posts
+        self.assertLess(counter.count, 30)
+        self.assertIsNone(User.query.get(john_id))
+        self.assertEqual([post.body for post in Post.query], ['susan'])
+        self.assertEqual(query_index('post', 'john', 1, 10)[1], 0)
+        susan, david = User.query.order_by(User.id).all()
+        self.assertEqual((susan.followers_count, david.followed_count), (0, 0))
+        self.assertEqual(susan.followers.count(), 0)
+        job = AccountDeletion.query.one()
+        self.assertEqual((job.status, job.posts_total, job.posts_deleted),
+                         ('done', 3, 3))
+        self.assertEqual(self.client.get('/').status_code, 302)
+
+    def test_background_account_deletion(self):
+        john, susan = self.create_users('john', 'susan')
+        susan.follow(john)
+        db.session.add_all([Post(body=f'john {i}', author=john)
+                            for i in range(5)])
+        db.session.commit()
+        john_id = john.id
+        app.config['ACCOUNT_DELETION_SYNC_LIMIT'] = 2
+        app.config['ACCOUNT_DELETION_BATCH_SIZE'] = 2
+        app.config['ACCOUNT_DELETION_THREAD'] = False
+        try:
+            self.login('susan')
+            explore = self.client.get('/explore').headers['ETag']
+            self.client.get('/logout')
+            self.login('john')
+            self.client.post('/delete-account')
+            # hidden at once, deleted later
+            job = AccountDeletion.query.one()
+            self.assertEqual((job.status, job.posts_deleted), ('pending', 0))
+            self.assertIsNotNone(User.query.get(john_id).deleted_at)
+            self.login('john')
+            self.assertIn(b'Invalid username',
+                          self.client.get('/login').data)
+            self.login('susan')
+            self.assertEqual(self.client.get('/user/john').status_code, 404)
+            self.assertNotEqual(self.client.get('/explore').headers['ETag'],
+                                explore)
+
+            self.assertEqual(account_deleter.work(), 1)
+            db.session.expire_all()
+            job = AccountDeletion.query.one()
+            self.assertEqual((job.status, job.posts_deleted), ('done', 5))
+            self.assertIsNone(User.query.get(john_id))
+            self.assertEqual(Post.query.count(), 0)
+            self.assertEqual(User.query.one().followed_count, 0)
+            # an interrupted job is resumed once stale
+            job.status = 'running'
+            db.session.commit()
+            self.assertIsNone(account_deleter.claim())
+            job.updated_at = datetime.utcnow() - timedelta(hours=1)
+            db.session.commit()
+            self.assertEqual(account_deleter.claim().id, job.id)
+        finally:
+            app.config['ACCOUNT_DELETION_SYNC_LIMIT'] = 1000
+            app.config['ACCOUNT_DELETION_BATCH_SIZE'] = 1000
+            app.config['ACCOUNT_DELETION_THREAD'] = True
+
+
+class FakeElasticsearch:
+    """
+    In-memory stand-in for the Elasticsearch client
+    """
+
+    def __init__(self):
+        self.indices = {}
+        self.bulk_requests = []
+        self.down = False
+
+    def bulk(self, body):
+        if self.down:
+            raise ElasticsearchConnectionError('N/A', 'down', None)
+        self.bulk_requests.append(body)
+        items = []
+        lines = iter(body)
+        for action in lines:
+            operation, meta = next(iter(action.items()))
+            documents = self.indices.setdefault(meta['_index'], {})
+            if operation == 'index':
+                documents[str(meta['_id'])] = next(lines)
+                status = 201
+            else:
+                status = 200 if documents.pop(str(meta['_id']), None) \
+                    else 404
+            items.append({operation: {'_id': meta['_id'],
+                                      'status': status}})
+        return {'errors': any(next(iter(item.values()))['status'] >= 300
+                              for item in items),
+                'items': items}
+
+    def search(self, index, body):
+        query = body['query']['multi_match']['query'].lower()
+        # sorted by (_score, _id) like the backend asks
+        hits = [{'_id': object_id, '_score': 1.0, 'sort': [1.0, object_id]}
+                for object_id, document in sorted(
+                    self.indices.get(index, {}).items())
+                if any(query in str(value).lower()
+                       for value in document.values())]
+        total = len(hits)
+        if 'search_after' in body:
+            hits = [hit for hit in hits
+                    if hit['sort'][1] > body['search_after'][1]]
+        start = body.get('from', 0)
+        return {'hits': {'total': {'value': total},
+                         'hits': hits[start:start + body['size']]}}
+
+
+class SearchCase(unittest.TestCase):
+    """
+    Tests for the search indexing
+    """
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['SEARCH_INDEXER_THREAD'] = False
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 0
+        db.create_all()
+        self.elasticsearch = app.elasticsearch
+        app.elasticsearch = FakeElasticsearch()
+        search_cache.setup()
+        hydration_cache.setup()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        app.elasticsearch = self.elasticsearch
+        last_seen_buffer.clear()
+        app.config['SEARCH_INDEXER_THREAD'] = True
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 10
+
+    def test_outbox(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first post', author=u)
+        p2 = Post(body='second post', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+
+        # mutations wait in the outbox until drained
+        self.assertEqual(indexer.queue_depth(), 2)
+        self.assertEqual(app.elasticsearch.indices, {})
+        self.assertEqual(indexer.drain(), 2)
+        self.assertEqual(indexer.queue_depth(), 0)
+        self.assertEqual(app.elasticsearch.indices['post'],
+                         {str(p1.id): {'body': 'first post'},
+                          str(p2.id): {'body': 'second post'}})
+
+        # repeated updates of an object are coalesced
+        p1.body = 'edited post'
+        db.session.commit()
+        p1.body = 'edited again'
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 3)
+        self.assertEqual(len(app.elasticsearch.bulk_requests[-1]), 3)
+        self.assertEqual(app.elasticsearch.indices['post'],
+                         {str(p1.id): {'body': 'edited again'}})
+
+        # failed mutations are retried later
+        app.elasticsearch.down = True
+        db.session.add(Post(body='third post', author=u))
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 1)
+        self.assertEqual(indexer.queue_depth(), 1)
+        self.assertEqual(indexer.drain(), 0)
+        app.elasticsearch.down = False
+        db.session.execute(search_outbox.update().values(
+            next_attempt=datetime.utcnow()))
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 1)
+        self.assertEqual(indexer.queue_depth(), 0)
+        self.assertEqual(len(app.elasticsearch.indices['post']), 2)
+
+    def test_outbox_single_drainer(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='first post', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+
+        # another process holds the lease until it expires
+        db.session.execute(lease.insert().values(
+            name='search-indexer', owner='other',
+            expires_at=datetime.utcnow() + timedelta(seconds=60)))
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 0)
+        self.assertEqual(indexer.queue_depth(), 1)
+        db.session.execute(lease.update().values(expires_at=datetime.utcnow()))
+        db.session.commit()
+
+        # a failed mutation waiting for a retry is superseded by a newer one
+        app.elasticsearch.down = True
+        self.assertEqual(indexer.drain(), 1)
+        app.elasticsearch.down = False
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(indexer.drain(), 1)
+        self.assertEqual(indexer.queue_depth(), 0)
+        self.assertEqual(app.elasticsearch.indices['post'], {})
+        self.assertEqual(len(app.elasticsearch.bulk_requests), 1)
+        self.assertIn('delete', app.elasticsearch.bulk_requests[0][0])
+        # and the lease is released for the other processes
+        self.assertLess(db.session.query(lease.c.expires_at).scalar(),
+                        datetime.utcnow())
+
+    def test_database_search(self):
+        app.elasticsearch = None
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the cat sat on the mat', author=u)
+        p2 = Post(body='a cat and a cat', author=u)
+        p3 = Post(body='a dog', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        self.assertEqual(indexer.queue_depth(), 0)
+
+        # ranked by relevance, any word matches
+        posts, total, _ = Post.search('cat', 1, 10)
+        self.assertEqual((posts, total), ([p2, p1], 2))
+        posts, total, _ = Post.search('dog mat', 1, 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(Post.search('"', 1, 10)[1], 0)
+
+        # the index follows the updates and deletes
+        p3.body = 'a cat'
+        db.session.delete(p2)
+        db.session.commit()
+        posts, total, _ = Post.search('cat', 1, 10)
+        self.assertEqual((posts, total), ([p3, p1], 2))
+
+    def test_search_cache(self):
+        app.elasticsearch = None
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='a cat', author=u)
+        db.session.add_all([u, p1])
+        db.session.commit()
+
+        self.assertEqual(query_index('post', 'Cat', 1, 10)[:2], ([p1.id], 1))
+        self.assertEqual(query_index('post', ' cat ', 1, 10)[:2],
+                         ([p1.id], 1))
+        self.assertEqual(query_index('post', 'cat', 2, 10)[:2], ([], 1))
+        self.assertEqual(search_cache.stats()['hits'], 1)
+        self.assertEqual(search_cache.stats()['misses'], 2)
+
+        # committing searchable changes invalidates the results
+        p2 = Post(body='another cat', author=u)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(query_index('post', 'cat', 1, 10)[1], 2)
+
+        # the generation is shared between processes through a file, by
+        # default in the instance folder
+        self.assertIsInstance(search_cache.generation, SharedGeneration)
+        path = os.path.join(tempfile.mkdtemp(), 'generation')
+        first, second = SharedGeneration(path), SharedGeneration(path)
+        first.bump()
+        first.bump()
+        self.assertEqual(second.get(), 2)
+
+    def search_pages(self, query, per_page):
+        """
+        Returns the ids of the pages of a search chained by positions
+        """
+        pages, after = [], None
+        while True:
+            ids, total, after = query_index('post', query, 1, per_page, after)
+            if not ids:
+                return pages
+            pages.append(ids)
+
+    def test_search_after(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Post(body=f'cat {i}' + ' cat' * (i % 3),
+                                 author=u) for i in range(12)])
+        db.session.add(Post(body='a dog', author=u))
+        db.session.commit()
+        indexer.drain()
+
+        for backend in ['elasticsearch', 'sqlite']:
+            if backend == 'sqlite':
+                app.elasticsearch = None
+            # the pages continued from positions are the pages by offset
+            pages = self.search_pages('cat', 5)
+            self.assertEqual([len(ids) for ids in pages], [5, 5, 2])
+            self.assertEqual(pages, [query_index('post', 'cat', page, 5)[0]
+                                     for page in (1, 2, 3)])
+
+    def test_search_route(self):
+        app.elasticsearch = None
+        app.config['WTF_CSRF_ENABLED'] = False
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.add_all([Post(body=f'cat {i}', author=u)
+                            for i in range(25)])
+        db.session.commit()
+        client = app.test_client()
+        client.post('/login', data={'username': 'john', 'password': 'cat'})
+
+        response = client.get('/search?q=cat')
+        self.assertIn(b'cursor=', response.data)
+        cursor = re.search(r'cursor=([\w-]+)', response.data.decode()).group(1)
+        self.assertEqual(decode_search_cursor(cursor)[0], 2)
+        response = client.get(f'/search?q=cat&cursor={cursor}')
+        self.assertIn(b'page=1', response.data)
+        # old page links still work
+        bodies = re.findall(r'cat \d+', response.data.decode())
+        self.assertEqual(len(bodies), 10)
+        self.assertEqual(bodies, re.findall(
+            r'cat \d+', client.get('/search?q=cat&page=2').data.decode()))
+        self.assertEqual(decode_search_cursor('garbage'), None)
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def test_account_deletion_index(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Post(body=f'cat {i}', author=u)
+                            for i in range(3)])
+        db.session.commit()
+        indexer.drain()
+        self.assertEqual(len(app.elasticsearch.indices['post']), 3)
+        account_deleter.request(u)
+        # the deletions go through the outbox, after the pending indexing
+        self.assertEqual(indexer.queue_depth(), 3)
+        indexer.drain()
+        self.assertEqual(app.elasticsearch.indices['post'], {})
+        self.assertEqual(len(app.elasticsearch.bulk_requests), 2)
+
+    def test_search_api(self):
+        app.elasticsearch = None
+        app.config['WTF_CSRF_ENABLED'] = False
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.add_all([Post(body=f'cat {i}', author=u)
+                            for i in range(25)])
+        db.session.commit()
+        client = app.test_client()
+        client.post('/login', data={'username': 'john', 'password': 'cat'})
+        app.config['WTF_CSRF_ENABLED'] = True
+        bodies, cursor = [], None
+        while True:
+            payload = client.get('/api/v1/search', query_string={
+                'q': 'cat', 'cursor': cursor, 'fields': 'body'}).get_json()
+            self.assertEqual(payload['total'], 25)
+            bodies += [post['body'] for post in payload['posts']]
+            cursor = payload['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(sorted(bodies), sorted(f'cat {i}' for i in range(25)))
+        self.assertEqual(client.get('/api/v1/search').status_code, 400)
+        self.assertEqual(
+            client.get('/api/v1/search?q=cat&cursor=garbage').status_code, 400)
+
+    def test_data_round_trip(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(4)]
+        db.session.add_all(users)
+        users[0].follow(users[1])
+        users[0].follow(users[2])
+        users[3].follow(users[0])
+        db.session.add_all([Post(body=f'cat {i}', author=users[i % 3])
+                            for i in range(10)])
+        db.session.commit()
+        timelines = db.session.query(timeline).order_by(
+            timeline.c.user_id, timeline.c.post_id).all()
+        runner = app.test_cli_runner()
+        directory = tempfile.mkdtemp()
+        files = {'users': os.path.join(directory, 'users.jsonl'),
+                 'follows': os.path.join(directory, 'follows.csv'),
+                 'posts': os.path.join(directory, 'posts.jsonl')}
+        for kind, path in files.items():
+            result = runner.invoke(args=['data', 'export', kind, path])
+            self.assertEqual(result.exit_code, 0, result.output)
+        with open(files['follows']) as follows:
+            self.assertEqual(follows.readline(), 'follower_id,followed_id\n')
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        app.elasticsearch = FakeElasticsearch()
+        for kind, path in files.items():
+            result = runner.invoke(args=['data', 'import', kind, path,
+                                         '--batch-size', '3'])
+            self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(
+            Counters.check([u.id for u in User.query], repair=False), [])
+        self.assertEqual(db.session.query(timeline).order_by(
+            timeline.c.user_id, timeline.c.post_id).all(), timelines)
+        # indexed at once, without going through the outbox
+        self.assertEqual(len(app.elasticsearch.indices['post']), 10)
+        self.assertEqual(indexer.queue_depth(), 0)
+
+        # the posts without an id follow the others, the batches before an
+        # error are kept
+        result = runner.invoke(args=['data', 'import', 'posts',
+                                     '--batch-size', '1'],
+                               input='{"user_id": 1, "body": "dog"}\n'
+                                     '{"user_id": 1}\n')
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('line 2: missing body', result.output)
+        post = Post.query.filter_by(body='dog').one()
+        self.assertEqual(post.id, 11)
+        self.assertEqual(User.query.get(1).posts_count, 5)
+        self.assertEqual(User.query.get(4).timeline_posts().first(), post)
+        self.assertEqual(len(app.elasticsearch.indices['post']), 11)
+
+        # the lines which are not JSON objects are reported
+        for line, error in (('{"user_id": 1', 'line 2: Expecting'),
+                            ('[1, "cat"]', 'line 2: not a JSON object')):
+            result = runner.invoke(args=['data', 'import', 'posts'],
+                                   input='\n' + line + '\n')
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn(error, result.output)
+
+    def test_database_reindex(self):
+        app.elasticsearch = None
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Post(body=f'cat {i}', author=u)
+                            for i in range(25)])
+        db.session.commit()
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'reindex.json')
+        reindexer = Reindexer('post', chunk_size=10, batch_size=4,
+                              workers=4, checkpoint=checkpoint)
+
+        # a database error fails its chunk only
+        def locked(cls, *args):
+            raise OperationalError('DELETE', {}, Exception('locked'))
+
+        Post.reindex = classmethod(locked)
+        try:
+            self.assertEqual(reindexer.run()[:2], (0, 3))
+        finally:
+            del Post.reindex
+        # SQLite is written by a single worker
+        self.assertEqual(reindexer.run()[:2], (25, 0))
+        self.assertEqual(query_index('post', 'cat', 1, 100)[1], 25)
+
+    def test_hydration_cache(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body=f'post {i}', author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        ids = [posts[2].id, posts[0].id, posts[1].id]
+        db.session.remove()
+
+        # the misses are fetched in one query, in the order of the hits
+        with QueryCounter() as counter:
+            self.assertEqual([p.id for p in Post.hydrate(ids + [42])], ids)
+        self.assertEqual(counter.count, 1)
+        db.session.remove()
+        with QueryCounter() as counter:
+            hydrated = Post.hydrate(ids)
+            self.assertEqual([p.body for p in hydrated],
+                             ['post 2', 'post 0', 'post 1'])
+        self.assertEqual(counter.count, 0)
+
+        # the objects are attached to the session
+        self.assertEqual(hydrated[0].author.username, 'john')
+        hydrated[0].body = 'edited'
+        db.session.delete(hydrated[1])
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual([p.body for p in Post.hydrate(ids)],
+                         ['edited', 'post 1'])
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        cache = LRUCache(2, ttl=-1)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_reindex(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Post(body=f'post {i}', author=u)
+                            for i in range(25)])
+        db.session.commit()
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'reindex.json')
+        reindexer = Reindexer('post', chunk_size=10, batch_size=4,
+                              checkpoint=checkpoint)
+
+        # failed chunks are not checkpointed
+        app.elasticsearch.down = True
+        self.assertEqual(reindexer.run()[:2], (0, 3))
+        app.elasticsearch.down = False
+        self.assertEqual(reindexer.run()[:2], (25, 0))
+        self.assertEqual(len(app.elasticsearch.indices['post']), 25)
+
+        # an interrupted run resumes from the checkpoint
+        reindexer.save_checkpoint({(0, 10)})
+        self.assertEqual(reindexer.run()[:2], (16, 0))
+        self.assertEqual(reindexer.run()[:2], (0, 0))
+        self.assertEqual(reindexer.run(restart=True)[:2], (25, 0))
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal SMTP server session recording the messages
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.server.gate.wait()
+        self.reply('220 localhost')
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                self.server.messages.append(b''.join(data))
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class MailCase(unittest.TestCase):
+    """
+    Tests for the email queue, against a local SMTP server
+    """
+
+    def setUp(self):
+        self.smtp = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                    FakeSMTPHandler)
+        self.smtp.daemon_threads = True
+        self.smtp.connections = 0
+        self.smtp.messages = []
+        self.smtp.gate = threading.Event()
+        self.smtp.gate.set()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+        state = app.extensions['mail']
+        self.server = state.server, state.port
+        state.server, state.port = self.smtp.server_address
+        app.config['MAIL_IDLE_TIMEOUT'] = 0.2
+
+    def tearDown(self):
+        state = app.extensions['mail']
+        state.server, state.port = self.server
+        self.smtp.shutdown()
+        self.smtp.server_close()
+        app.config['MAIL_IDLE_TIMEOUT'] = 10
+        app.config['MAIL_WORKERS'] = 2
+        app.config['MAIL_QUEUE_SIZE'] = 100
+        app.config['MAIL_QUEUE_FULL'] = 'block'
+
+    def message(self, i):
+        return Message(f'message {i}', sender='admin@example.com',
+                       recipients=['john@example.com'], body='hello')
+
+    def test_connection_reuse(self):
+        app.config['MAIL_WORKERS'] = 1
+        mail_queue = MailQueue()
+        for i in range(5):
+            self.assertTrue(mail_queue.put(self.message(i)))
+        mail_queue.join()
+        self.assertEqual(len(self.smtp.messages), 5)
+        self.assertEqual(self.smtp.connections, 1)
+        stats = mail_queue.stats()
+        self.assertEqual((stats['depth'], stats['sent'], stats['failed']),
+                         (0, 5, 0))
+        self.assertGreater(stats['latency_max'], 0)
+
+    def test_queue_full(self):
+        app.config['MAIL_WORKERS'] = 1
+        app.config['MAIL_QUEUE_SIZE'] = 1
+        app.config['MAIL_QUEUE_FULL'] = 'drop'
+        mail_queue = MailQueue()
+        # the worker is stuck on the first one, the second one waits
+        self.smtp.gate.clear()
+        self.assertTrue(mail_queue.put(self.message(1)))
+        while not self.smtp.connections:
+            time.sleep(0.01)
+        self.assertTrue(mail_queue.put(self.message(2)))
+        self.assertFalse(mail_queue.put(self.message(3)))
+        self.assertEqual(mail_queue.stats()['depth'], 1)
+        self.smtp.gate.set()
+        mail_queue.join()
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertEqual(mail_queue.stats()['dropped'], 1)
+
+
+class MetricsCase(unittest.TestCase):
+    """
+    Tests for the metrics endpoint
+    """
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 0
+        db.create_all()
+        metrics.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        last_seen_buffer.clear()
+        metrics.clear()
+        app.config['WTF_CSRF_ENABLED'] = True
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 10
+        app.config['METRICS_DIR'] = None
+        app.config['METRICS_TOKEN'] = None
+
+    def scrape(self, **kwargs):
+        response = self.client.get('/metrics', **kwargs)
+        self.assertEqual(response.status_code, 200)
+        samples = {}
+        for line in response.get_data(as_text=True).splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_request_metrics(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.client.post('/login', data={'username': 'john',
+                                         'password': 'cat'})
+        for _ in range(2):
+            self.assertEqual(self.client.get('/explore').status_code, 200)
+        self.client.get('/no-such-page')
+
+        samples = self.scrape()
+        self.assertEqual(samples['microblog_http_requests_total{'
+                                 'endpoint="explore",method="GET",'
+                                 'status="200"}'], 2)
+        self.assertEqual(samples['microblog_http_requests_total{'
+                                 'endpoint="unmatched",method="GET",'
+                                 'status="404"}'], 1)
+        self.assertEqual(samples['microblog_http_request_duration_seconds_'
+                                 'bucket{endpoint="explore",le="+Inf"}'], 2)
+        self.assertEqual(samples['microblog_http_request_sql_statements_'
+                                 'count{endpoint="explore"}'], 2)
+        self.assertGreater(samples['microblog_http_request_sql_statements_'
+                                   'sum{endpoint="explore"}'], 0)
+        self.assertIn('microblog_mail_queue_depth', samples)
+        self.assertIn('microblog_search_cache_entries{cache="results"}',
+                      samples)
+
+    def test_workers_aggregation(self):
+        app.config['METRICS_DIR'] = tempfile.mkdtemp()
+        metrics.inc('microblog_http_requests_total', 2, endpoint='index',
+                    method='GET', status='200')
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        # the files of a running worker and of one that exited
+        for pid in (os.getppid(), exited.pid):
+            with open(metrics.path(pid), 'w') as file:
+                json.dump({'microblog_http_requests_total': [
+                    [[['endpoint', 'index'], ['method', 'GET'],
+                      ['status', '200']], 1]],
+                    'microblog_mail_queue_depth': [[[], 5]]}, file)
+
+        samples = self.scrape()
+        # the counters of all are added up, not the gauges of the exited one
+        self.assertEqual(samples['microblog_http_requests_total{'
+                                 'endpoint="index",method="GET",'
+                                 'status="200"}'], 4)
+        self.assertEqual(samples['microblog_mail_queue_depth'], 5)
+
+    def test_token(self):
+        app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.scrape(headers={'Authorization': 'Bearer secret'})
+        # without a token, only the host itself scrapes the metrics
+        app.config['METRICS_TOKEN'] = None
+        self.scrape()
+        self.assertEqual(self.client.get('/metrics', environ_base={
+            'REMOTE_ADDR': '10.0.0.1'}).status_code, 403)
+        self.assertEqual(self.client.get('/metrics', headers={
+            'X-Forwarded-For': '10.0.0.1'}).status_code, 403)
+
+    def test_failed_statement(self):
+        with app.test_request_context():
+            with self.assertRaises(OperationalError):
+                db.session.execute('SELECT * FROM missing')
+            self.assertEqual(db.session.connection().info['metrics_started'],
+                             [])
+
+
+class ProfilingCase(unittest.TestCase):
+    """
+    Tests for the request profiling
+    """
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 0
+        app.config['PROFILE_DIR'] = tempfile.mkdtemp()
+        init_profiling()
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        last_seen_buffer.clear()
+        app.config['WTF_CSRF_ENABLED'] = True
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 10
+        app.config['PROFILE_DIR'] = None
+        app.config['PROFILE_SAMPLE_RATE'] = 0
+
+    def profiles(self):
+        return sorted(os.listdir(app.config['PROFILE_DIR']))
+
+    def login(self, username, email):
+        u = User(username=username, email=email)
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.client.post('/login', data={'username': username,
+                                         'password': 'cat'})
+
+    def test_token(self):
+        response = self.client.get('/login',
+                                   headers={'X-Profile': profile_token()})
+        name = response.headers['X-Profile-File']
+        self.assertRegex(name, r'-login-\d+ms$')
+        self.assertEqual(self.profiles(), [f'{name}.folded', f'{name}.prof'])
+        stats = pstats.Stats(os.path.join(app.config['PROFILE_DIR'],
+                                          f'{name}.prof'))
+        self.assertTrue(any(function == 'login' for _, _, function
+                            in stats.stats))
+        with open(os.path.join(app.config['PROFILE_DIR'],
+                               f'{name}.folded')) as folded:
+            for line in folded:
+                self.assertRegex(line, r'^\S.*;.* \d+$')
+
+        # forged or expired tokens are ignored
+        self.client.get('/login', headers={'X-Profile': 'forged'})
+        self.client.get('/login',
+                        headers={'X-Profile': profile_token(-10)})
+        self.assertEqual(len(self.profiles()), 2)
+
+    def test_admin_flag(self):
+        self.login('john', 'john@example.com')
+        self.client.get('/explore?profile')
+        self.assertEqual(self.profiles(), [])
+        self.client.get('/logout')
+        self.login('admin', app.config['ADMINS'][0])
+        response = self.client.get('/explore?profile')
+        self.assertIn('-explore-', response.headers['X-Profile-File'])
+
+    def test_sampling(self):
+        self.client.get('/login')
+        self.assertEqual(self.profiles(), [])
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        self.client.get('/login')
+        self.assertEqual(len(self.profiles()), 2)
+
+
+class QueryPlanCase(unittest.TestCase):
+    """
+    Checks that the queries of the timelines, profiles and explore page
+    search indexes instead of scanning whole tables
+    """
+    database_url = 'sqlite://'
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.database_url
+        db.create_all()
+        self.users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                      for i in range(3)]
+        db.session.add_all(self.users)
+        db.session.add_all([Post(body=f'post {i}', author=self.users[i % 3])
+                            for i in range(6)])
+        self.users[0].follow(self.users[1])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+
+    def full_scans(self, query, strict=False):
+        """
+        Returns the steps of the plan of a query scanning a whole table
+        Strictly, the sorts and the index scans without a search key are
+        returned too, for the queries whose LIMIT should be served by an index
+        """
+        statement = query.statement.compile(dialect=db.engine.dialect)
+        connection = db.session.connection()
+        tables = r'(user|post|followers|timeline)\b'
+        if db.engine.dialect.name == 'sqlite':
+            plan = [row[-1] for row in connection.execute(
+                f'EXPLAIN QUERY PLAN {statement}',
+                [statement.params[name] for name in statement.positiontup])]
+            return [step for step in plan
+                    if re.match(r'SCAN (TABLE )?' + tables, step) and
+                    (strict or 'USING' not in step) or
+                    strict and re.match(r'USE TEMP B-TREE FOR .*ORDER BY',
+                                        step)]
+        # the tables are tiny, sequential scans are only used as a last resort
+        connection.execute('SET LOCAL enable_seqscan = off')
+        plan = [row[0] for row in connection.execute(
+            f'EXPLAIN {statement}', statement.params)]
+        # each node of the plan with the lines of its details
+        nodes = []
+        for line in plan:
+            if not nodes or '->' in line:
+                nodes.append([])
+            nodes[-1].append(line)
+        return [node[0] for node in nodes
+                if re.search(r'Seq Scan on "?' + tables, node[0]) or
+                strict and (
+                    re.search(r'(^|->)\s*(Incremental )?Sort\b', node[0]) or
+                    re.search(r'(^|->)\s*Index (Only )?Scan', node[0]) and
+                    not any('Index Cond' in line for line in node[1:]))]
+
+    def test_query_plans(self):
+        u = self.users[0]
+        queries = {
+            'followed_posts': u.followed_posts().limit(10),
+            'followers': u.followers,
+            'followed': u.followed,
+            'explore': Post.query.order_by(Post.timestamp.desc()).limit(10),
+        }
+        for name, query in queries.items():
+            self.assertEqual(self.full_scans(query), [], name)
+        # the pages of the timeline and profile are read in index order
+        queries = {
+            'timeline_posts': u.timeline_posts().limit(10),
+            'profile': u.posts.order_by(Post.timestamp.desc(),
+                                        Post.id.desc()).limit(10),
+        }
+        for name, query in queries.items():
+            self.assertEqual(self.full_scans(query, strict=True), [], name)
+
+
+@unittest.skipUnless(os.environ.get('TEST_POSTGRES_URL'),
+                     'TEST_POSTGRES_URL is not set')
+class PostgresQueryPlanCase(QueryPlanCase):
+    """
+    Checks the query plans on PostgreSQL
+    """
+    database_url = os.environ.get('TEST_POSTGRES_URL')
+
+
+class DataCase(unittest.TestCase):
+    """
+    Tests for the bulk import of the users, posts and follows
+    """
+    database_url = 'sqlite://'
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.database_url
+        app.config['SEARCH_INDEXER_THREAD'] = False
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['SEARCH_INDEXER_THREAD'] = True
+
+    def test_mixed_ids(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['data', 'import', 'users', '--format',
+                                     'csv', '--batch-size', '2'],
+                               input='id,username,email\n'
+                                     '3,john,john@example.com\n'
+                                     ',susan,susan@example.com\n'
+                                     '7,david,david@example.com\n'
+                                     ',mary,mary@example.com\n')
+        self.assertEqual(result.exit_code, 0, result.output)
+        # the rows without an id follow the ids of the earlier batches
+        self.assertEqual([(u.id, u.username) for u in
+                          User.query.order_by(User.id)],
+                         [(3, 'john'), (4, 'susan'), (7, 'david'),
+                          (8, 'mary')])
+        self.assertEqual(User.query.get(4).email_hash,
+                         User(email='susan@example.com').email_hash)
+
+
+@unittest.skipUnless(os.environ.get('TEST_POSTGRES_URL'),
+                     'TEST_POSTGRES_URL is not set')
+class PostgresDataCase(DataCase):
+    """
+    Tests for the bulk import through COPY on PostgreSQL
+    """
+    database_url = os.environ.get('TEST_POSTGRES_URL')
+
+
+class PaginationCase(unittest.TestCase):
+    """
+    Tests for the keyset pagination
+    """
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_keyset_paginate(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        # two posts per timestamp to check the id tie-breaker
+        posts = [Post(body=f'post {i}', author=u1 if i % 3 else u2,
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(7)]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                          reverse=True)
+        key = (Post.timestamp, Post.id)
+
+        # forward through the union query
+        seen, cursor, pages = [], None, []
+        while True:
+            page = keyset_paginate(u1.followed_posts(), key, 3, cursor)
+            pages.append(page)
+            seen.extend(page.items)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+        self.assertEqual([len(p.items) for p in pages], [3, 3, 1])
+        self.assertIsNone(pages[0].prev_cursor)
+
+        # backward from the last page
+        page = keyset_paginate(u1.followed_posts(), key, 3,
+                               pages[-1].prev_cursor)
+        self.assertEqual(page.items, expected[3:6])
+        page = keyset_paginate(u1.followed_posts(), key, 3,
+                               page.prev_cursor)
+        self.assertEqual(page.items, expected[:3])
+        self.assertIsNone(page.prev_cursor)
+
+        # invalid cursors fall back to the first page
+        page = keyset_paginate(Post.query, key, 3, 'not-a-cursor')
+        self.assertEqual(page.items, expected[:3])
+
+        # the home timeline pages on the timeline index, or on the posts when
+        # popular authors are merged in on read
+        saved = app.config['TIMELINE_FANOUT_THRESHOLD']
+        for threshold in (5000, 0):
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = threshold
+            try:
+                query, key = u1.timeline()
+                self.assertEqual(key[0].table.name,
+                                 'timeline' if threshold else 'post')
+                seen, cursor = [], None
+                while True:
+                    page = keyset_paginate(query, key, 3, cursor)
+                    seen.extend(page.items)
+                    cursor = page.next_cursor
+                    if cursor is None:
+                        break
+                self.assertEqual(seen, expected, threshold)
+                page = keyset_paginate(query, key, 3, page.prev_cursor)
+                self.assertEqual(page.items, expected[3:6], threshold)
+            finally:
+                app.config['TIMELINE_FANOUT_THRESHOLD'] = saved
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)